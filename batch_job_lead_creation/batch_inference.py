@@ -0,0 +1,230 @@
+import json
+import os
+import re
+import time
+from urllib.parse import urlparse
+
+import boto3
+
+from logger_config import logger
+
+# status of a batch inference job, as reported by bedrock
+COMPLETED_STATUSES = {"Completed", "PartiallyCompleted"}
+FAILED_STATUSES = {"Failed", "Stopped", "Expired"}
+
+# one record per model request, record ids are 11 alphanumeric characters
+RECORD_KINDS = {"E": "extraction", "S": "summary"}
+
+
+def build_batch_records(session_requests):
+    """
+    Turns the model requests of every session into batch inference records.
+
+    Args:
+        session_requests (Dict): Session id to {"extraction": body, "summary": body}.
+
+    Returns:
+        tuple: JSONL records and the manifest of session ids, a record id holds the
+        kind of the request and the position of its session in the manifest.
+    """
+    records = []
+    manifest = []
+    kind_prefixes = {kind: prefix for prefix, kind in RECORD_KINDS.items()}
+    for session_id, requests in session_requests.items():
+        for kind, body in requests.items():
+            records.append(
+                {
+                    "recordId": f"{kind_prefixes[kind]}{len(manifest):010d}",
+                    "modelInput": body,
+                }
+            )
+        manifest.append(session_id)
+    return records, manifest
+
+
+def group_batch_outputs(output_records, manifest):
+    """Model outputs of a finished job, keyed by session id and request kind."""
+    model_outputs = {}
+    for record in output_records:
+        record_id = record.get("recordId", "")
+        model_output = record.get("modelOutput")
+        if model_output is None:
+            logger.info(f"batch inference record {record_id} failed: {record.get('error')}")
+            continue
+        try:
+            session_id = manifest[int(record_id[1:])]
+            kind = RECORD_KINDS[record_id[0]]
+        except (KeyError, IndexError, ValueError):
+            logger.info(f"unknown batch inference record id {record_id}")
+            continue
+        model_outputs.setdefault(session_id, {})[kind] = model_output
+    return model_outputs
+
+
+def read_jsonl(text):
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def to_jsonl(records):
+    return "".join(json.dumps(record) + "\n" for record in records)
+
+
+class BedrockBatchInference:
+    """Runs the records as a bedrock batch inference job, with input and output in s3."""
+
+    def __init__(self, s3_uri, role_arn, model_id, region_name):
+        parsed_uri = urlparse(s3_uri)
+        self.bucket = parsed_uri.netloc
+        self.prefix = parsed_uri.path.strip("/")
+        self.role_arn = role_arn
+        self.model_id = model_id
+        self.bedrock_client = boto3.client("bedrock", region_name=region_name)
+        self.s3_client = boto3.client("s3", region_name=region_name)
+
+    def key(self, job_name, file_name):
+        return "/".join(part for part in (self.prefix, job_name, file_name) if part)
+
+    def submit(self, job_name, records, manifest):
+        """Uploads the records and starts the job. Returns the job arn."""
+        self.s3_client.put_object(
+            Bucket=self.bucket,
+            Key=self.key(job_name, "input.jsonl"),
+            Body=to_jsonl(records).encode("utf-8"),
+        )
+        self.s3_client.put_object(
+            Bucket=self.bucket,
+            Key=self.key(job_name, "manifest.json"),
+            Body=json.dumps(manifest).encode("utf-8"),
+        )
+        response = self.bedrock_client.create_model_invocation_job(
+            jobName=job_name,
+            roleArn=self.role_arn,
+            modelId=self.model_id,
+            inputDataConfig={
+                "s3InputDataConfig": {
+                    "s3Uri": f"s3://{self.bucket}/{self.key(job_name, 'input.jsonl')}"
+                }
+            },
+            outputDataConfig={
+                "s3OutputDataConfig": {
+                    "s3Uri": f"s3://{self.bucket}/{self.key(job_name, 'output')}/"
+                }
+            },
+        )
+        return response["jobArn"]
+
+    def get_status(self, job_id):
+        response = self.bedrock_client.get_model_invocation_job(jobIdentifier=job_id)
+        return response["status"]
+
+    def get_outputs(self, job_name, job_id):
+        """Model outputs keyed by session id, read from the .jsonl.out files of the job."""
+        manifest = json.loads(
+            self.s3_client.get_object(
+                Bucket=self.bucket, Key=self.key(job_name, "manifest.json")
+            )["Body"].read()
+        )
+        output_records = []
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(
+            Bucket=self.bucket, Prefix=self.key(job_name, "output") + "/"
+        ):
+            for s3_object in page.get("Contents", []):
+                if not s3_object["Key"].endswith(".jsonl.out"):
+                    continue
+                body = self.s3_client.get_object(
+                    Bucket=self.bucket, Key=s3_object["Key"]
+                )["Body"].read()
+                output_records.extend(read_jsonl(body.decode("utf-8")))
+        return group_batch_outputs(output_records, manifest)
+
+
+def stub_model(model_input):
+    """Stand in for the model, returns no user details and a fixed summary."""
+    for tool in model_input.get("tools", []):
+        properties = tool["input_schema"]["properties"]
+        return {
+            "content": [
+                {
+                    "type": "tool_use",
+                    "name": tool["name"],
+                    "input": {key: None for key in properties},
+                }
+            ]
+        }
+    return {"content": [{"type": "text", "text": "Summary generated by the stub model."}]}
+
+
+class LocalBatchInference:
+    """Processes the records from a local JSONL file through a model callable, for testing."""
+
+    def __init__(self, directory, model=stub_model):
+        self.directory = directory
+        self.model = model
+
+    def path(self, job_name, file_name):
+        return os.path.join(self.directory, job_name, file_name)
+
+    def submit(self, job_name, records, manifest):
+        os.makedirs(os.path.join(self.directory, job_name), exist_ok=True)
+        with open(self.path(job_name, "input.jsonl"), "w") as f:
+            f.write(to_jsonl(records))
+        with open(self.path(job_name, "manifest.json"), "w") as f:
+            json.dump(manifest, f)
+
+        # same output layout as bedrock, one line per record with its input and output
+        output_records = []
+        with open(self.path(job_name, "input.jsonl")) as f:
+            for record in read_jsonl(f.read()):
+                try:
+                    record["modelOutput"] = self.model(record["modelInput"])
+                except Exception as e:
+                    record["error"] = str(e)
+                output_records.append(record)
+        with open(self.path(job_name, "input.jsonl.out"), "w") as f:
+            f.write(to_jsonl(output_records))
+        return job_name
+
+    def get_status(self, job_id):
+        if os.path.exists(self.path(job_id, "input.jsonl.out")):
+            return "Completed"
+        return "Failed"
+
+    def get_outputs(self, job_name, job_id):
+        with open(self.path(job_name, "manifest.json")) as f:
+            manifest = json.load(f)
+        with open(self.path(job_name, "input.jsonl.out")) as f:
+            return group_batch_outputs(read_jsonl(f.read()), manifest)
+
+
+def get_batch_inference(backend, model_id, region_name):
+    """
+    Batch inference backend set by the environment, None keeps the online calls.
+
+    Args:
+        backend (str): `bedrock`, `local` or None.
+        model_id (str): Bedrock model used by the batch inference job.
+        region_name (str): Region of bedrock and the s3 bucket.
+    """
+    try:
+        if backend == "bedrock":
+            return BedrockBatchInference(
+                os.environ["batch_inference_s3_uri"],
+                os.environ["batch_inference_role_arn"],
+                model_id,
+                region_name,
+            )
+        if backend == "local":
+            return LocalBatchInference(
+                os.environ.get("batch_inference_local_dir", "/tmp/batch_inference")
+            )
+        if backend:
+            logger.info(f"unknown batch inference backend {backend}")
+    except Exception as e:
+        logger.info(f"Exception {e} occured while creating batch inference backend")
+    return None
+
+
+def batch_inference_job_name(job_name):
+    # bedrock job names allow letters, numbers and hyphens
+    return re.sub(r"[^a-zA-Z0-9-]", "-", f"{job_name}-{int(time.time())}")
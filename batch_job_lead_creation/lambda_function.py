@@ -20,9 +20,343 @@ from simple_salesforce import (
 
 # importing functions
 from utils import *
+from batch_orchestrator import (
+    get_shard,
+    get_shard_invoker,
+    is_orchestrator_event,
+    run_shards,
+    shard_of,
+)
+from batch_inference import (
+    COMPLETED_STATUSES,
+    FAILED_STATUSES,
+    batch_inference_job_name,
+    build_batch_records,
+    get_batch_inference,
+)
 from logger_config import logger
 
 
+def read_session_inputs(session_items, job):
+    """Chat history, user inputs and previous lead creation attempts of a prefetched session."""
+    chat_history_item = session_items[job["chat_history_table"]]
+    chat_history = chat_history_item["history"] if chat_history_item else []
+    lead_item = session_items[job["leads_table"]]
+    previous_lead_creation_attempts = (
+        lead_item.get("lead_creation_attempts", 0) if lead_item else 0
+    )
+
+    # get user inputs from chat history
+    user_inputs = [
+        entry["content"][0]["text"] for entry in chat_history if entry["role"] == "user"
+    ]
+    return chat_history, user_inputs, previous_lead_creation_attempts
+
+
+def session_skip_reason(
+    session_id, session_items, user_inputs, previous_lead_creation_attempts, job
+):
+    """Outcome of a session that needs no model call, None when it should be processed."""
+    # Skip sessions whose transcript already had no mandatory details
+    lead_item = session_items[job["leads_table"]] or {}
+    if lead_item.get("missing_details_fingerprint") == transcript_fingerprint(
+        user_inputs, job["user_details_extraction_prompt"].version
+    ):
+        logger.info(f"transcript of session id {session_id} is unchanged, skipping")
+        return "unchanged_transcript"
+
+    # Skip bedrock calls when email or phone number can not be present
+    if not mandatory_details_possibly_present(user_inputs):
+        error_message = f"mandatory user deatils are not present to create lead for session id is {session_id}"
+        logger.info(error_message)
+        return "missing_details"
+
+    # Trying lead creation for only 4 times.
+    if previous_lead_creation_attempts >= 4:
+        return "attempts_exhausted"
+    return None
+
+
+def summary_conversation(chat_history):
+    """Conversation given to the summary prompt, without a trailing user message."""
+    if len(chat_history) % 2 != 0:
+        chat_history = chat_history[:-1]
+        logger.info(f"odd number of chat history elemnts")
+    return format_conversation_history(chat_history)
+
+
+def submit_batch_inference(
+    prefetched_sessions,
+    job,
+    batch_inference,
+    min_records,
+    job_name,
+    max_records=50000,
+    stop_at=None,
+    page_start_keys=None,
+):
+    """
+    Writes the extraction and summary requests of the pending sessions to one batch
+    inference job, so a later run only has to ingest the outputs. Reading stops at
+    max_records requests or at stop_at, the rest of the backlog goes to a later job.
+
+    Returns:
+        tuple: State of the submitted job with the cursor of the first session left
+        out, or None with the read sessions when there are too few requests for a
+        batch job and they are processed online instead.
+    """
+    read_sessions = []
+    read_session_ids = set()
+    session_requests = {}
+    backlog_read = True
+    summary_prompt = get_prompt("summary_instructions.txt")
+    for session_id, session_items in prefetched_sessions:
+        read_session_ids.add(session_id)
+        # the read sessions are only processed online when the job stays too small
+        if read_sessions is not None:
+            read_sessions.append((session_id, session_items))
+        try:
+            chat_history, user_inputs, previous_attempts = read_session_inputs(
+                session_items, job
+            )
+            if session_skip_reason(
+                session_id, session_items, user_inputs, previous_attempts, job
+            ):
+                continue
+            session_requests[session_id] = {
+                "extraction": build_extraction_request(
+                    user_inputs,
+                    job["user_details_extraction_prompt"],
+                    job["extraction_mode"],
+                ),
+                "summary": build_summary_request(
+                    summary_conversation(chat_history), summary_prompt, session_id
+                ),
+            }
+        except Exception as e:
+            logger.info(f"Error preparing batch requests of session ID {session_id}: {e}")
+        if read_sessions is not None and 2 * len(session_requests) >= min_records:
+            read_sessions = None
+        if 2 * len(session_requests) + 2 > max_records or (
+            stop_at is not None and time.time() > stop_at
+        ):
+            backlog_read = False
+            break
+
+    records, manifest = build_batch_records(session_requests)
+    if len(records) < min_records:
+        logger.info(
+            f"{len(records)} batch inference records are below {min_records}, using online calls"
+        )
+        return None, read_sessions
+
+    # the next job starts at the page of the first read ahead session left out
+    cursor = None
+    for session_id, start_key in (page_start_keys or {}).items():
+        cursor = start_key
+        if session_id not in read_session_ids:
+            break
+
+    job_name = batch_inference_job_name(job_name)
+    job_id = batch_inference.submit(job_name, records, manifest)
+    logger.info(
+        f"submitted batch inference job {job_id} with {len(records)} records of {len(manifest)} sessions, backlog read is {backlog_read}"
+    )
+    inference_state = {
+        "batch_job_name": job_name,
+        "batch_job_id": job_id,
+        "backlog_read": backlog_read,
+        "cursor": cursor,
+    }
+    return inference_state, read_sessions
+
+
+def process_session(session_id, session_items, job) -> str:
+    """
+    Creates the lead of one session. Errors are contained to the session.
+
+    Args:
+        session_id (str): Session id waiting for a lead.
+        session_items (Dict): Prefetched chat history and leads table rows of the session.
+        job (Dict): Settings, clients and rate limiters shared by all sessions.
+
+    Returns:
+        str: Outcome of the session, counted in the job results.
+    """
+    logger.info(f"session_id is {session_id}")
+    try:
+        dynamodb_client = job["dynamodb_client"] or get_worker_dynamodb_client(
+            job["dynamodb_region_name"]
+        )
+        leads_table = job["leads_table"]
+
+        # outputs of a finished batch inference job replace the bedrock calls
+        model_outputs = job.get("model_outputs")
+        if model_outputs is not None and session_id not in model_outputs:
+            return "awaiting_batch_inference"
+
+        # chat history and previous lead creation attempts are prefetched in batches
+        chat_history, user_inputs, previous_lead_creation_attempts = read_session_inputs(
+            session_items, job
+        )
+        logger.info(f"user_inputs is {user_inputs}")
+
+        skip_reason = session_skip_reason(
+            session_id, session_items, user_inputs, previous_lead_creation_attempts, job
+        )
+        if skip_reason:
+            return skip_reason
+
+        # extracting user details
+        if model_outputs is not None:
+            extraction_output = model_outputs[session_id].get("extraction")
+            user_details_dict = (
+                parse_extraction_response(extraction_output, job["extraction_mode"])
+                if extraction_output
+                else None
+            )
+        else:
+            job["bedrock_limiter"].acquire()
+            user_details_dict = extract_user_details_dict(
+                user_inputs,
+                job["user_details_extraction_prompt"],
+                job["model_id"],
+                job["bedrock_runtime"],
+                job["extraction_mode"],
+            )
+
+        if user_details_dict is None:
+            error_message = f"Unable to extract user details for session ID {session_id}"
+            logger.info(error_message)
+            return "extraction_failed"
+
+        # validating user details
+        user_details_dict = validate_user_info(user_details_dict)
+        logger.info(f"user_details_dict is {user_details_dict}")
+
+        # crosschecking if email, phone number and first name is present or not.
+        if not (
+            (user_details_dict["FirstName"] or user_details_dict["LastName"])
+            and (user_details_dict["Email"])
+            and (user_details_dict["Phone"])
+        ):
+            error_message = f"mandatory user deatils are not present to create lead for session id is {session_id}"
+            logger.info(error_message)
+            job["dynamodb_limiter"].acquire()
+            record_missing_details_fingerprint(
+                dynamodb_client,
+                leads_table,
+                session_id,
+                transcript_fingerprint(
+                    user_inputs, job["user_details_extraction_prompt"].version
+                ),
+            )
+            return "missing_details"
+
+        if not user_details_dict["LastName"]:
+            user_details_dict["LastName"] = user_details_dict["FirstName"]
+            user_details_dict["FirstName"] = None
+
+        try:
+            lead_creation_attempts = 0
+            lead_creation_message = "None"
+            summary = "None"
+            summary_output = (
+                model_outputs[session_id].get("summary")
+                if model_outputs is not None
+                else None
+            )
+            if summary_output is not None:
+                summary = parse_summary_response(summary_output)
+            else:
+                # loading summary prompt
+                summary_extraction_prompt = get_prompt("summary_instructions.txt")
+                conversation_history_list = summary_conversation(chat_history)
+                job["bedrock_limiter"].acquire()
+                summary = generate_conversation_summary(
+                    conversation_history_list,
+                    job["bedrock_runtime"],
+                    job["model_id"],
+                    summary_extraction_prompt,
+                    session_id,
+                )
+
+            # new leads are created together in collections requests, known leads and
+            # external id upserts still go one session at a time
+            lead_writer = job["lead_writer"]
+            if (
+                lead_writer is not None
+                and not job["lead_external_id_field"]
+                and lookup_lead_in_dedup_index(
+                    user_details_dict, dynamodb_client, job["lead_dedup_table"]
+                )
+                is None
+            ):
+                lead_writer.add(
+                    {
+                        "session_id": session_id,
+                        "user_details": user_details_dict,
+                        "summary": summary,
+                        "user_inputs": user_inputs,
+                        "previous_lead_creation_attempts": previous_lead_creation_attempts,
+                    },
+                    dynamodb_client,
+                )
+                return "queued"
+
+            job["salesforce_limiter"].acquire()
+            (
+                lead_id,
+                lead_creation_message,
+                lead_creation_attempts,
+            ) = lead_creation(
+                user_details_dict,
+                job["salesforce_object"],
+                summary,
+                dynamodb_client,
+                leads_table,
+                job["lead_dedup_table"],
+                job["lead_external_id_field"],
+                job["deadline"],
+                session_id,
+            )
+            lead_creation_attempts = (
+                lead_creation_attempts + previous_lead_creation_attempts
+            )
+        except Exception as e:
+            logger.info(f"Exception {e} occured while creating the lead")
+            lead_creation_message = f"Exception {e} occured while creating the lead"
+            lead_id = None
+            lead_creation_attempts = previous_lead_creation_attempts + 1
+
+        if lead_id is None:
+            lead_id = "None"
+            lead_creation_status = False
+        else:
+            lead_creation_status = True
+        logger.info(
+            f"lead creation status for lead id {lead_id} is {lead_creation_message}"
+        )
+        user_details_dict.pop("Description", None)
+        job["dynamodb_limiter"].acquire()
+        update_leads_table(
+            dynamodb_client,
+            leads_table,
+            session_id,
+            user_details_dict,
+            summary,
+            user_inputs,
+            lead_creation_attempts,
+            lead_id,
+            lead_creation_status,
+            lead_creation_message,
+        )
+        return "created" if lead_creation_status else "lead_not_created"
+    except Exception as e:
+        logger.info(f"Error processing session ID {session_id}: {e}")
+        return "error"
+
+
 def lambda_handler(event, context) -> dict:
     """
     AWS Lambda handler to handle user queries for Y-axis.
@@ -35,6 +369,24 @@ def lambda_handler(event, context) -> dict:
         dict: Dictionary containing the status code and result message.
     """
     try:
+        # fan the sessions out to parallel shard invocations when sharding is enabled
+        batch_shard_count = int(os.environ.get("batch_shard_count", "1"))
+        if is_orchestrator_event(event, batch_shard_count):
+            # shards answer before this run times out, unfinished ones count as incomplete
+            shard_stats = run_shards(
+                get_shard_invoker(os.environ.get("shard_invoker", "lambda"), context),
+                event,
+                batch_shard_count,
+                get_deadline(context, int(os.environ.get("shard_margin_seconds", "30"))),
+            )
+            return {"statusCode": 200, "body": json.dumps(shard_stats)}
+
+        # every shard keeps its own checkpoint and works on its own sessions
+        shard, shard_count = get_shard(event)
+        job_name = "batch_job_lead_creation"
+        if shard_count > 1:
+            job_name = f"{job_name}-shard-{shard}"
+
         # Extract Salesforce details from Secrets Manager
         secret_name = os.environ["secret_name"]
         secret_region_name = os.environ["secret_region_name"]
@@ -58,6 +410,12 @@ def lambda_handler(event, context) -> dict:
         model_id = os.environ["model_id"]
         chat_history_table = os.environ["chat_history_table"]
         leads_table = os.environ["leads_table_name"]
+        lead_dedup_table = os.environ.get("lead_dedup_table_name")
+        lead_external_id_field = os.environ.get("lead_external_id_field")
+        lead_outbox_table = os.environ.get("lead_outbox_table_name")
+
+        # time left in this invocation, salesforce retries stop before it
+        deadline = get_deadline(context, event=event)
 
         # Extract region names
         bedrock_region_name = os.environ["bedrock_region_name"]
@@ -67,6 +425,9 @@ def lambda_handler(event, context) -> dict:
         guardrail_id = os.environ["guardrail_id"]
         guardrail_version = os.environ["guardrail_version"]
 
+        # Extraction mode, json uses tool output and text uses comma separated output
+        extraction_mode = os.environ.get("extraction_mode", "json")
+
         # Getting Bedrock client
         bedrock_runtime = get_bedrock_client(bedrock_region_name)
         if bedrock_runtime is None:
@@ -81,11 +442,27 @@ def lambda_handler(event, context) -> dict:
             logger.info(error_message)
             return {"statusCode": 500, "body": json.dumps({"message": error_message})}
 
-        # session ids with no lead ids in leads table
-        extracted_session_ids = session_ids_with_no_lead_id(
-            dynamodb_client, leads_table
+        # resume state of an earlier run that stopped before its deadline
+        checkpoint = BatchCheckpoint(
+            dynamodb_client,
+            os.environ.get("batch_checkpoint_table_name"),
+            job_name,
+        )
+
+        # session ids waiting for a lead, read from the pending lead index while sessions
+        # are processed. Without the index the leads table is scanned in segments.
+        scan_total_segments = int(os.environ.get("scan_total_segments", "4"))
+        page_start_keys = {}
+        extracted_session_ids = checkpoint.unprocessed(
+            pending_session_ids(
+                dynamodb_client,
+                leads_table,
+                scan_total_segments,
+                checkpoint.cursor,
+                page_start_keys,
+                lambda session_id: shard_of(session_id, shard_count) == shard,
+            )
         )
-        logger.info(f"extracted_session_ids is {extracted_session_ids}")
 
         # Get Salesforce object
         salesforce_object = get_salesforce_object(
@@ -99,156 +476,247 @@ def lambda_handler(event, context) -> dict:
                 "body": json.dumps({"message": error_message}),
             }
 
-        # iterate through each session ids
-        for session_id in extracted_session_ids:
-            logger.info(f"session_id is {session_id}")
+        # Send lead writes queued by lead creation lambda to salesforce
+        if lead_outbox_table and shard == 0:
+            outbox_stats = drain_lead_outbox(
+                dynamodb_client,
+                lead_outbox_table,
+                leads_table,
+                salesforce_object,
+                lead_dedup_table,
+                deadline,
+            )
+            logger.info(f"outbox_stats is {outbox_stats}")
+
+        # Load user details extraction prompt, once for all sessions
+        try:
+            user_details_extraction_prompt = get_prompt(
+                EXTRACTION_PROMPT_FILES[extraction_mode]
+            )
+        except Exception as e:
+            error_message = f"Error reading extraction instructions: {e}"
+            logger.info(error_message)
+            return {
+                "statusCode": 500,
+                "body": json.dumps({"message": error_message}),
+            }
+
+        # shared settings of the session workers
+        session_worker_concurrency = int(
+            os.environ.get("session_worker_concurrency", "1")
+        )
+        salesforce_limiter = RateLimiter(
+            float(os.environ.get("salesforce_calls_per_second", "0"))
+        )
+        # leads per sObject Collections request, 0 creates every lead on its own
+        lead_collection_size = min(
+            200, int(os.environ.get("lead_collection_size", "200"))
+        )
+        lead_writer = (
+            LeadCollectionWriter(
+                salesforce_object,
+                leads_table,
+                lead_dedup_table,
+                deadline,
+                lead_collection_size,
+                salesforce_limiter,
+            )
+            if lead_collection_size > 0
+            else None
+        )
+        job = {
+            "model_id": model_id,
+            "chat_history_table": chat_history_table,
+            "leads_table": leads_table,
+            "lead_dedup_table": lead_dedup_table,
+            "lead_external_id_field": lead_external_id_field,
+            "deadline": deadline,
+            "extraction_mode": extraction_mode,
+            "user_details_extraction_prompt": user_details_extraction_prompt,
+            "bedrock_runtime": bedrock_runtime,
+            "salesforce_object": salesforce_object,
+            # workers share the bedrock and salesforce clients, dynamodb resources are per thread
+            "dynamodb_client": dynamodb_client
+            if session_worker_concurrency <= 1
+            else None,
+            "dynamodb_region_name": dynamodb_region_name,
+            "bedrock_limiter": RateLimiter(
+                float(os.environ.get("bedrock_calls_per_second", "0"))
+            ),
+            "salesforce_limiter": salesforce_limiter,
+            "lead_writer": lead_writer,
+            "dynamodb_limiter": RateLimiter(
+                float(os.environ.get("dynamodb_calls_per_second", "0"))
+            ),
+        }
+
+        # prefetch chat histories and lead rows of up to 100 sessions per request
+        session_attributes = {
+            chat_history_table: [
+                "session_id",
+                "history",
+                "updated_at",
+                "user_turn_count",
+            ],
+            leads_table: [
+                "session_id",
+                "lead_creation_attempts",
+                "missing_details_fingerprint",
+            ],
+        }
+        unfetched_session_ids = set()
+        prefetched_sessions = prefetch_session_items(
+            dynamodb_client,
+            extracted_session_ids,
+            session_attributes,
+            unfetched_session_ids=unfetched_session_ids,
+        )
 
-            # get chat history
-            chat_history = get_session_history(
-                session_id, chat_history_table, dynamodb_client
+        # most likely leads first, fresh chats with many user turns and attempts left,
+        # ordered within a window of read ahead sessions
+        if os.environ.get("session_priority", "true").lower() == "true":
+            priority_weights = os.environ.get("session_priority_weights")
+            prefetched_sessions = prioritized_sessions(
+                prefetched_sessions,
+                chat_history_table,
+                leads_table,
+                make_session_priority_score(
+                    json.loads(priority_weights) if priority_weights else None
+                ),
+                int(os.environ.get("session_priority_window", "500")),
             )
 
-            # get user inputs from chat history
-            user_inputs = [
-                entry["content"][0]["text"]
-                for entry in chat_history
-                if entry["role"] == "user"
-            ]
-            logger.info(f"user_inputs is {user_inputs}")
-
-            try:
-                # Get previous lead creation attempts
-                previous_lead_creation_attempts = retrieve_previous_user_info(
-                    dynamodb_client, leads_table, session_id
+        # stop taking new sessions early enough for running ones to finish
+        stop_at = get_deadline(
+            context, int(os.environ.get("batch_stop_seconds", "60")), event
+        )
+
+        # offline mode, the model requests of all sessions go to one batch inference job
+        # and a later run creates the leads from its outputs
+        checkpoint_table = os.environ.get("batch_checkpoint_table_name")
+        batch_inference = get_batch_inference(
+            os.environ.get("batch_inference_backend"), model_id, bedrock_region_name
+        )
+        if batch_inference is not None and not checkpoint_table:
+            logger.info("batch inference needs the checkpoint table, using online calls")
+            batch_inference = None
+        inference_state = None
+        if batch_inference is not None:
+            inference_state = get_batch_inference_state(
+                dynamodb_client, checkpoint_table, job_name
+            )
+        if inference_state is not None:
+            status = batch_inference.get_status(inference_state["batch_job_id"])
+            logger.info(f"batch inference job {inference_state['batch_job_id']} is {status}")
+            if status in COMPLETED_STATUSES:
+                job["model_outputs"] = batch_inference.get_outputs(
+                    inference_state["batch_job_name"], inference_state["batch_job_id"]
+                )
+                # only the sessions of the job are processed, the backlog is read again
+                # from the cursor of the job when the next job is submitted
+                prefetched_sessions = prefetch_session_items(
+                    dynamodb_client,
+                    checkpoint.unprocessed(job["model_outputs"]),
+                    session_attributes,
+                    unfetched_session_ids=unfetched_session_ids,
+                )
+            elif status in FAILED_STATUSES:
+                # sessions of the failed job are submitted again by the next run
+                clear_batch_inference_state(
+                    dynamodb_client, checkpoint_table, job_name
+                )
+                return {
+                    "statusCode": 500,
+                    "body": json.dumps(
+                        {"message": f"batch inference job {status}", "completed": False}
+                    ),
+                }
+            else:
+                return {
+                    "statusCode": 200,
+                    "body": json.dumps(
+                        {"message": f"batch inference job is {status}", "completed": False}
+                    ),
+                }
+        elif batch_inference is not None:
+            inference_state, prefetched_sessions = submit_batch_inference(
+                prefetched_sessions,
+                job,
+                batch_inference,
+                int(os.environ.get("batch_inference_min_records", "100")),
+                job_name,
+                int(os.environ.get("batch_inference_max_records", "50000")),
+                stop_at,
+                page_start_keys,
+            )
+            if inference_state is not None:
+                save_batch_inference_state(
+                    dynamodb_client,
+                    checkpoint_table,
+                    job_name,
+                    inference_state,
                 )
+                return {
+                    "statusCode": 200,
+                    "body": json.dumps(
+                        {
+                            "message": "submitted batch inference job",
+                            "batch_job_id": inference_state["batch_job_id"],
+                            "completed": False,
+                        }
+                    ),
+                }
+
+        def process_prefetched_session(prefetched_session):
+            result = process_session(*prefetched_session, job)
+            checkpoint.mark_processed(prefetched_session[0])
+            return result
+
+        # process sessions, one at a time or with a bounded worker pool
+        session_results, stopped = run_session_workers(
+            prefetched_sessions,
+            process_prefetched_session,
+            session_worker_concurrency,
+            lambda: stop_at is not None and time.time() > stop_at,
+        )
+
+        # create the leads still waiting for a full collections request
+        if lead_writer is not None:
+            lead_writer.flush(dynamodb_client)
+            session_results.pop("queued", None)
+            for result, count in lead_writer.results.items():
+                session_results[result] = session_results.get(result, 0) + count
+        # sessions dynamodb did not return are not processed, the next run retries them
+        if unfetched_session_ids:
+            session_results["unfetched"] = len(unfetched_session_ids)
+            stopped = True
+        logger.info(f"session_results is {session_results}, stopped is {stopped}")
 
-                # Load user details extraction prompt
-                try:
-                    with open("prompts/extraction_instructions.txt") as f:
-                        user_details_extraction_prompt = f.read()
-                except Exception as e:
-                    error_message = f"Error reading extraction instructions: {e}"
-                    logger.info(error_message)
-                    return {
-                        "statusCode": 500,
-                        "body": json.dumps({"message": error_message}),
-                    }
-
-                # Trying lead creation for only 4 times.
-                if previous_lead_creation_attempts < 4:
-                    # extracting user details
-                    user_details = extract_user_details(
-                        user_inputs,
-                        user_details_extraction_prompt,
-                        model_id,
-                        bedrock_runtime,
-                    )
-
-                    if user_details is None:
-                        error_message = f"Unable to extract user details for session ID {session_id}"
-                        logger.info(error_message)
-                        continue  # Skip to the next session ID if user details extraction fails
-
-                    # parsing user details
-                    user_details_dict = parse_user_details(user_details)
-                    user_details_dict = validate_user_info(user_details_dict)
-                    logger.info(f"user_details_dict is {user_details_dict}")
-
-                    # crosschecking if email, phone number and first name is present or not.
-                    if (
-                        (
-                            user_details_dict["FirstName"]
-                            or user_details_dict["LastName"]
-                        )
-                        and (user_details_dict["Email"])
-                        and (user_details_dict["Phone"])
-                    ):
-                        if not user_details_dict["LastName"]:
-                            user_details_dict["LastName"] = user_details_dict[
-                                "FirstName"
-                            ]
-                            user_details_dict["FirstName"] = None
-
-                        try:
-                            lead_creation_attempts = 0
-                            lead_creation_message = "None"
-                            # loading summary prompt
-                            with open("prompts/summary_instructions.txt") as f:
-                                summary_extraction_prompt = f.read()
-
-                            if len(chat_history) % 2 != 0:
-                                chat_history = chat_history[:-1]
-                                logger.info(f"odd number of chat history elemnts")
-
-                            conversation_history_list = format_conversation_history(
-                                chat_history
-                            )
-                            summary = generate_conversation_summary(
-                                conversation_history_list,
-                                bedrock_runtime,
-                                model_id,
-                                summary_extraction_prompt,
-                                session_id
-                            )
-
-                            (
-                                lead_id,
-                                lead_creation_message,
-                                lead_creation_attempts,
-                            ) = lead_creation(
-                                user_details_dict,
-                                salesforce_object,
-                                summary,
-                                dynamodb_client,
-                                leads_table,
-                            )
-                            lead_creation_attempts = (
-                                lead_creation_attempts + previous_lead_creation_attempts
-                            )
-                        except Exception as e:
-                            logger.info(
-                                f"Exception {e} occured while creating the lead"
-                            )
-                            lead_creation_message = (
-                                f"Exception {e} occured while creating the lead"
-                            )
-                            lead_id = None
-                            try:
-                                lead_creation_attempts = (
-                                    previous_lead_creation_attempts + 1
-                                )
-                            except Exception as e:
-                                lead_creation_attempts = 1
-
-                        if lead_id is None:
-                            lead_id = "None"
-                            lead_creation_status = False
-                        else:
-                            lead_creation_status = True
-                        logger.info(
-                            f"lead creation status for lead id {lead_id} is {lead_creation_message}"
-                        )
-                        user_details_dict.pop("Description", None)
-                        update_leads_table(
-                            dynamodb_client,
-                            leads_table,
-                            session_id,
-                            user_details_dict,
-                            summary,
-                            user_inputs,
-                            lead_creation_attempts,
-                            lead_id,
-                            lead_creation_status,
-                            lead_creation_message,
-                        )
-                    else:
-                        error_message = f"mandatory user deatils are not present to create lead for session id is {session_id}"
-                        logger.info(error_message)
-            except Exception as e:
-                logger.info(f"Error processing session ID {session_id}: {e}")
+        # save where to continue and start the next run, or forget a finished run
+        if stopped:
+            # a run without a saved checkpoint would start over, leave it to the schedule
+            if checkpoint.save(checkpoint.resume_cursor(page_start_keys), page_start_keys):
+                reinvoke_batch_job(
+                    context, event, int(os.environ.get("batch_max_reinvokes", "0"))
+                )
+        elif "model_outputs" in job:
+            clear_batch_inference_state(dynamodb_client, checkpoint_table, job_name)
+            # the next job continues after the sessions of this one
+            if inference_state.get("backlog_read", True):
+                checkpoint.clear()
+            else:
+                checkpoint.save(inference_state.get("cursor"))
+        else:
+            checkpoint.clear()
         return {
             "statusCode": 200,
-            "body": json.dumps({"message": "successfully created lead ids"}),
+            "body": json.dumps(
+                {
+                    "message": "successfully created lead ids",
+                    "results": session_results,
+                    "completed": not stopped,
+                }
+            ),
         }
     except Exception as e:
         error_message = f"Error during creating lead: {e}"
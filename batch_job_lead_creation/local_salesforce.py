@@ -0,0 +1,292 @@
+import json
+import os
+import re
+import sys
+import time
+import uuid
+from urllib.parse import unquote
+
+import boto3
+from simple_salesforce import SalesforceMalformedRequest, SalesforceResourceNotFound
+
+from logger_config import logger
+
+# duplicate rule messages of the org, matched by resolve_duplicate_lead
+DUPLICATE_ERRORS = {
+    "Email": "Email already exists in our database",
+    "Phone": "Mobile phone number already exists in our database.",
+}
+
+# rejected records, for exercising the failure path of the lead writes
+REJECTED_EMAIL_PATTERN = re.compile(r"^reject", re.IGNORECASE)
+
+
+class LocalSObject:
+    def __init__(self, salesforce):
+        self.salesforce = salesforce
+
+    def create(self, record):
+        result = self.salesforce.create_record(record)
+        if not result["success"]:
+            raise SalesforceMalformedRequest(
+                "local/Lead", 400, "Lead", result["errors"]
+            )
+        return {"id": result["id"], "success": True, "errors": []}
+
+    def update(self, lead_id, record):
+        self.salesforce.calls.append(("update", lead_id))
+        if lead_id not in self.salesforce.leads:
+            raise SalesforceResourceNotFound(
+                f"local/Lead/{lead_id}", 404, "Lead", [{"errorCode": "NOT_FOUND"}]
+            )
+        self.salesforce.leads[lead_id].update(record)
+        return 204
+
+    def upsert(self, record_path, record, **kwargs):
+        """Upsert by external id, answers like the raw response of simple_salesforce."""
+        field, value = record_path.split("/", 1)
+        value = unquote(value)
+        self.salesforce.calls.append(("upsert", value))
+        for lead_id, lead in self.salesforce.leads.items():
+            if lead.get(field) == value:
+                self.salesforce.leads[lead_id].update(record)
+                return LocalResponse(200, {"id": lead_id, "success": True, "created": False})
+        result = self.create(dict(record, **{field: value}))
+        return LocalResponse(201, {"id": result["id"], "success": True, "created": True})
+
+
+class LocalResponse:
+    """Status code and JSON body of a stand in response, like requests.Response."""
+
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.body = body
+        self.content = json.dumps(body).encode("utf-8") if body is not None else b""
+
+    def json(self):
+        return self.body
+
+
+class LocalSalesforce:
+    """
+    In memory stand in for the simple_salesforce client, for local runs and checks.
+
+    Supports the calls of the lead writes: Lead create, update and upsert, lead queries
+    by one field and sObject Collections creates. Email and phone duplicates are rejected
+    with the org's duplicate rule messages, and emails starting with `reject` are
+    rejected with a validation error.
+    """
+
+    def __init__(self):
+        self.leads = {}
+        self.calls = []
+        self.Lead = LocalSObject(self)
+
+    def create_record(self, record):
+        self.calls.append(("create", record.get("Email")))
+        if REJECTED_EMAIL_PATTERN.match(record.get("Email") or ""):
+            errors = [
+                {
+                    "statusCode": "FIELD_CUSTOM_VALIDATION_EXCEPTION",
+                    "message": "Lead rejected by the local salesforce",
+                }
+            ]
+            return {"id": None, "success": False, "errors": errors}
+        for field, message in DUPLICATE_ERRORS.items():
+            value = record.get(field)
+            if value and any(lead.get(field) == value for lead in self.leads.values()):
+                errors = [{"statusCode": "DUPLICATES_DETECTED", "message": message}]
+                return {"id": None, "success": False, "errors": errors}
+        lead_id = "00Q" + uuid.uuid4().hex[:15].upper()
+        self.leads[lead_id] = dict(record, Id=lead_id)
+        return {"id": lead_id, "success": True, "errors": []}
+
+    def query(self, query):
+        self.calls.append(("query", query))
+        match = re.search(r"WHERE (\w+) = '([^']*)'", query)
+        records = [
+            {"Name": None, "Description": None, **lead}
+            for lead in self.leads.values()
+            if match and lead.get(match.group(1)) == match.group(2)
+        ][:1]
+        return {"totalSize": len(records), "done": True, "records": records}
+
+    def restful(self, path, method="GET", data=None, **kwargs):
+        if path != "composite/sobjects" or method != "POST":
+            raise SalesforceResourceNotFound(
+                f"local/{path}", 404, path, [{"errorCode": "NOT_FOUND"}]
+            )
+        records = json.loads(data)["records"]
+        return [
+            self.create_record(
+                {key: value for key, value in record.items() if key != "attributes"}
+            )
+            for record in records
+        ]
+
+
+def create_check_table(dynamodb_client, table_name, key_name):
+    table = dynamodb_client.create_table(
+        TableName=table_name,
+        KeySchema=[{"AttributeName": key_name, "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": key_name, "AttributeType": "S"}],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    table.wait_until_exists()
+    return table
+
+
+def check_lead_outbox(dynamodb_client, salesforce_object=None):
+    """
+    Runs enqueue, drain, complete and fail of the lead outbox against local stand ins.
+
+    Creates throwaway leads, outbox and dedup tables, queues two writes of the same
+    lead and one write salesforce rejects, drains the outbox, writes one lead twice
+    by external id and deletes the tables.
+
+    Args:
+        dynamodb_client: DynamoDB resource, for example of DynamoDB Local.
+        salesforce_object: Salesforce client, a LocalSalesforce by default.
+
+    Returns:
+        List: Failed checks, empty when the outbox works.
+    """
+    from utils import (
+        PENDING_STATUS,
+        create_lead_id_index,
+        create_outbox_pending_index,
+        drain_lead_outbox,
+        enqueue_lead_write,
+        get_pending_lead_writes,
+        upsert_lead,
+    )
+
+    salesforce_object = salesforce_object or LocalSalesforce()
+    prefix = f"outbox-check-{int(time.time())}"
+    leads_table = f"{prefix}-leads"
+    outbox_table = f"{prefix}-outbox"
+    dedup_table = f"{prefix}-dedup"
+    lead_writes = {
+        "first-session": "jane@example.com",
+        "second-session": "jane@example.com",
+        "rejected-session": "reject@example.com",
+    }
+    failed_checks = []
+
+    def check(name, passed):
+        logger.info(f"outbox check {name}: {'passed' if passed else 'failed'}")
+        if not passed:
+            failed_checks.append(name)
+
+    try:
+        leads = create_check_table(dynamodb_client, leads_table, "session_id")
+        outbox = create_check_table(dynamodb_client, outbox_table, "outbox_id")
+        create_check_table(dynamodb_client, dedup_table, "dedup_key")
+        create_lead_id_index(dynamodb_client, leads_table)
+        create_outbox_pending_index(dynamodb_client, outbox_table)
+
+        for session_id, email in lead_writes.items():
+            leads.put_item(Item={"session_id": session_id, "outbox_pending": True})
+            user_details_dict = {
+                "FirstName": "Jane",
+                "LastName": "Doe",
+                "Email": email,
+                "Phone": None,
+            }
+            check(
+                f"enqueue {session_id}",
+                enqueue_lead_write(
+                    session_id,
+                    user_details_dict,
+                    f"Summary of {session_id}.",
+                    outbox_table,
+                    dynamodb_client,
+                ),
+            )
+        check(
+            "pending writes",
+            len(get_pending_lead_writes(dynamodb_client, outbox_table))
+            == len(lead_writes),
+        )
+
+        outbox_stats = drain_lead_outbox(
+            dynamodb_client,
+            outbox_table,
+            leads_table,
+            salesforce_object,
+            dedup_table,
+            max_attempts=1,
+        )
+        check("drain stats", outbox_stats == {"sent": 2, "failed": 1, "pending": 0})
+
+        lead_ids = {
+            session_id: leads.get_item(Key={"session_id": session_id})["Item"].get(
+                "lead_id"
+            )
+            for session_id in lead_writes
+        }
+        check(
+            "one lead for both writes",
+            lead_ids["first-session"] is not None
+            and lead_ids["first-session"] == lead_ids["second-session"],
+        )
+        rejected_lead = leads.get_item(Key={"session_id": "rejected-session"})["Item"]
+        check(
+            "rejected write back in the pending lead index",
+            rejected_lead.get("pending_status") == PENDING_STATUS
+            and "outbox_pending" not in rejected_lead,
+        )
+        remaining_writes = outbox.scan()["Items"]
+        check(
+            "only the rejected write is left in the outbox",
+            [item["outbox_id"] for item in remaining_writes] == ["rejected-session"]
+            and "pending_status" not in remaining_writes[0],
+        )
+        check(
+            "no pending writes",
+            get_pending_lead_writes(dynamodb_client, outbox_table) == [],
+        )
+
+        # lead creation with lead_external_id_field, created first and updated after
+        upsert_results = [
+            upsert_lead(
+                {"FirstName": "John", "LastName": "Roe", "Email": "John@Example.com"},
+                salesforce_object,
+                f"Summary of upsert session {number}.",
+                "Email_External_Id__c",
+                dynamodb_client,
+                leads_table,
+                session_id=f"upsert-session-{number}",
+            )
+            for number in range(2)
+        ]
+        check(
+            "upsert creates the lead",
+            upsert_results[0][0] is not None
+            and upsert_results[0][1] == "successfully created",
+        )
+        check(
+            "upsert updates the same lead",
+            upsert_results[1][0] == upsert_results[0][0]
+            and "Updated the lead with upsert" in (upsert_results[1][1] or ""),
+        )
+    except Exception as e:
+        logger.info(f"Exception {e} occured while checking the lead outbox")
+        failed_checks.append(str(e))
+    finally:
+        for table_name in (leads_table, outbox_table, dedup_table):
+            try:
+                dynamodb_client.Table(table_name).delete()
+            except Exception as e:
+                logger.info(f"Exception {e} occured while deleting {table_name}")
+    return failed_checks
+
+
+if __name__ == "__main__":
+    # python local_salesforce.py, with dynamodb_endpoint_url set to DynamoDB Local
+    dynamodb_client = boto3.resource(
+        "dynamodb",
+        region_name=os.environ.get("dynamodb_region_name", "us-east-1"),
+        endpoint_url=os.environ.get("dynamodb_endpoint_url", "http://localhost:8000"),
+    )
+    sys.exit(1 if check_lead_outbox(dynamodb_client) else 0)
@@ -1,25 +1,39 @@
 # basic packages
 import boto3
+from botocore.exceptions import ClientError
+from boto3.dynamodb.conditions import Key
 from typing import Dict
 import random, time, os
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from random import randint
 import json
 from dotenv import load_dotenv
 from io import StringIO
 from typing import Dict, Any, Optional
 import configparser
+import itertools
+import uuid
+import heapq
+import hashlib
 import re
+from decimal import Decimal
+from urllib.parse import quote
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import queue
+import threading
 
 # salesforce packages
 from simple_salesforce import (
     Salesforce,
+    SalesforceError,
     SalesforceMalformedRequest,
     SalesforceResourceNotFound,
 )
+import requests
 
 # logging
 from logger_config import logger
+from prompt_registry import get_prompt, get_prompt_versions
 
 from validate_user_details import ValidateUserDetails
 
@@ -45,21 +59,455 @@ def get_secret(secret_name, region_name):
         return None
 
 
-def session_ids_with_no_lead_id(dynamodb_client, leads_table):
+# Scan a table in parallel segments. Every segment follows LastEvaluatedKey with the
+# client of the dynamodb resource, which is safe to share between threads and converts
+# dynamodb types like the resource does. Items are yielded as pages arrive.
+def parallel_scan(dynamodb_client, table_name, total_segments=4, **scan_kwargs):
+    client = dynamodb_client.meta.client
+    page_queue = queue.Queue()
+    segment_done = object()
+
+    def scan_segment(segment):
+        try:
+            paginator = client.get_paginator("scan")
+            for page in paginator.paginate(
+                TableName=table_name,
+                Segment=segment,
+                TotalSegments=total_segments,
+                **scan_kwargs,
+            ):
+                page_queue.put(page["Items"])
+        except Exception as e:
+            page_queue.put(e)
+        finally:
+            page_queue.put(segment_done)
+
+    executor = ThreadPoolExecutor(max_workers=total_segments)
     try:
-        table = dynamodb_client.Table(leads_table)
-        # Scan the table and get all items
-        response = table.scan()
+        for segment in range(total_segments):
+            executor.submit(scan_segment, segment)
+        running_segments = total_segments
+        while running_segments:
+            page = page_queue.get()
+            if page is segment_done:
+                running_segments -= 1
+            elif isinstance(page, Exception):
+                raise page
+            else:
+                yield from page
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
 
-        recent_session_ids = [
-            item.get("session_id")
-            for item in response["Items"]
-            if (item.get("lead_id") == "None") or (item.get("lead_id") is None)
-        ]
-        return recent_session_ids
+
+# Session ids without a lead id, the filter and projection are applied by dynamodb
+def session_ids_with_no_lead_id(dynamodb_client, leads_table, total_segments=4):
+    try:
+        # sessions claimed by a running lead creation call are left to that call and
+        # lead writes waiting in the outbox are sent by the outbox drainer
+        scanned_items = parallel_scan(
+            dynamodb_client,
+            leads_table,
+            total_segments,
+            FilterExpression="(attribute_not_exists(lead_id) OR lead_id = :none OR attribute_type(lead_id, :null_type)) AND attribute_not_exists(outbox_pending) AND (attribute_not_exists(claim_status) OR claim_status <> :claimed OR claimed_until < :now)",
+            ProjectionExpression="session_id",
+            ExpressionAttributeValues={
+                ":none": "None",
+                ":null_type": "NULL",
+                ":claimed": "claimed",
+                ":now": int(time.time()),
+            },
+        )
+        session_count = 0
+        for item in scanned_items:
+            session_count += 1
+            yield item["session_id"]
+        logger.info(f"number of session ids with no lead id is {session_count}")
     except Exception as e:
         logger.info(f"Error extracting recent session IDs: {e}")
-        return []
+
+
+# Read items by session id with batch_get_item, 100 keys per call. Keys dynamodb leaves
+# unprocessed are requested again with a growing delay, the ones still unprocessed after
+# max_attempts are added to unfetched_session_ids.
+def batch_get_items(
+    dynamodb_client,
+    table_name,
+    session_ids,
+    attributes=None,
+    max_attempts=5,
+    unfetched_session_ids=None,
+):
+    items = {}
+    session_ids = list(dict.fromkeys(session_ids))
+    for start in range(0, len(session_ids), 100):
+        table_request = {
+            "Keys": [
+                {"session_id": session_id}
+                for session_id in session_ids[start : start + 100]
+            ]
+        }
+        if attributes:
+            table_request["ProjectionExpression"] = ", ".join(
+                f"#attribute{number}" for number in range(len(attributes))
+            )
+            table_request["ExpressionAttributeNames"] = {
+                f"#attribute{number}": attribute
+                for number, attribute in enumerate(attributes)
+            }
+        request_items = {table_name: table_request}
+        attempt = 0
+        while request_items:
+            response = dynamodb_client.batch_get_item(RequestItems=request_items)
+            for item in response["Responses"].get(table_name, []):
+                items[item["session_id"]] = item
+            request_items = response.get("UnprocessedKeys") or {}
+            if request_items:
+                attempt += 1
+                if attempt >= max_attempts:
+                    unfetched_keys = request_items[table_name]["Keys"]
+                    logger.info(
+                        f"{len(unfetched_keys)} unprocessed keys left in {table_name} after {attempt} attempts"
+                    )
+                    if unfetched_session_ids is not None:
+                        unfetched_session_ids.update(
+                            key["session_id"] for key in unfetched_keys
+                        )
+                    break
+                time.sleep(min(2, 0.05 * 2**attempt))
+    return items
+
+
+# Prefetch the rows of a batch of sessions from several tables before they are processed.
+# Yields (session_id, {table_name: item or None}) in the order of the session ids. Sessions
+# with rows dynamodb did not return are not yielded but added to unfetched_session_ids,
+# so they are not mistaken for sessions without rows.
+def prefetch_session_items(
+    dynamodb_client,
+    session_ids,
+    table_attributes,
+    batch_size=100,
+    unfetched_session_ids=None,
+):
+    session_ids = iter(session_ids)
+    while True:
+        batch = list(itertools.islice(session_ids, batch_size))
+        if not batch:
+            return
+        batch_unfetched_session_ids = set()
+        fetched_items = {
+            table_name: batch_get_items(
+                dynamodb_client,
+                table_name,
+                batch,
+                attributes,
+                unfetched_session_ids=batch_unfetched_session_ids,
+            )
+            for table_name, attributes in table_attributes.items()
+        }
+        if unfetched_session_ids is not None:
+            unfetched_session_ids |= batch_unfetched_session_ids
+        for session_id in batch:
+            if session_id in batch_unfetched_session_ids:
+                continue
+            yield session_id, {
+                table_name: items.get(session_id)
+                for table_name, items in fetched_items.items()
+            }
+
+
+# weights of the default session priority score, changed with session_priority_weights
+DEFAULT_PRIORITY_WEIGHTS = {"recency": 2.0, "turns": 1.0, "attempts": 1.0}
+
+
+def make_session_priority_score(weights=None):
+    """
+    Score of a pending session, sessions with higher scores are processed first.
+
+    The score adds how recent the chat is, how many turns the user took and how many
+    lead creation attempts are left, each between 0 and 1, times its weight.
+    """
+    weights = dict(DEFAULT_PRIORITY_WEIGHTS, **(weights or {}))
+
+    def session_priority_score(session):
+        recency = 0.0
+        try:
+            updated_at = datetime.fromisoformat(session["updated_at"])
+            age_hours = max(0.0, (datetime.utcnow() - updated_at).total_seconds() / 3600)
+            # 1 for a chat updated just now, 0.5 after a day
+            recency = 1 / (1 + age_hours / 24)
+        except (KeyError, TypeError, ValueError):
+            pass
+        turns = min(int(session.get("user_turn_count") or 0), 10) / 10
+        attempts = max(0, 4 - int(session.get("lead_creation_attempts") or 0)) / 4
+        return (
+            weights["recency"] * recency
+            + weights["turns"] * turns
+            + weights["attempts"] * attempts
+        )
+
+    return session_priority_score
+
+
+# Reorder prefetched (session_id, session_items) pairs, highest score first. The score
+# reads the chat history and lead rows already prefetched for processing, so scoring
+# costs no extra reads. The best of the next `window` sessions is yielded each time one
+# more session is read, a window of 0 orders the whole backlog before the first one.
+def prioritized_sessions(
+    prefetched_sessions, chat_history_table, leads_table, score=None, window=500
+):
+    score = score or make_session_priority_score()
+    heap = []
+    for position, (session_id, session_items) in enumerate(prefetched_sessions):
+        session = dict(
+            session_items[leads_table] or {}, **(session_items[chat_history_table] or {})
+        )
+        try:
+            priority = score(session)
+        except Exception as e:
+            logger.info(f"Exception {e} occured while scoring session id {session_id}")
+            priority = 0
+        # position keeps the read order between sessions with the same score
+        heapq.heappush(heap, (-priority, position, session_id, session_items))
+        if window and len(heap) >= window:
+            yield heapq.heappop(heap)[2:]
+    while heap:
+        yield heapq.heappop(heap)[2:]
+
+
+class BatchCheckpoint:
+    """Read cursor and processed sessions of an unfinished batch job run.
+
+    The cursor is kept in the checkpoint table under the job name, and every processed
+    session in an item of its own keyed by job name, run id and session id, so the
+    checkpoint stays small however many sessions a run processes. The next invocation
+    skips the marked sessions and continues from the cursor. Without a checkpoint
+    table nothing is saved and every run starts over.
+    """
+
+    def __init__(self, dynamodb_client, table_name, job_name):
+        self.dynamodb_client = dynamodb_client
+        self.table = dynamodb_client.Table(table_name) if table_name else None
+        self.job_name = job_name
+        self.run_id = uuid.uuid4().hex
+        self.resumed = False
+        self.processed_count = 0
+        # processed by this invocation, and found marked by an earlier one
+        self.processed_session_ids = set()
+        self.earlier_processed_session_ids = set()
+        self.cursor = None
+        self.lock = threading.Lock()
+        if self.table is None:
+            return
+        try:
+            item = self.table.get_item(Key={"job_name": job_name}).get("Item")
+            if item and item.get("run_id"):
+                self.resumed = True
+                self.run_id = item["run_id"]
+                self.processed_count = int(item.get("processed_count", 0))
+                self.cursor = item.get("cursor")
+                logger.info(
+                    f"resuming {job_name} after {self.processed_count} processed sessions"
+                )
+        except Exception as e:
+            logger.info(f"Exception {e} occured while reading batch checkpoint")
+
+    def marker_key(self, session_id):
+        return f"{self.job_name}#{self.run_id}#{session_id}"
+
+    def get_processed_markers(self, session_ids, max_attempts=5):
+        """Session ids of the batch marked as processed by an earlier invocation."""
+        prefix_length = len(self.marker_key(""))
+        request_items = {
+            self.table.name: {
+                "Keys": [
+                    {"job_name": self.marker_key(session_id)}
+                    for session_id in dict.fromkeys(session_ids)
+                ],
+                "ProjectionExpression": "job_name",
+            }
+        }
+        processed_session_ids = set()
+        attempt = 0
+        while request_items:
+            response = self.dynamodb_client.batch_get_item(RequestItems=request_items)
+            for item in response["Responses"].get(self.table.name, []):
+                processed_session_ids.add(item["job_name"][prefix_length:])
+            request_items = response.get("UnprocessedKeys") or {}
+            if request_items:
+                attempt += 1
+                if attempt >= max_attempts:
+                    logger.info(f"unprocessed checkpoint keys left after {attempt} attempts")
+                    break
+                time.sleep(min(2, 0.05 * 2**attempt))
+        return processed_session_ids
+
+    def unprocessed(self, session_ids, batch_size=100):
+        """Yields the session ids not processed by the run, looked up 100 at a time."""
+        session_ids = iter(session_ids)
+        if not self.resumed:
+            yield from session_ids
+            return
+        for batch in iter(lambda: list(itertools.islice(session_ids, batch_size)), []):
+            try:
+                processed_session_ids = self.get_processed_markers(batch)
+            except Exception as e:
+                logger.info(f"Exception {e} occured while reading processed sessions")
+                processed_session_ids = set()
+            self.earlier_processed_session_ids |= processed_session_ids
+            for session_id in batch:
+                if session_id not in processed_session_ids:
+                    yield session_id
+
+    def is_processed(self, session_id):
+        return (
+            session_id in self.processed_session_ids
+            or session_id in self.earlier_processed_session_ids
+        )
+
+    def mark_processed(self, session_id):
+        with self.lock:
+            self.processed_session_ids.add(session_id)
+
+    def resume_cursor(self, page_start_keys):
+        """Start key of the page holding the first read session not processed yet."""
+        last_start_key = self.cursor
+        for session_id, start_key in page_start_keys.items():
+            if not self.is_processed(session_id):
+                return start_key
+            last_start_key = start_key
+        return last_start_key
+
+    def sessions_behind_cursor(self, cursor, page_start_keys):
+        """Sessions read from pages before the cursor, the next run does not read them again."""
+        page_numbers = []
+        session_pages = {}
+        for session_id, start_key in page_start_keys.items():
+            if not page_numbers or page_numbers[-1] != start_key:
+                page_numbers.append(start_key)
+            session_pages[session_id] = len(page_numbers) - 1
+        if cursor not in page_numbers:
+            return set()
+        cursor_page = page_numbers.index(cursor)
+        return {
+            session_id
+            for session_id, page in session_pages.items()
+            if page < cursor_page
+        }
+
+    def save(self, cursor=None, page_start_keys=None):
+        """Saves the processed markers and then the cursor. Returns False when not saved."""
+        if self.table is None:
+            return False
+        try:
+            with self.lock:
+                session_ids = set(self.processed_session_ids)
+            marked_session_ids = session_ids - self.sessions_behind_cursor(
+                cursor, page_start_keys or {}
+            )
+            # old checkpoints of abandoned runs are removed by the table ttl
+            expires_at = int(time.time()) + 2 * 24 * 3600
+            with self.table.batch_writer() as batch:
+                for session_id in marked_session_ids:
+                    batch.put_item(
+                        Item={
+                            "job_name": self.marker_key(session_id),
+                            "expires_at": expires_at,
+                        }
+                    )
+            self.table.put_item(
+                Item={
+                    "job_name": self.job_name,
+                    "run_id": self.run_id,
+                    "processed_count": self.processed_count + len(session_ids),
+                    "cursor": cursor,
+                    "updated_at": str(datetime.utcnow()),
+                    "expires_at": expires_at,
+                }
+            )
+            logger.info(
+                f"saved checkpoint of {self.job_name} with {len(marked_session_ids)} of {len(session_ids)} processed sessions marked"
+            )
+            return True
+        except Exception as e:
+            logger.info(f"Exception {e} occured while saving batch checkpoint")
+            return False
+
+    def clear(self):
+        if self.table is None:
+            return
+        try:
+            # markers of the run are left to the table ttl, a new run has a new run id
+            self.table.delete_item(Key={"job_name": self.job_name})
+        except Exception as e:
+            logger.info(f"Exception {e} occured while clearing batch checkpoint")
+
+
+# Batch inference job submitted by an earlier run, kept in the checkpoint table next
+# to the checkpoint of the batch job until its outputs are ingested.
+def get_batch_inference_state(dynamodb_client, table_name, job_name):
+    if not table_name:
+        return None
+    try:
+        table = dynamodb_client.Table(table_name)
+        return table.get_item(Key={"job_name": f"{job_name}#batch_inference"}).get(
+            "Item"
+        )
+    except Exception as e:
+        logger.info(f"Exception {e} occured while reading batch inference state")
+        return None
+
+
+def save_batch_inference_state(dynamodb_client, table_name, job_name, state):
+    try:
+        table = dynamodb_client.Table(table_name)
+        table.put_item(
+            Item={
+                **state,
+                "job_name": f"{job_name}#batch_inference",
+                "updated_at": str(datetime.utcnow()),
+                # batch inference jobs that never finish are forgotten after a week
+                "expires_at": int(time.time()) + 7 * 24 * 3600,
+            }
+        )
+        return True
+    except Exception as e:
+        logger.info(f"Exception {e} occured while saving batch inference state")
+        return False
+
+
+def clear_batch_inference_state(dynamodb_client, table_name, job_name):
+    try:
+        table = dynamodb_client.Table(table_name)
+        table.delete_item(Key={"job_name": f"{job_name}#batch_inference"})
+    except Exception as e:
+        logger.info(f"Exception {e} occured while clearing batch inference state")
+
+
+# Start the next run of the batch job asynchronously, so a large backlog is drained
+# over several invocations. The chain stops after max_reinvokes runs.
+def reinvoke_batch_job(context, event, max_reinvokes):
+    reinvoke_count = 0
+    if isinstance(event, dict):
+        reinvoke_count = int(event.get("reinvoke_count", 0))
+    if context is None or reinvoke_count >= max_reinvokes:
+        logger.info(f"not reinvoking batch job, reinvoke count is {reinvoke_count}")
+        return False
+    payload = {"reinvoke_count": reinvoke_count + 1}
+    # a shard keeps working on its own part of the sessions
+    if isinstance(event, dict) and "shard" in event:
+        payload.update(shard=event["shard"], shard_count=event.get("shard_count", 1))
+    try:
+        lambda_client = boto3.client("lambda")
+        lambda_client.invoke(
+            FunctionName=context.invoked_function_arn,
+            InvocationType="Event",
+            Payload=json.dumps(payload),
+        )
+        logger.info(f"reinvoked batch job, reinvoke count is {reinvoke_count + 1}")
+        return True
+    except Exception as e:
+        logger.info(f"Exception {e} occured while reinvoking batch job")
+        return False
 
 
 def retrieve_previous_user_info(dynamodb_client, leads_table, session_id):
@@ -100,16 +548,107 @@ def get_bedrock_client(region_name):
         return None
 
 
+# endpoint of a local dynamodb stand in, for example DynamoDB Local, unset for aws
+DYNAMODB_ENDPOINT_URL = os.environ.get("dynamodb_endpoint_url") or None
+
+
 def get_dynamodb_client(region_name):
     try:
         # Initialize the DynamoDB resource
-        dynamodb_client = boto3.resource("dynamodb", region_name=region_name)
+        dynamodb_client = boto3.resource(
+            "dynamodb", region_name=region_name, endpoint_url=DYNAMODB_ENDPOINT_URL
+        )
         return dynamodb_client
     except Exception as e:
         logger.error(f"Failed to set up DynamoDB client: {e}")
         return None
 
 
+# dynamodb resources are not thread safe, every worker thread gets its own
+worker_resources = threading.local()
+
+
+def get_worker_dynamodb_client(region_name):
+    dynamodb_client = getattr(worker_resources, "dynamodb_client", None)
+    if dynamodb_client is None:
+        dynamodb_client = boto3.session.Session().resource(
+            "dynamodb", region_name=region_name, endpoint_url=DYNAMODB_ENDPOINT_URL
+        )
+        worker_resources.dynamodb_client = dynamodb_client
+    return dynamodb_client
+
+
+class RateLimiter:
+    """Token bucket shared by worker threads, a rate of 0 means no limit."""
+
+    def __init__(self, calls_per_second, burst=None):
+        self.calls_per_second = calls_per_second
+        self.capacity = burst or max(1, calls_per_second)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.calls_per_second <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.updated_at) * self.calls_per_second,
+                )
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_seconds = (1 - self.tokens) / self.calls_per_second
+            time.sleep(wait_seconds)
+
+
+# Run process_session for every work item with at most `concurrency` sessions in
+# flight. Work items are pulled from the iterable only when a worker is free, and no
+# new item is pulled once should_stop returns True. Returns the outcome counts and
+# whether the run stopped before the work items ran out.
+def run_session_workers(work_items, process_session, concurrency, should_stop=None):
+    results = {}
+    work_items = iter(work_items)
+    stopped = False
+
+    def next_work_item():
+        nonlocal stopped
+        if should_stop is not None and should_stop():
+            stopped = True
+            return None
+        return next(work_items, None)
+
+    if concurrency <= 1:
+        while True:
+            work_item = next_work_item()
+            if work_item is None:
+                break
+            result = process_session(work_item)
+            results[result] = results.get(result, 0) + 1
+        return results, stopped
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        running = set()
+        while True:
+            work_item = next_work_item()
+            if work_item is None:
+                break
+            running.add(executor.submit(process_session, work_item))
+            if len(running) >= concurrency:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    results[result] = results.get(result, 0) + 1
+        for future in running:
+            result = future.result()
+            results[result] = results.get(result, 0) + 1
+    return results, stopped
+
+
 def get_bedrockchat_model_response(
     system_prompt,
     chat_history,
@@ -220,22 +759,56 @@ def update_session_history(session_id, table_name, chat_history, dynamodb_client
         logger.info(f"Exception {e} occured while updating chat history")
 
 
+# Local check so that bedrock is called only when email and phone number could be present
+def mandatory_details_possibly_present(user_inputs):
+    validate_user_details_obj = ValidateUserDetails()
+    user_text = "\n".join(user_inputs)
+    if not validate_user_details_obj.contains_email(user_text):
+        logger.info("no email address found in user inputs")
+        return False
+    if not validate_user_details_obj.contains_phone(user_text):
+        logger.info("no phone number found in user inputs")
+        return False
+    return True
+
+
+# Request body of the user details extraction, shared by invoke_model and batch inference
+def build_extraction_request(
+    user_inputs, user_details_extraction_prompt, extraction_mode="json"
+):
+    join_user_inputs = ".\n ".join(user_inputs)
+
+    # modify the prompt
+    new_prompt = user_details_extraction_prompt.render(input_query=join_user_inputs)
+
+    body = {}
+    body["anthropic_version"] = "bedrock-2023-05-31"
+    body["max_tokens"] = 512 if extraction_mode == "json" else 10000
+    body["messages"] = [{"role": "user", "content": new_prompt}]
+    if extraction_mode == "json":
+        body["tools"] = [USER_DETAILS_TOOL]
+        body["tool_choice"] = {"type": "tool", "name": USER_DETAILS_TOOL["name"]}
+    return body
+
+
+# User details dict from the model response body of an extraction request
+def parse_extraction_response(response_body, extraction_mode="json"):
+    if extraction_mode == "json":
+        user_details_dict = parse_user_details_tool_output(response_body)
+        if user_details_dict is None:
+            logger.info(f"user details tool output not found in {response_body}")
+        return user_details_dict
+    return parse_user_details(response_body["content"][0]["text"].strip())
+
+
 def extract_user_details(
     user_inputs, user_details_extraction_prompt, model_id, bedrock_runtime
 ):
     try:
-        join_user_inputs = ".\n ".join(user_inputs)
-
-        # modify the prompt
-        new_prompt = user_details_extraction_prompt.replace(
-            "{input_query}", join_user_inputs
+        body = build_extraction_request(
+            user_inputs, user_details_extraction_prompt, "text"
         )
 
-        body = {}
-        body["anthropic_version"] = "bedrock-2023-05-31"
-        body["max_tokens"] = 10000
-        body["messages"] = [{"role": "user", "content": new_prompt}]
-
         response = bedrock_runtime.invoke_model(
             modelId=model_id,
             contentType="application/json",
@@ -273,6 +846,138 @@ def parse_user_details(user_details):
     return user_info_dict
 
 
+# user details extracted by the model, in the order used by the extraction prompt
+USER_DETAIL_KEYS = [
+    "Name",
+    "Age",
+    "Marital Status",
+    "Work Experience",
+    "Highest Qualification",
+    "Citizen",
+    "Visa Status",
+    "Current Location",
+    "Future Location",
+    "Subject",
+    "Profession",
+    "How",
+    "Email",
+    "Country Code",
+    "Phone",
+]
+
+# tool definition used to get user details as json matching this schema
+USER_DETAILS_TOOL = {
+    "name": "record_user_details",
+    "description": "Record the user details found in the user inputs. Use null for any detail that is missing or unclear.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            key: {"type": ["string", "null"]} for key in USER_DETAIL_KEYS
+        },
+        "required": USER_DETAIL_KEYS,
+    },
+}
+
+
+def parse_user_details_tool_output(response_body):
+    for content in response_body.get("content", []):
+        if (
+            content.get("type") == "tool_use"
+            and content.get("name") == USER_DETAILS_TOOL["name"]
+        ):
+            tool_input = content.get("input") or {}
+            user_info_dict = {}
+            for key in USER_DETAIL_KEYS:
+                value = tool_input.get(key)
+                value = "None" if value is None else str(value).strip()
+                user_info_dict[key] = value if value else "None"
+            return user_info_dict
+    return None
+
+
+def extract_user_details_json(
+    user_inputs, user_details_extraction_prompt, model_id, bedrock_runtime
+):
+    try:
+        body = build_extraction_request(
+            user_inputs, user_details_extraction_prompt, "json"
+        )
+
+        response = bedrock_runtime.invoke_model(
+            modelId=model_id,
+            contentType="application/json",
+            accept="application/json",
+            body=json.dumps(body),
+        )
+
+        logger.info(
+            f"model response parameters for extracting user details as json is {response}"
+        )
+
+        # Parse the response
+        response_body = json.loads(response["body"].read().decode("utf-8"))
+        return parse_extraction_response(response_body, "json")
+    except Exception as e:
+        logger.info(f"Exception {e} occured while extracting user details as json")
+        return None
+
+
+# Extract user details as a dict ready for validate_user_info
+def extract_user_details_dict(
+    user_inputs,
+    user_details_extraction_prompt,
+    model_id,
+    bedrock_runtime,
+    extraction_mode="json",
+):
+    if extraction_mode == "json":
+        return extract_user_details_json(
+            user_inputs, user_details_extraction_prompt, model_id, bedrock_runtime
+        )
+
+    user_details = extract_user_details(
+        user_inputs, user_details_extraction_prompt, model_id, bedrock_runtime
+    )
+    if user_details is None:
+        return None
+    return parse_user_details(user_details)
+
+
+# Fingerprint of what the extraction sees: the user inputs and the prompt version.
+# It only changes when the user says something new or the prompt is changed.
+def transcript_fingerprint(user_inputs, prompt_version):
+    digest = hashlib.sha256(prompt_version.encode("utf-8"))
+    for user_input in user_inputs:
+        digest.update(b"\x00" + user_input.encode("utf-8"))
+    return digest.hexdigest()
+
+
+# Remember the transcript that had no email, phone or name, so later runs skip it
+# until the user adds to the conversation
+def record_missing_details_fingerprint(
+    dynamodb_client, leads_table, session_id, fingerprint
+):
+    try:
+        table = dynamodb_client.Table(leads_table)
+        table.update_item(
+            Key={"session_id": session_id},
+            UpdateExpression="SET missing_details_fingerprint = :fingerprint, missing_details_at = :timestamp",
+            ExpressionAttributeValues={
+                ":fingerprint": fingerprint,
+                ":timestamp": str(datetime.utcnow()),
+            },
+        )
+    except Exception as e:
+        logger.info(f"Exception {e} occured while saving transcript fingerprint")
+
+
+# prompt file used by each extraction mode
+EXTRACTION_PROMPT_FILES = {
+    "json": "json_extraction_instructions.txt",
+    "text": "extraction_instructions.txt",
+}
+
+
 def validate_user_info(user_details_dict):
     validate_user_details_obj = ValidateUserDetails()
 
@@ -431,12 +1136,8 @@ def format_conversation_history(chat_history):
     return conversation_history_list
 
 
-def generate_conversation_summary(
-    conversation_history_list, bedrock_runtime, model_id, summarization_prompt, session_id
-):
-    if not conversation_history_list:
-        return "No conversation history available."
-
+# Request body of the conversation summary, shared by invoke_model and batch inference
+def build_summary_request(conversation_history_list, summarization_prompt, session_id):
     # Prepare the conversation history
     conversation_text = "\n".join(
         [
@@ -446,14 +1147,32 @@ def generate_conversation_summary(
     )
     # modify the prompt
     current_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    new_prompt = summarization_prompt.replace(
-        "{conversation_text}", conversation_text
-    ).replace("{current_datetime}", current_datetime).replace("{session_id}", session_id)
+    new_prompt = summarization_prompt.render(
+        conversation_text=conversation_text,
+        current_datetime=current_datetime,
+        session_id=session_id,
+    )
+    body = {}
+    body["anthropic_version"] = "bedrock-2023-05-31"
+    body["max_tokens"] = 10000
+    body["messages"] = [{"role": "user", "content": new_prompt}]
+    return body
+
+
+def parse_summary_response(response_body):
+    return response_body["content"][0]["text"].strip()
+
+
+def generate_conversation_summary(
+    conversation_history_list, bedrock_runtime, model_id, summarization_prompt, session_id
+):
+    if not conversation_history_list:
+        return "No conversation history available."
+
     try:
-        body = {}
-        body["anthropic_version"] = "bedrock-2023-05-31"
-        body["max_tokens"] = 10000
-        body["messages"] = [{"role": "user", "content": new_prompt}]
+        body = build_summary_request(
+            conversation_history_list, summarization_prompt, session_id
+        )
 
         summarization_response = bedrock_runtime.invoke_model(
             modelId=model_id,
@@ -466,8 +1185,7 @@ def generate_conversation_summary(
         response_body = json.loads(
             summarization_response["body"].read().decode("utf-8")
         )
-        summary = response_body["content"][0]["text"].strip()
-        return summary
+        return parse_summary_response(response_body)
     except Exception as e:
         logger.info(f"Exception {e} occured while getting conversation summary")
         return f"Error generating summary: {e}"
@@ -475,6 +1193,11 @@ def generate_conversation_summary(
 
 def get_salesforce_object(username, password, security_token, domain):
     try:
+        # in memory stand in for local runs, no salesforce login
+        if os.environ.get("salesforce_backend") == "local":
+            from local_salesforce import LocalSalesforce
+
+            return LocalSalesforce()
         # Set your Salesforce credentials here
         sf = Salesforce(
             username=username,
@@ -488,163 +1211,1302 @@ def get_salesforce_object(username, password, security_token, domain):
         return None
 
 
-# Function to get session ids and summaries for a particular lead_id
-def get_summaries_for_lead(lead_id, dynamodb_client, leads_table):
+# GSI on lead_id sorted by lead_updated_epoch, used to get the latest sessions of a lead
+LEAD_ID_INDEX_NAME = os.environ.get(
+    "lead_id_index_name", "lead_id-lead_updated_epoch-index"
+)
+
+
+# epoch time in milliseconds stored next to the string timestamps for indexed queries
+def get_epoch_millis():
+    return int(time.time() * 1000)
+
+
+# utc timestamp string, epoch millis and day bucket of the same instant, written together
+# so the day index and the epoch sort key always agree
+def get_lead_update_time():
+    now = datetime.now(timezone.utc)
+    return (
+        str(now.replace(tzinfo=None)),
+        int(now.timestamp() * 1000),
+        now.strftime("%Y-%m-%d"),
+    )
+
+
+# Create the lead_id index on leads table if it is not there already
+def create_lead_id_index(dynamodb_client, leads_table, index_name=LEAD_ID_INDEX_NAME):
+    try:
+        client = dynamodb_client.meta.client
+        table_description = client.describe_table(TableName=leads_table)["Table"]
+        existing_indexes = [
+            index["IndexName"]
+            for index in table_description.get("GlobalSecondaryIndexes", [])
+        ]
+        if index_name in existing_indexes:
+            logger.info(f"index {index_name} already exists on {leads_table}")
+            return True
+
+        index_definition = {
+            "IndexName": index_name,
+            "KeySchema": [
+                {"AttributeName": "lead_id", "KeyType": "HASH"},
+                {"AttributeName": "lead_updated_epoch", "KeyType": "RANGE"},
+            ],
+            "Projection": {
+                "ProjectionType": "INCLUDE",
+                "NonKeyAttributes": ["summary"],
+            },
+        }
+        billing_mode = table_description.get("BillingModeSummary", {}).get(
+            "BillingMode", "PROVISIONED"
+        )
+        if billing_mode == "PROVISIONED":
+            throughput = table_description["ProvisionedThroughput"]
+            index_definition["ProvisionedThroughput"] = {
+                "ReadCapacityUnits": throughput["ReadCapacityUnits"],
+                "WriteCapacityUnits": throughput["WriteCapacityUnits"],
+            }
+
+        client.update_table(
+            TableName=leads_table,
+            AttributeDefinitions=[
+                {"AttributeName": "lead_id", "AttributeType": "S"},
+                {"AttributeName": "lead_updated_epoch", "AttributeType": "N"},
+            ],
+            GlobalSecondaryIndexUpdates=[{"Create": index_definition}],
+        )
+        logger.info(f"creating index {index_name} on {leads_table}")
+        return True
+    except Exception as e:
+        logger.info(f"Exception {e} occured while creating lead id index")
+        return False
+
+
+# Timestamps like '2024-10-03 13:31:21.824414' are written with datetime.utcnow()
+def parse_utc_timestamp(value):
+    return datetime.fromisoformat(value).replace(tzinfo=timezone.utc)
+
+
+# Set lead_updated_epoch on rows written before it existed so they show up in the index
+def backfill_lead_updated_epoch(dynamodb_client, leads_table):
+    try:
+        table = dynamodb_client.Table(leads_table)
+        scan_kwargs = {
+            "FilterExpression": boto3.dynamodb.conditions.Attr(
+                "lead_updated_epoch"
+            ).not_exists(),
+            "ProjectionExpression": "session_id, lead_updated_at",
+        }
+        updated_count = 0
+        while True:
+            response = table.scan(**scan_kwargs)
+            for item in response["Items"]:
+                # claim rows and other partial rows have no timestamp to convert
+                if not item.get("lead_updated_at"):
+                    continue
+                try:
+                    updated_at = parse_utc_timestamp(item["lead_updated_at"])
+                    table.update_item(
+                        Key={"session_id": item["session_id"]},
+                        UpdateExpression="SET lead_updated_epoch = :epoch",
+                        ExpressionAttributeValues={
+                            ":epoch": int(updated_at.timestamp() * 1000)
+                        },
+                    )
+                    updated_count += 1
+                except Exception as e:
+                    logger.info(
+                        f"Exception {e} occured while backfilling session id {item['session_id']}"
+                    )
+            if "LastEvaluatedKey" not in response:
+                break
+            scan_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+        logger.info(f"lead_updated_epoch set for {updated_count} rows")
+        return updated_count
+    except Exception as e:
+        logger.info(f"Exception {e} occured while backfilling lead_updated_epoch")
+        return None
+
+
+# Sparse GSI of sessions waiting for a lead. Only rows without a lead carry pending_status,
+# so querying it costs as much as the pending work and not the whole leads table.
+PENDING_LEAD_INDEX_NAME = os.environ.get(
+    "pending_lead_index_name", "pending_status-pending_since-index"
+)
+PENDING_STATUS = "pending"
+
+
+def create_pending_lead_index(
+    dynamodb_client,
+    leads_table,
+    index_name=PENDING_LEAD_INDEX_NAME,
+    projection_type="KEYS_ONLY",
+):
+    try:
+        client = dynamodb_client.meta.client
+        table_description = client.describe_table(TableName=leads_table)["Table"]
+        existing_indexes = [
+            index["IndexName"]
+            for index in table_description.get("GlobalSecondaryIndexes", [])
+        ]
+        if index_name in existing_indexes:
+            logger.info(f"index {index_name} already exists on {leads_table}")
+            return True
+
+        index_definition = {
+            "IndexName": index_name,
+            "KeySchema": [
+                {"AttributeName": "pending_status", "KeyType": "HASH"},
+                {"AttributeName": "pending_since", "KeyType": "RANGE"},
+            ],
+            "Projection": {"ProjectionType": projection_type},
+        }
+        billing_mode = table_description.get("BillingModeSummary", {}).get(
+            "BillingMode", "PROVISIONED"
+        )
+        if billing_mode == "PROVISIONED":
+            throughput = table_description["ProvisionedThroughput"]
+            index_definition["ProvisionedThroughput"] = {
+                "ReadCapacityUnits": throughput["ReadCapacityUnits"],
+                "WriteCapacityUnits": throughput["WriteCapacityUnits"],
+            }
+
+        client.update_table(
+            TableName=leads_table,
+            AttributeDefinitions=[
+                {"AttributeName": "pending_status", "AttributeType": "S"},
+                {"AttributeName": "pending_since", "AttributeType": "N"},
+            ],
+            GlobalSecondaryIndexUpdates=[{"Create": index_definition}],
+        )
+        logger.info(f"creating index {index_name} on {leads_table}")
+        return True
+    except Exception as e:
+        logger.info(f"Exception {e} occured while creating pending lead index")
+        return False
+
+
+# Mark rows written before the pending index existed, so they show up in the index
+def backfill_pending_leads(dynamodb_client, leads_table, total_segments=4):
     try:
         table = dynamodb_client.Table(leads_table)
-        # Query to retrieve all rows for the given lead_id
-        response = table.scan(
-            FilterExpression=boto3.dynamodb.conditions.Attr("lead_id").eq(lead_id)
-        )
-
-        if len(response["Items"]) > 1:
-            # Sort the items by 'lead_updated_at' in descending order (most recent first)
-            sorted_items = sorted(
-                response["Items"],
-                key=lambda x: datetime.strptime(
-                    x.get("lead_updated_at"), "%Y-%m-%d %H:%M:%S.%f"
-                ),  # Adjusted for fractional seconds
-                reverse=True,
+        scanned_items = parallel_scan(
+            dynamodb_client,
+            leads_table,
+            total_segments,
+            FilterExpression="(attribute_not_exists(lead_id) OR lead_id = :none OR attribute_type(lead_id, :null_type)) AND attribute_not_exists(pending_status) AND attribute_not_exists(outbox_pending) AND (attribute_not_exists(lead_creation_attempts) OR lead_creation_attempts < :max_attempts)",
+            ProjectionExpression="session_id, lead_updated_epoch",
+            ExpressionAttributeValues={
+                ":none": "None",
+                ":null_type": "NULL",
+                ":max_attempts": 4,
+            },
+        )
+        updated_count = 0
+        for item in scanned_items:
+            table.update_item(
+                Key={"session_id": item["session_id"]},
+                UpdateExpression="SET pending_status = :pending, pending_since = :since",
+                ExpressionAttributeValues={
+                    ":pending": PENDING_STATUS,
+                    ":since": item.get("lead_updated_epoch", get_epoch_millis()),
+                },
             )
-        else:
-            sorted_items = response["Items"]
+            updated_count += 1
+        logger.info(f"marked {updated_count} rows as pending leads")
+        return updated_count
+    except Exception as e:
+        logger.info(f"Exception {e} occured while backfilling pending leads")
+        return None
 
-        count = 0  # Initialize count variable to store only last 5 summaries
-        logger.info(f"length of sorted_items is {len(sorted_items)}")
 
-        # Extract session_ids and summaries
-        session_summaries = []
-        for item in sorted_items:
-            count += 1  # Increment count
-            if count > 4:  # Break out of loop if count exceeds 4
+# Session ids waiting for a lead, oldest first. Claims of running lead creation calls
+# carry the end of their lease as pending_since, so they are returned only once expired.
+# The query starts at start_key, and page_start_keys records the start key of the page
+# each session id was read from, which is the resume cursor of that session. Only session
+# ids passing session_filter, for example the sessions of one shard, are yielded and
+# recorded, so sessions left to other workers do not hold the cursor back.
+def pending_session_ids(
+    dynamodb_client,
+    leads_table,
+    total_segments=4,
+    start_key=None,
+    page_start_keys=None,
+    session_filter=None,
+):
+    table = dynamodb_client.Table(leads_table)
+    query_kwargs = {
+        "IndexName": PENDING_LEAD_INDEX_NAME,
+        "KeyConditionExpression": Key("pending_status").eq(PENDING_STATUS)
+        & Key("pending_since").lte(get_epoch_millis()),
+        "ScanIndexForward": True,
+    }
+    if start_key:
+        query_kwargs["ExclusiveStartKey"] = start_key
+    session_count = 0
+    try:
+        while True:
+            response = table.query(**query_kwargs)
+            for item in response["Items"]:
+                session_count += 1
+                if session_filter is not None and not session_filter(item["session_id"]):
+                    continue
+                if page_start_keys is not None:
+                    page_start_keys[item["session_id"]] = query_kwargs.get(
+                        "ExclusiveStartKey"
+                    )
+                yield item["session_id"]
+            if "LastEvaluatedKey" not in response:
                 break
-            session_id = item.get("session_id")
-            print(f"session_id is {session_id}")
-            summary = item.get("summary")
-            if summary:
-                session_summaries.append(summary)
+            query_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    except Exception as e:
+        logger.info(f"Exception {e} occured while querying pending lead index")
+        if session_count == 0:
+            # index is not there yet, fall back to scanning the leads table
+            yield from filter(
+                session_filter,
+                session_ids_with_no_lead_id(dynamodb_client, leads_table, total_segments),
+            )
+            return
+    logger.info(f"number of pending session ids is {session_count}")
+
+
+# Function to get the latest summaries of a particular lead_id, most recent first
+def get_summary_list_for_lead(lead_id, dynamodb_client, leads_table):
+    try:
+        table = dynamodb_client.Table(leads_table)
+        # Query the latest 4 rows for the given lead_id, most recent first
+        response = table.query(
+            IndexName=LEAD_ID_INDEX_NAME,
+            KeyConditionExpression=Key("lead_id").eq(lead_id),
+            ScanIndexForward=False,
+            Limit=4,
+            ProjectionExpression="summary",
+        )
+        logger.info(f"number of summaries for lead id {lead_id} is {response['Count']}")
 
-        # Join all summaries together
-        joined_summary = "\n\n".join(session_summaries)
-        return joined_summary
+        # Extract summaries
+        session_summaries = [
+            item.get("summary") for item in response["Items"] if item.get("summary")
+        ]
+
+        return session_summaries
     except Exception as e:
         logger.info(
             f"Error in getting the summary for the all session ids of a lead id: {e}"
         )
-        return ""
+        return []
 
 
-def lead_creation(
-    user_details_dict, salesforce_object, summary, dynamodb_client, leads_table
+# Function to get the joined summaries for a particular lead_id
+def get_summaries_for_lead(lead_id, dynamodb_client, leads_table):
+    # Join all summaries together
+    return "\n\n".join(get_summary_list_for_lead(lead_id, dynamodb_client, leads_table))
+
+
+# Rolling summary digest per lead, so the Description of a long lived lead stays bounded.
+# The latest summaries are kept in full, older ones are compressed and the rest only counted.
+LEAD_DIGEST_TABLE = os.environ.get("lead_digest_table_name")
+DIGEST_RECENT_SUMMARIES = 3
+DIGEST_OLDER_SUMMARIES = 6
+DIGEST_COMPRESSED_CHARS = 400
+MAX_DESCRIPTION_CHARS = 32000
+
+
+def compress_summary(summary, max_chars=DIGEST_COMPRESSED_CHARS):
+    summary = " ".join(summary.split())
+    if len(summary) <= max_chars:
+        return summary
+    cut = summary[:max_chars]
+    # keep whole sentences when a good part of the summary fits
+    sentence_end = cut.rfind(". ")
+    if sentence_end > max_chars // 2:
+        return cut[: sentence_end + 1]
+    return cut.rsplit(" ", 1)[0] + " ..."
+
+
+def merge_summary_into_digest(digest, summary, session_id=None):
+    # a session updated again replaces its previous summary
+    recent_summaries = [
+        entry
+        for entry in digest["recent_summaries"]
+        if entry["summary"] != summary
+        and not (session_id and entry.get("session_id") == session_id)
+    ]
+    recent_summaries.insert(0, {"session_id": session_id or "", "summary": summary})
+    older_summaries = list(digest["older_summaries"])
+    archived_count = int(digest["archived_count"])
+    while len(recent_summaries) > DIGEST_RECENT_SUMMARIES:
+        older_summaries.insert(0, compress_summary(recent_summaries.pop()["summary"]))
+    while len(older_summaries) > DIGEST_OLDER_SUMMARIES:
+        older_summaries.pop()
+        archived_count += 1
+    return dict(
+        digest,
+        recent_summaries=recent_summaries,
+        older_summaries=older_summaries,
+        archived_count=archived_count,
+    )
+
+
+def render_lead_digest(digest):
+    parts = [entry["summary"] for entry in digest["recent_summaries"]]
+    if digest["older_summaries"]:
+        parts.append(
+            "Earlier sessions:\n"
+            + "\n".join(f"- {summary}" for summary in digest["older_summaries"])
+        )
+    if digest["archived_count"]:
+        parts.append(f"{digest['archived_count']} older sessions not shown.")
+    return "\n\n".join(parts)[:MAX_DESCRIPTION_CHARS]
+
+
+# Description for an existing lead with the new summary merged into its digest
+def get_lead_description(
+    lead_id, summary, dynamodb_client, leads_table, session_id=None
 ):
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            lead_attempt = attempt + 1
-            print(f"attempt number is {lead_attempt}")
-            user_details_dict["Description"] = summary
-            result = salesforce_object.Lead.create(user_details_dict)
-            lead_id = result.get("id")
-            logger.info(f"Lead created with API response ID: {lead_id}")
-
-            lead_creation_message = "successfully created"
-            return lead_id, lead_creation_message, lead_attempt
-        except (SalesforceMalformedRequest, SalesforceResourceNotFound) as e:
-            logger.info(f"Error in creating lead: {e}")
-            lead_creation_message = f"Error in creating lead: {e}"
-            error_message = str(e)
+    if not LEAD_DIGEST_TABLE:
+        existing_summary = get_summaries_for_lead(lead_id, dynamodb_client, leads_table)
+        return summary + "\n\n" + existing_summary
+    try:
+        table = dynamodb_client.Table(LEAD_DIGEST_TABLE)
+        for _ in range(3):
+            digest = table.get_item(Key={"lead_id": lead_id}).get("Item")
+            if digest is None:
+                # first digest of the lead, start from the summaries in the leads table
+                digest = {
+                    "lead_id": lead_id,
+                    "recent_summaries": [],
+                    "older_summaries": [],
+                    "archived_count": 0,
+                    "version": 0,
+                }
+                previous_summaries = get_summary_list_for_lead(
+                    lead_id, dynamodb_client, leads_table
+                )
+                for previous_summary in reversed(previous_summaries):
+                    digest = merge_summary_into_digest(digest, previous_summary)
+                condition = {"ConditionExpression": "attribute_not_exists(lead_id)"}
+            else:
+                condition = {
+                    "ConditionExpression": "version = :version",
+                    "ExpressionAttributeValues": {":version": digest["version"]},
+                }
+            digest = merge_summary_into_digest(digest, summary, session_id)
+            digest["version"] = int(digest["version"]) + 1
+            digest["updated_at"] = str(datetime.utcnow())
+            try:
+                table.put_item(Item=digest, **condition)
+                return render_lead_digest(digest)
+            except ClientError as e:
+                if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    raise
+                logger.info(f"digest of lead id {lead_id} changed meanwhile, merging again")
+        return render_lead_digest(digest)
+    except Exception as e:
+        logger.info(f"Exception {e} occured while updating the lead digest")
+        existing_summary = get_summaries_for_lead(lead_id, dynamodb_client, leads_table)
+        return summary + "\n\n" + existing_summary
 
-            logger.info(f"error in creating the lead is {error_message.lower()}")
-            # Check if the error message contains "Email already exists"
-            if "email already exists in our database" in error_message.lower():
-                email_id = user_details_dict["Email"]
-                logger.info(f"Email id is already there in database {email_id}")
 
-                # SQL query to find the lead with the given email ID
-                query = f"SELECT Id, Name, Email, Description FROM Lead WHERE Email = '{email_id}' LIMIT 1"
+def normalize_email(email):
+    if not email or email == "Not specified":
+        return None
+    return str(email).strip().lower()
 
-                try:
-                    # Execute the query
-                    lead_result = salesforce_object.query(query)
-
-                    # Check if the lead exists
-                    if lead_result["totalSize"] > 0:
-                        lead = lead_result["records"][0]
-                        logger.info(
-                            f"Lead found: {lead['Name']} (ID: {lead['Id']}, Email: {lead['Email']}, Description: {lead['Description']})"
-                        )
-                    else:
-                        logger.info(f"No lead found with email: {email_id}")
 
-                    lead_id = lead["Id"]
-                    existing_summary = get_summaries_for_lead(
-                        lead_id, dynamodb_client, leads_table
-                    )
-                    new_summary = summary + "\n\n" + existing_summary
-                    user_details_dict["Description"] = new_summary
-                    salesforce_object.Lead.update(lead_id, user_details_dict)
+def normalize_phone(phone):
+    if not phone or phone == "Not specified":
+        return None
+    digits = re.sub(r"\D", "", str(phone))
+    return digits if digits else None
 
-                    lead_attempt = attempt + 1
-                    lead_creation_message = f"Lead id {lead_id} already exists for user mail id {email_id}. Only updating the summary."
-                    return lead_id, lead_creation_message, lead_attempt
-                except Exception as e:
-                    lead_creation_message = f"Email id is already there in database. Unexpected error at creating the lead: {e}"
-                    logger.info(lead_creation_message)
-                    lead_attempt = attempt + 1
-                    return None, lead_creation_message, lead_attempt
 
+# keys of the local dedup index for the email and phone number of a lead
+def get_dedup_keys(user_details_dict):
+    dedup_keys = []
+    email = normalize_email(user_details_dict.get("Email"))
+    if email:
+        dedup_keys.append(f"email#{email}")
+    phone = normalize_phone(user_details_dict.get("Phone"))
+    if phone:
+        dedup_keys.append(f"phone#{phone}")
+    return dedup_keys
+
+
+# Find a lead id already created for the email or phone number in the dedup index
+def lookup_lead_in_dedup_index(user_details_dict, dynamodb_client, dedup_table):
+    if not dedup_table:
+        return None
+    try:
+        dedup_keys = get_dedup_keys(user_details_dict)
+        if not dedup_keys:
+            return None
+        response = dynamodb_client.batch_get_item(
+            RequestItems={
+                dedup_table: {
+                    "Keys": [{"dedup_key": dedup_key} for dedup_key in dedup_keys],
+                    "ProjectionExpression": "dedup_key, lead_id",
+                }
+            }
+        )
+        lead_ids = {
+            item["dedup_key"]: item["lead_id"]
+            for item in response["Responses"].get(dedup_table, [])
+        }
+        # email match is preferred over phone match
+        for dedup_key in dedup_keys:
+            if dedup_key in lead_ids:
+                logger.info(f"lead id {lead_ids[dedup_key]} found for {dedup_key}")
+                return lead_ids[dedup_key]
+        return None
+    except Exception as e:
+        logger.info(f"Exception {e} occured while checking the lead dedup index")
+        return None
+
+
+def record_lead_in_dedup_index(lead_id, user_details_dict, dynamodb_client, dedup_table):
+    if not dedup_table or not lead_id:
+        return False
+    try:
+        table = dynamodb_client.Table(dedup_table)
+        time_value = str(datetime.utcnow())
+        with table.batch_writer() as batch:
+            for dedup_key in get_dedup_keys(user_details_dict):
+                batch.put_item(
+                    Item={
+                        "dedup_key": dedup_key,
+                        "lead_id": lead_id,
+                        "updated_at": time_value,
+                    }
+                )
+        return True
+    except Exception as e:
+        logger.info(f"Exception {e} occured while updating the lead dedup index")
+        return False
+
+
+# Update an existing lead with the new summary added to the previous summaries
+def update_existing_lead(
+    lead_id,
+    user_details_dict,
+    salesforce_object,
+    summary,
+    dynamodb_client,
+    leads_table,
+    session_id=None,
+):
+    user_details_dict["Description"] = get_lead_description(
+        lead_id, summary, dynamodb_client, leads_table, session_id
+    )
+    call_salesforce_or_raise(salesforce_object.Lead.update, lead_id, user_details_dict)
+
+
+# salesforce error codes that can succeed when the call is retried
+RETRYABLE_SALESFORCE_ERROR_CODES = {
+    "REQUEST_LIMIT_EXCEEDED",
+    "UNABLE_TO_LOCK_ROW",
+    "SERVER_UNAVAILABLE",
+}
+
+# seconds kept free for a salesforce call after the backoff delay
+SALESFORCE_CALL_SECONDS = 5
+
+
+# Deadline as epoch seconds from the lambda context, keeping some time to save results
+# A shard also stops by the deadline its orchestrator put in the event, whichever is first
+def get_deadline(context, reserve_seconds=10, event=None):
+    deadlines = []
+    if isinstance(event, dict) and event.get("deadline") is not None:
+        deadlines.append(float(event["deadline"]) - reserve_seconds)
+    if context is not None:
+        try:
+            deadlines.append(
+                time.time() + context.get_remaining_time_in_millis() / 1000 - reserve_seconds
+            )
+        except Exception as e:
+            logger.info(f"Exception {e} occured while reading remaining lambda time")
+    return min(deadlines) if deadlines else None
+
+
+def is_retryable_salesforce_error(error):
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    if isinstance(error, SalesforceError):
+        if error.status >= 500:
+            return True
+        content = error.content if isinstance(error.content, list) else []
+        error_codes = {item.get("errorCode") for item in content if isinstance(item, dict)}
+        return bool(error_codes & RETRYABLE_SALESFORCE_ERROR_CODES)
+    return False
+
+
+# Call salesforce, retrying only retryable errors with exponential backoff and jitter.
+# Returns the result, the last error and the number of attempts made.
+def call_salesforce_with_retry(
+    call, *args, max_attempts=3, base_delay=0.5, max_delay=8, deadline=None, **kwargs
+):
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            return call(*args, **kwargs), None, attempt
+        except Exception as e:
+            if attempt >= max_attempts or not is_retryable_salesforce_error(e):
+                return None, e, attempt
+            delay = random.uniform(0, min(max_delay, base_delay * 2**attempt))
             if (
-                "mobile phone number already exists in our database."
-                in error_message.lower()
+                deadline is not None
+                and time.time() + delay + SALESFORCE_CALL_SECONDS > deadline
             ):
-                phone_number = user_details_dict["Phone"]
-                logger.info(f"Phone number is already there in database {phone_number}")
-
-                # SOQL query to find the lead with the given email ID
-                query = f"SELECT Id, Name, Phone, Description FROM Lead WHERE Phone = '{phone_number}' LIMIT 1"
+                logger.info(f"Not enough time left to retry salesforce call: {e}")
+                return None, e, attempt
+            logger.info(
+                f"Retryable salesforce error {e}, retrying in {delay:.2f} seconds ({attempt}/{max_attempts})"
+            )
+            time.sleep(delay)
+
+
+# Same retry policy for calls whose errors are handled by the caller, raises the last error
+def call_salesforce_or_raise(call, *args, **kwargs):
+    result, error, _ = call_salesforce_with_retry(call, *args, **kwargs)
+    if error is not None:
+        raise error
+    return result
+
+
+# messages used when email or phone number of the lead already exists in salesforce
+DUPLICATE_LEAD_MESSAGES = {
+    "Email": {
+        "error": "email already exists in our database",
+        "found": "Lead id {lead_id} already exists for user mail id {value}. Only updating the summary.",
+        "failed": "Email id is already there in database. Unexpected error at creating the lead: {error}",
+    },
+    "Phone": {
+        "error": "mobile phone number already exists in our database.",
+        "found": "Lead id {lead_id} already exists for phone_number is {value}. updating the summary.",
+        "failed": "Phone number is already there in database. Unexpected error at creating the lead: {error}",
+    },
+}
+
+
+# Update the existing lead when salesforce reports the email or phone number as duplicate.
+# Returns None when the error is not a duplicate error.
+def resolve_duplicate_lead(
+    error_message,
+    user_details_dict,
+    salesforce_object,
+    summary,
+    dynamodb_client,
+    leads_table,
+    dedup_table,
+    lead_attempt,
+    session_id=None,
+):
+    logger.info(f"error in creating the lead is {error_message.lower()}")
+    for field, messages in DUPLICATE_LEAD_MESSAGES.items():
+        if messages["error"] not in error_message.lower():
+            continue
 
-                try:
-                    # Execute the query
-                    lead_result = salesforce_object.query(query)
-
-                    # Check if the lead exists
-                    if lead_result["totalSize"] > 0:
-                        lead = lead_result["records"][0]
-                        logger.info(
-                            f"Lead found: {lead['Name']} (ID: {lead['Id']}, Phone: {lead['Phone']}, Description: {lead['Description']})"
-                        )
-                    else:
-                        logger.info(f"No lead found with phone_number: {phone_number}")
+        value = user_details_dict[field]
+        logger.info(f"{field} is already there in database {value}")
 
-                    lead_id = lead["Id"]
-                    existing_summary = get_summaries_for_lead(
-                        lead_id, dynamodb_client, leads_table
-                    )
-                    new_summary = summary + "\n\n" + existing_summary
-                    user_details_dict["Description"] = new_summary
-                    salesforce_object.Lead.update(lead_id, user_details_dict)
+        # SOQL query to find the lead with the given email ID or phone number
+        query = f"SELECT Id, Name, {field}, Description FROM Lead WHERE {field} = '{value}' LIMIT 1"
 
-                    lead_attempt = attempt + 1
-                    lead_creation_message = f"Lead id {lead_id} already exists for phone_number is {phone_number}. updating the summary."
-                    return lead_id, lead_creation_message, lead_attempt
-                except Exception as e:
-                    lead_creation_message = f"Phone number is already there in database. Unexpected error at creating the lead: {e}"
-                    logger.info(lead_creation_message)
-                    lead_attempt = attempt + 1
-                    return None, lead_creation_message, lead_attempt
-
-            if attempt < max_retries - 1:
-                logger.info(f"Retrying... ({attempt + 1}/{max_retries})")
-                time.sleep(2)  # Wait for 2 seconds before retrying
+        try:
+            # Execute the query
+            lead_result = call_salesforce_or_raise(salesforce_object.query, query)
+
+            # Check if the lead exists
+            if lead_result["totalSize"] > 0:
+                lead = lead_result["records"][0]
+                logger.info(
+                    f"Lead found: {lead['Name']} (ID: {lead['Id']}, {field}: {lead[field]}, Description: {lead['Description']})"
+                )
             else:
-                logger.info("Max retries reached. Could not create lead.")
-                lead_attempt = attempt + 1
-                return None, lead_creation_message, lead_attempt
+                logger.info(f"No lead found with {field}: {value}")
+
+            lead_id = lead["Id"]
+            update_existing_lead(
+                lead_id,
+                user_details_dict,
+                salesforce_object,
+                summary,
+                dynamodb_client,
+                leads_table,
+                session_id,
+            )
+            record_lead_in_dedup_index(
+                lead_id, user_details_dict, dynamodb_client, dedup_table
+            )
+
+            lead_creation_message = messages["found"].format(lead_id=lead_id, value=value)
+            return lead_id, lead_creation_message, lead_attempt
         except Exception as e:
-            lead_creation_message = f"Unexpected error at creating the lead: {e}"
+            lead_creation_message = messages["failed"].format(error=e)
             logger.info(lead_creation_message)
-            lead_attempt = attempt + 1
             return None, lead_creation_message, lead_attempt
+    return None
+
+
+# external id fields found missing in the salesforce org, upsert is skipped for them
+UNSUPPORTED_EXTERNAL_ID_FIELDS = set()
+
+
+# Create or update the lead keyed on an external id field holding the normalized email
+def upsert_lead(
+    user_details_dict,
+    salesforce_object,
+    summary,
+    external_id_field,
+    dynamodb_client,
+    leads_table,
+    deadline=None,
+    session_id=None,
+):
+    external_id = normalize_email(user_details_dict.get("Email"))
+    if external_id is None or external_id_field in UNSUPPORTED_EXTERNAL_ID_FIELDS:
+        return None, None
+    try:
+        lead_fields = dict(user_details_dict)
+        lead_fields.pop(external_id_field, None)
+        lead_fields["Description"] = summary
+        response, error, _ = call_salesforce_with_retry(
+            salesforce_object.Lead.upsert,
+            f"{external_id_field}/{quote(external_id, safe='@.')}",
+            lead_fields,
+            raw_response=True,
+            deadline=deadline,
+        )
+        if error is not None:
+            raise error
+        result = response.json() if response.content else {}
+        lead_id = result.get("id")
+        created = result.get("created", response.status_code == 201)
+        if lead_id is None:
+            # older api versions do not return the id of an updated record
+            lead_result = call_salesforce_or_raise(
+                salesforce_object.query,
+                f"SELECT Id FROM Lead WHERE {external_id_field} = '{external_id}' LIMIT 1"
+            )
+            lead_id = lead_result["records"][0]["Id"]
+
+        if created:
+            logger.info(f"Lead created with upsert, ID: {lead_id}")
+            return lead_id, "successfully created"
+
+        # returning user, keep the summaries of previous sessions in the description
+        description = get_lead_description(
+            lead_id, summary, dynamodb_client, leads_table, session_id
+        )
+        if description.strip() != summary.strip():
+            call_salesforce_or_raise(
+                salesforce_object.Lead.update, lead_id, {"Description": description}
+            )
+        lead_creation_message = f"Lead id {lead_id} already exists for external id {external_id}. Updated the lead with upsert."
+        logger.info(lead_creation_message)
+        return lead_id, lead_creation_message
+    except (SalesforceMalformedRequest, SalesforceResourceNotFound) as e:
+        error_message = str(e)
+        if "INVALID_FIELD" in error_message or "NOT_FOUND" in error_message:
+            logger.info(f"external id field {external_id_field} is not available: {e}")
+            UNSUPPORTED_EXTERNAL_ID_FIELDS.add(external_id_field)
+        else:
+            logger.info(f"Error in upserting lead: {e}")
+        return None, None
+    except Exception as e:
+        logger.info(f"Unexpected error at upserting the lead: {e}")
+        return None, None
+
+
+def lead_creation(
+    user_details_dict,
+    salesforce_object,
+    summary,
+    dynamodb_client,
+    leads_table,
+    dedup_table=None,
+    external_id_field=None,
+    deadline=None,
+    session_id=None,
+):
+    # go straight to update when a lead is already known for the email or phone number
+    lead_id = lookup_lead_in_dedup_index(user_details_dict, dynamodb_client, dedup_table)
+    if lead_id is not None:
+        try:
+            update_existing_lead(
+                lead_id,
+                user_details_dict,
+                salesforce_object,
+                summary,
+                dynamodb_client,
+                leads_table,
+                session_id,
+            )
+            record_lead_in_dedup_index(
+                lead_id, user_details_dict, dynamodb_client, dedup_table
+            )
+            lead_creation_message = f"Lead id {lead_id} found in dedup index. Only updating the summary."
+            return lead_id, lead_creation_message, 1
+        except Exception as e:
+            logger.info(
+                f"Error in updating lead {lead_id} from dedup index: {e}, creating the lead"
+            )
+
+    # single call create or update when the org has an external id field for leads
+    if external_id_field:
+        lead_id, lead_creation_message = upsert_lead(
+            user_details_dict,
+            salesforce_object,
+            summary,
+            external_id_field,
+            dynamodb_client,
+            leads_table,
+            deadline,
+            session_id,
+        )
+        if lead_id is not None:
+            record_lead_in_dedup_index(
+                lead_id, user_details_dict, dynamodb_client, dedup_table
+            )
+            return lead_id, lead_creation_message, 1
+        logger.info("upsert did not complete, creating the lead")
+
+    user_details_dict["Description"] = summary
+    result, error, lead_attempt = call_salesforce_with_retry(
+        salesforce_object.Lead.create, user_details_dict, deadline=deadline
+    )
+    print(f"attempt number is {lead_attempt}")
+    if error is None:
+        lead_id = result.get("id")
+        logger.info(f"Lead created with API response ID: {lead_id}")
+        record_lead_in_dedup_index(
+            lead_id, user_details_dict, dynamodb_client, dedup_table
+        )
+
+        lead_creation_message = "successfully created"
+        return lead_id, lead_creation_message, lead_attempt
+
+    if isinstance(error, SalesforceError):
+        logger.info(f"Error in creating lead: {error}")
+        duplicate_result = resolve_duplicate_lead(
+            str(error),
+            user_details_dict,
+            salesforce_object,
+            summary,
+            dynamodb_client,
+            leads_table,
+            dedup_table,
+            lead_attempt,
+            session_id,
+        )
+        if duplicate_result is not None:
+            return duplicate_result
+        lead_creation_message = f"Error in creating lead: {error}"
+    else:
+        lead_creation_message = f"Unexpected error at creating the lead: {error}"
+    logger.info(lead_creation_message)
+    return None, lead_creation_message, lead_attempt
+
+
+# Create records with one sObject Collections request. Results come back in the
+# same order as the records, each with its own success flag and errors.
+def create_salesforce_records(salesforce_object, sobject_name, records):
+    payload = {
+        "allOrNone": False,
+        "records": [
+            dict(record, attributes={"type": sobject_name}) for record in records
+        ],
+    }
+    return salesforce_object.restful(
+        "composite/sobjects",
+        method="POST",
+        data=json.dumps(payload, default=json_default),
+    )
+
+
+def format_salesforce_errors(errors):
+    return "; ".join(
+        f"{error.get('statusCode')}: {error.get('message')}" for error in errors
+    )
+
+
+# Create leads with sObject Collections requests of up to batch_size records. Each lead
+# is a dict with user_details, summary and session_id. Results are mapped back to the
+# leads by position, duplicate email or phone errors update the existing lead. Returns
+# (lead_id, lead_creation_message, lead_attempt) for every lead in the same order.
+def create_leads_in_collections(
+    leads,
+    salesforce_object,
+    dynamodb_client,
+    leads_table,
+    dedup_table=None,
+    deadline=None,
+    batch_size=200,
+):
+    lead_results = []
+    for start in range(0, len(leads), batch_size):
+        batch = leads[start : start + batch_size]
+        records = [dict(lead["user_details"], Description=lead["summary"]) for lead in batch]
+        results, error, lead_attempt = call_salesforce_with_retry(
+            create_salesforce_records,
+            salesforce_object,
+            "Lead",
+            records,
+            deadline=deadline,
+        )
+        if error is not None:
+            logger.info(f"Error in creating {len(batch)} leads: {error}")
+            lead_results.extend(
+                (None, f"Error in creating lead: {error}", lead_attempt) for _ in batch
+            )
+            continue
+        logger.info(f"created {len(batch)} leads with one collections request")
+
+        for lead, result in zip(batch, results):
+            user_details_dict = dict(lead["user_details"])
+            if result.get("success"):
+                record_lead_in_dedup_index(
+                    result["id"], user_details_dict, dynamodb_client, dedup_table
+                )
+                lead_results.append((result["id"], "successfully created", lead_attempt))
+                continue
+
+            error_message = format_salesforce_errors(result.get("errors", []))
+            duplicate_result = resolve_duplicate_lead(
+                error_message,
+                user_details_dict,
+                salesforce_object,
+                lead["summary"],
+                dynamodb_client,
+                leads_table,
+                dedup_table,
+                lead_attempt,
+                lead["session_id"],
+            )
+            if duplicate_result is not None:
+                lead_results.append(duplicate_result)
+            else:
+                lead_results.append(
+                    (None, f"Error in creating lead: {error_message}", lead_attempt)
+                )
+    return lead_results
+
+
+class LeadCollectionWriter:
+    """
+    Collects prepared leads from the session workers and creates them in sObject
+    Collections requests. A full batch is sent by the worker adding its last lead,
+    the rest is sent by flush at the end of the run.
+    """
+
+    def __init__(
+        self,
+        salesforce_object,
+        leads_table,
+        dedup_table=None,
+        deadline=None,
+        batch_size=200,
+        salesforce_limiter=None,
+    ):
+        self.salesforce_object = salesforce_object
+        self.leads_table = leads_table
+        self.dedup_table = dedup_table
+        self.deadline = deadline
+        self.batch_size = batch_size
+        self.salesforce_limiter = salesforce_limiter
+        self.leads = []
+        self.results = {}
+        self.lock = threading.Lock()
+
+    def add(self, lead, dynamodb_client):
+        """Queues one lead, sending the batch when it is full."""
+        with self.lock:
+            self.leads.append(lead)
+            if len(self.leads) < self.batch_size:
+                return
+            batch, self.leads = self.leads, []
+        self.send(batch, dynamodb_client)
+
+    def flush(self, dynamodb_client):
+        """Sends the leads still queued."""
+        with self.lock:
+            batch, self.leads = self.leads, []
+        if batch:
+            self.send(batch, dynamodb_client)
+
+    def send(self, batch, dynamodb_client):
+        try:
+            if self.salesforce_limiter is not None:
+                self.salesforce_limiter.acquire()
+            lead_results = create_leads_in_collections(
+                batch,
+                self.salesforce_object,
+                dynamodb_client,
+                self.leads_table,
+                self.dedup_table,
+                self.deadline,
+                self.batch_size,
+            )
+        except Exception as e:
+            logger.info(f"Exception {e} occured while creating {len(batch)} leads")
+            lead_results = [
+                (None, f"Exception {e} occured while creating the lead", 1) for _ in batch
+            ]
+
+        for lead, (lead_id, lead_creation_message, lead_attempt) in zip(
+            batch, lead_results
+        ):
+            lead_creation_status = lead_id is not None
+            logger.info(
+                f"lead creation status for session id {lead['session_id']} is {lead_creation_message}"
+            )
+            update_leads_table(
+                dynamodb_client,
+                self.leads_table,
+                lead["session_id"],
+                lead["user_details"],
+                lead["summary"],
+                lead["user_inputs"],
+                lead["previous_lead_creation_attempts"] + lead_attempt,
+                lead_id if lead_creation_status else "None",
+                lead_creation_status,
+                lead_creation_message,
+            )
+            result = "created" if lead_creation_status else "lead_not_created"
+            with self.lock:
+                self.results[result] = self.results.get(result, 0) + 1
+
+
+# dynamodb returns numbers as Decimal, salesforce payloads need plain numbers
+def json_default(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == int(value) else float(value)
+    raise TypeError(f"{type(value)} is not JSON serializable")
+
+
+def from_dynamodb_item(value):
+    if isinstance(value, dict):
+        return {key: from_dynamodb_item(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [from_dynamodb_item(item) for item in value]
+    if isinstance(value, Decimal):
+        return json_default(value)
+    return value
+
+
+# Record the lead write intent in the outbox table, as the lead creation lambda does
+def enqueue_lead_write(
+    session_id, user_details_dict, summary, outbox_table, dynamodb_client
+):
+    try:
+        dedup_keys = get_dedup_keys(user_details_dict)
+        created_epoch = get_epoch_millis()
+        table = dynamodb_client.Table(outbox_table)
+        table.put_item(
+            Item={
+                "outbox_id": session_id,
+                "session_id": session_id,
+                "outbox_status": PENDING_STATUS,
+                # keys of the sparse outbox index read by the batch job
+                "pending_status": PENDING_STATUS,
+                "pending_since": created_epoch,
+                "lead_key": dedup_keys[0] if dedup_keys else f"session#{session_id}",
+                "created_epoch": created_epoch,
+                "created_at": str(datetime.utcnow()),
+                "user_details": user_details_dict,
+                "summary": summary,
+                "attempts": 0,
+            },
+            ConditionExpression="attribute_not_exists(outbox_id)",
+        )
+        logger.info(f"lead write for session id {session_id} queued in outbox")
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            logger.info(f"lead write for session id {session_id} is already in outbox")
+            return True
+        logger.info(f"Exception {e} occured while queueing lead write")
+        return False
+    except Exception as e:
+        logger.info(f"Exception {e} occured while queueing lead write")
+        return False
+
+
+# Sparse GSI of the outbox, only writes still to be sent carry pending_status. The
+# index projects the whole write, so draining reads only the pending writes.
+OUTBOX_PENDING_INDEX_NAME = os.environ.get(
+    "outbox_pending_index_name", "pending_status-pending_since-index"
+)
+
+
+def create_outbox_pending_index(
+    dynamodb_client, outbox_table, index_name=OUTBOX_PENDING_INDEX_NAME
+):
+    return create_pending_lead_index(
+        dynamodb_client, outbox_table, index_name, projection_type="ALL"
+    )
+
+
+# Mark writes queued before the outbox index existed, so they show up in the index
+def backfill_pending_lead_writes(dynamodb_client, outbox_table):
+    try:
+        table = dynamodb_client.Table(outbox_table)
+        scan_kwargs = {
+            "FilterExpression": "outbox_status = :pending AND attribute_not_exists(pending_status)",
+            "ProjectionExpression": "outbox_id, created_epoch",
+            "ExpressionAttributeValues": {":pending": PENDING_STATUS},
+        }
+        updated_count = 0
+        while True:
+            response = table.scan(**scan_kwargs)
+            for item in response["Items"]:
+                table.update_item(
+                    Key={"outbox_id": item["outbox_id"]},
+                    UpdateExpression="SET pending_status = :pending, pending_since = :since",
+                    ExpressionAttributeValues={
+                        ":pending": PENDING_STATUS,
+                        ":since": item.get("created_epoch", get_epoch_millis()),
+                    },
+                )
+                updated_count += 1
+            if "LastEvaluatedKey" not in response:
+                break
+            scan_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+        logger.info(f"marked {updated_count} outbox writes as pending")
+        return updated_count
+    except Exception as e:
+        logger.info(f"Exception {e} occured while backfilling pending lead writes")
+        return None
+
+
+# Get lead write intents waiting in the outbox table, oldest first. Without the
+# outbox index the table is scanned.
+def get_pending_lead_writes(dynamodb_client, outbox_table):
+    table = dynamodb_client.Table(outbox_table)
+    try:
+        read = table.query
+        read_kwargs = {
+            "IndexName": OUTBOX_PENDING_INDEX_NAME,
+            "KeyConditionExpression": Key("pending_status").eq(PENDING_STATUS),
+            "ScanIndexForward": True,
+        }
+        pending_lead_writes = []
+        while True:
+            try:
+                response = read(**read_kwargs)
+            except ClientError as e:
+                if read != table.query or e.response["Error"]["Code"] not in (
+                    "ValidationException",
+                    "ResourceNotFoundException",
+                ):
+                    raise
+                logger.info(
+                    f"outbox index {OUTBOX_PENDING_INDEX_NAME} is not available, scanning {outbox_table}"
+                )
+                read = table.scan
+                read_kwargs = {
+                    "FilterExpression": boto3.dynamodb.conditions.Attr(
+                        "outbox_status"
+                    ).eq(PENDING_STATUS)
+                }
+                continue
+            pending_lead_writes.extend(
+                from_dynamodb_item(item) for item in response["Items"]
+            )
+            if "LastEvaluatedKey" not in response:
+                break
+            read_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+        return pending_lead_writes
+    except Exception as e:
+        logger.info(f"Exception {e} occured while getting pending lead writes")
+        return []
+
+
+# Save the lead id on the lead row and remove the intent from the outbox
+def complete_lead_write(
+    lead_write, lead_id, lead_creation_message, dynamodb_client, outbox_table, leads_table
+):
+    try:
+        outbox = dynamodb_client.Table(outbox_table)
+        # remember the lead id first so that a retry does not create the lead again
+        outbox.update_item(
+            Key={"outbox_id": lead_write["outbox_id"]},
+            UpdateExpression="SET lead_id = :lead_id",
+            ExpressionAttributeValues={":lead_id": lead_id},
+        )
+        leads = dynamodb_client.Table(leads_table)
+        new_timestamp, new_epoch, new_day = get_lead_update_time()
+        leads.update_item(
+            Key={"session_id": lead_write["session_id"]},
+            UpdateExpression="SET lead_id = :lead_id, lead_creation_status = :status, lead_creation_message = :message, lead_updated_at = :new_timestamp, lead_updated_epoch = :new_epoch, lead_updated_day = :new_day, lead_creation_attempts = if_not_exists(lead_creation_attempts, :zero) + :one REMOVE outbox_pending, pending_status, pending_since",
+            ExpressionAttributeValues={
+                ":lead_id": lead_id,
+                ":status": True,
+                ":message": lead_creation_message,
+                ":new_timestamp": new_timestamp,
+                ":new_epoch": new_epoch,
+                ":new_day": new_day,
+                ":zero": 0,
+                ":one": 1,
+            },
+        )
+        outbox.delete_item(Key={"outbox_id": lead_write["outbox_id"]})
+        return True
+    except Exception as e:
+        logger.info(f"Exception {e} occured while completing lead write")
+        return False
+
+
+# Count a failed attempt, after max attempts the session is left to the regular batch flow
+def fail_lead_write(
+    lead_write, error_message, dynamodb_client, outbox_table, leads_table, max_attempts
+):
+    try:
+        attempts = lead_write.get("attempts", 0) + 1
+        outbox_status = "failed" if attempts >= max_attempts else "pending"
+        update_expression = "SET attempts = :attempts, outbox_status = :status, last_error = :error"
+        if outbox_status == "failed":
+            # out of the outbox index, the session goes back to the pending lead index
+            update_expression += " REMOVE pending_status, pending_since"
+        outbox = dynamodb_client.Table(outbox_table)
+        outbox.update_item(
+            Key={"outbox_id": lead_write["outbox_id"]},
+            UpdateExpression=update_expression,
+            ExpressionAttributeValues={
+                ":attempts": attempts,
+                ":status": outbox_status,
+                ":error": error_message,
+            },
+        )
+        if outbox_status == "failed":
+            leads = dynamodb_client.Table(leads_table)
+            leads.update_item(
+                Key={"session_id": lead_write["session_id"]},
+                UpdateExpression="SET lead_creation_message = :message, pending_status = :pending, pending_since = :since REMOVE outbox_pending",
+                ExpressionAttributeValues={
+                    ":message": error_message,
+                    ":pending": PENDING_STATUS,
+                    ":since": get_epoch_millis(),
+                },
+            )
+    except Exception as e:
+        logger.info(f"Exception {e} occured while recording failed lead write")
+
+
+# Send pending lead writes to salesforce. Writes of the same lead are sent oldest first,
+# one per round, and new leads of a round are created in sObject Collections batches.
+def drain_lead_outbox(
+    dynamodb_client,
+    outbox_table,
+    leads_table,
+    salesforce_object,
+    dedup_table=None,
+    deadline=None,
+    batch_size=200,
+    max_attempts=4,
+):
+    outbox_stats = {"sent": 0, "failed": 0}
+    lead_queues = {}
+    for lead_write in sorted(
+        get_pending_lead_writes(dynamodb_client, outbox_table),
+        key=lambda item: item["created_epoch"],
+    ):
+        lead_queues.setdefault(lead_write["lead_key"], []).append(lead_write)
+
+    def lead_write_done(lead_write, lead_id, lead_creation_message):
+        if complete_lead_write(
+            lead_write,
+            lead_id,
+            lead_creation_message,
+            dynamodb_client,
+            outbox_table,
+            leads_table,
+        ):
+            outbox_stats["sent"] += 1
+        else:
+            lead_queues.pop(lead_write["lead_key"], None)
+
+    def lead_write_failed(lead_write, error_message):
+        logger.info(f"lead write for session id {lead_write['session_id']} failed: {error_message}")
+        fail_lead_write(
+            lead_write,
+            error_message,
+            dynamodb_client,
+            outbox_table,
+            leads_table,
+            max_attempts,
+        )
+        outbox_stats["failed"] += 1
+        # later writes of this lead wait for the next run to keep their order
+        lead_queues.pop(lead_write["lead_key"], None)
+
+    while lead_queues:
+        if deadline is not None and time.time() > deadline:
+            logger.info("deadline reached while draining lead outbox")
+            break
+
+        round_lead_writes = [queue.pop(0) for queue in lead_queues.values()]
+        lead_queues = {key: queue for key, queue in lead_queues.items() if queue}
+
+        new_lead_writes = []
+        for lead_write in round_lead_writes:
+            user_details_dict = dict(lead_write["user_details"])
+            if lead_write.get("lead_id"):
+                # sent to salesforce before, only the dynamodb updates are left
+                lead_write_done(lead_write, lead_write["lead_id"], "successfully created")
+                continue
+
+            lead_id = lookup_lead_in_dedup_index(
+                user_details_dict, dynamodb_client, dedup_table
+            )
+            if lead_id is None:
+                new_lead_writes.append(lead_write)
+                continue
+
+            # Lead.update retries on its own, the digest is merged only once
+            try:
+                update_existing_lead(
+                    lead_id,
+                    user_details_dict,
+                    salesforce_object,
+                    lead_write["summary"],
+                    dynamodb_client,
+                    leads_table,
+                    lead_write["session_id"],
+                )
+            except Exception as e:
+                lead_write_failed(lead_write, f"Error in updating lead: {e}")
+                continue
+            record_lead_in_dedup_index(
+                lead_id, user_details_dict, dynamodb_client, dedup_table
+            )
+            lead_write_done(
+                lead_write,
+                lead_id,
+                f"Lead id {lead_id} found in dedup index. Only updating the summary.",
+            )
+
+        lead_results = create_leads_in_collections(
+            new_lead_writes,
+            salesforce_object,
+            dynamodb_client,
+            leads_table,
+            dedup_table,
+            deadline,
+            batch_size,
+        )
+        for lead_write, (lead_id, lead_creation_message, _) in zip(
+            new_lead_writes, lead_results
+        ):
+            if lead_id is not None:
+                lead_write_done(lead_write, lead_id, lead_creation_message)
+            else:
+                lead_write_failed(lead_write, lead_creation_message)
+
+    outbox_stats["pending"] = sum(len(queue) for queue in lead_queues.values())
+    return outbox_stats
 
 
 def check_session_id_and_status(session_id, table_name, dynamodb_client):
@@ -684,12 +2546,24 @@ def update_leads_table(
 ):
     try:
         table = dynamodb_client.Table(leads_table)
+        # the session stays in the pending lead index until it has a lead or runs out of attempts
+        if lead_id in (None, "None") and lead_creation_attempts < 4:
+            pending_expression = ", pending_status = :pending, pending_since = if_not_exists(pending_since, :new_epoch)"
+            pending_values = {":pending": PENDING_STATUS}
+        else:
+            pending_expression = " REMOVE pending_status, pending_since"
+            pending_values = {}
+        new_timestamp, new_epoch, new_day = get_lead_update_time()
         table.update_item(
             Key={"session_id": session_id},
-            UpdateExpression="SET user_details = :updated_user_details, lead_updated_at = :new_timestamp,summary = :new_summary,user_inputs = :new_user_inputs, lead_creation_attempts = :new_lead_creation_attempts, lead_id =:new_lead_id, lead_creation_status=:new_lead_creation_status, lead_creation_message=:new_lead_creation_message",
+            UpdateExpression="SET user_details = :updated_user_details, lead_updated_at = :new_timestamp, lead_updated_epoch = :new_epoch, lead_updated_day = :new_day,summary = :new_summary,user_inputs = :new_user_inputs, lead_creation_attempts = :new_lead_creation_attempts, lead_id =:new_lead_id, lead_creation_status=:new_lead_creation_status, lead_creation_message=:new_lead_creation_message"
+            + pending_expression,
             ExpressionAttributeValues={
+                **pending_values,
                 ":updated_user_details": user_details_dict,
-                ":new_timestamp": str(datetime.utcnow()),
+                ":new_timestamp": new_timestamp,
+                ":new_epoch": new_epoch,
+                ":new_day": new_day,
                 ":new_summary": summary,
                 ":new_user_inputs": user_inputs,
                 ":new_lead_creation_attempts": lead_creation_attempts,
@@ -0,0 +1,192 @@
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ReadTimeoutError
+
+from logger_config import logger
+
+
+def shard_of(session_id, shard_count):
+    """Shard of a session id, stable across invocations and processes."""
+    if shard_count <= 1:
+        return 0
+    digest = hashlib.md5(session_id.encode("utf-8")).hexdigest()
+    return int(digest[:8], 16) % shard_count
+
+
+def get_shard(event):
+    """Shard and shard count of a worker invocation, (0, 1) for an unsharded run."""
+    if isinstance(event, dict) and "shard" in event:
+        return int(event["shard"]), int(event.get("shard_count", 1))
+    return 0, 1
+
+
+def is_orchestrator_event(event, shard_count):
+    """A run with sharding enabled that is not itself a shard fans the work out."""
+    return shard_count > 1 and not (isinstance(event, dict) and "shard" in event)
+
+
+def shard_response_stats(response):
+    body = response.get("body")
+    try:
+        body = json.loads(body) if isinstance(body, str) else body or {}
+    except ValueError:
+        body = {"message": body}
+    return {
+        "statusCode": response.get("statusCode"),
+        "message": body.get("message"),
+        "results": body.get("results", {}),
+        "completed": body.get("completed", False),
+    }
+
+
+def timed_out_shard_stats(seconds):
+    """Statistics of a shard without a response by the deadline, counted as not completed."""
+    return {
+        "statusCode": None,
+        "message": "shard did not respond before the deadline",
+        "results": {},
+        "completed": False,
+        "timed_out": True,
+        "seconds": round(seconds, 3),
+    }
+
+
+def run_local_shard(shard_event):
+    """Runs one shard in a pool process, with its own clients."""
+    from lambda_function import lambda_handler
+
+    started_at = time.time()
+    try:
+        response = lambda_handler(shard_event, None)
+    except Exception as e:
+        response = {"statusCode": 500, "body": json.dumps({"message": str(e)})}
+    return dict(shard_response_stats(response), seconds=round(time.time() - started_at, 3))
+
+
+class LocalShardInvoker:
+    """Runs the shards in a local process pool, for tests and local runs."""
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+
+    def map(self, shard_events, deadline=None):
+        started_at = time.time()
+        executor = ProcessPoolExecutor(max_workers=self.max_workers or len(shard_events))
+        try:
+            futures = [
+                executor.submit(run_local_shard, shard_event)
+                for shard_event in shard_events
+            ]
+            wait(
+                futures,
+                timeout=None if deadline is None else max(0, deadline - time.time()),
+            )
+            return [
+                future.result()
+                if future.done()
+                else timed_out_shard_stats(time.time() - started_at)
+                for future in futures
+            ]
+        finally:
+            # shards still running are left behind, they stop at their own deadline
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+class LambdaShardInvoker:
+    """Runs every shard as its own synchronous invocation of the lambda function."""
+
+    def __init__(self, function_name, region_name=None):
+        self.function_name = function_name
+        self.region_name = region_name
+
+    def get_lambda_client(self, deadline=None):
+        # wait for a shard response until the deadline, or up to the lambda timeout
+        read_timeout = 900 if deadline is None else max(1, deadline - time.time())
+        return boto3.client(
+            "lambda",
+            region_name=self.region_name,
+            config=Config(read_timeout=read_timeout, retries={"max_attempts": 0}),
+        )
+
+    def invoke(self, lambda_client, shard_event):
+        started_at = time.time()
+        try:
+            response = lambda_client.invoke(
+                FunctionName=self.function_name,
+                InvocationType="RequestResponse",
+                Payload=json.dumps(shard_event),
+            )
+            response = json.loads(response["Payload"].read() or b"{}")
+        except ReadTimeoutError:
+            return timed_out_shard_stats(time.time() - started_at)
+        except Exception as e:
+            response = {"statusCode": 500, "body": json.dumps({"message": str(e)})}
+        return dict(
+            shard_response_stats(response), seconds=round(time.time() - started_at, 3)
+        )
+
+    def map(self, shard_events, deadline=None):
+        lambda_client = self.get_lambda_client(deadline)
+        with ThreadPoolExecutor(max_workers=len(shard_events)) as executor:
+            return list(
+                executor.map(
+                    lambda shard_event: self.invoke(lambda_client, shard_event),
+                    shard_events,
+                )
+            )
+
+
+def get_shard_invoker(invoker_name, context):
+    """Shard invoker set by the environment, lambda by default."""
+    if invoker_name == "local":
+        return LocalShardInvoker()
+    function_name = os.environ.get("shard_function_name") or (
+        context.invoked_function_arn if context is not None else None
+    )
+    return LambdaShardInvoker(function_name)
+
+
+def run_shards(invoker, event, shard_count, deadline=None):
+    """
+    Dispatches the shards of a batch run in parallel and collects their statistics.
+
+    Args:
+        invoker: LambdaShardInvoker or LocalShardInvoker.
+        event (Dict): Event of the orchestrator run, passed on to every shard.
+        shard_count (int): Number of shards the sessions are split into.
+        deadline (float): Epoch seconds by which the shards have to respond, passed on
+            to every shard. A shard without a response by then counts as not completed.
+
+    Returns:
+        Dict: Statistics of every shard, the summed results and the wall clock time.
+    """
+    shard_events = [
+        dict(event if isinstance(event, dict) else {}, shard=shard, shard_count=shard_count)
+        for shard in range(shard_count)
+    ]
+    if deadline is not None:
+        for shard_event in shard_events:
+            shard_event["deadline"] = deadline
+    started_at = time.time()
+    shard_stats = invoker.map(shard_events, deadline)
+
+    results = {}
+    for shard, stats in enumerate(shard_stats):
+        stats["shard"] = shard
+        for result, count in stats["results"].items():
+            results[result] = results.get(result, 0) + count
+    summary = {
+        "message": f"ran {shard_count} shards",
+        "results": results,
+        "completed": all(stats["completed"] for stats in shard_stats),
+        "seconds": round(time.time() - started_at, 3),
+        "shards": shard_stats,
+    }
+    logger.info(f"shard stats are {summary}")
+    return summary
@@ -20,6 +20,13 @@ from simple_salesforce import (
 
 # importing functions
 from utils import *
+from batch_orchestrator import (
+    get_shard,
+    get_shard_invoker,
+    is_orchestrator_event,
+    run_shards,
+    shard_of,
+)
 from logger_config import logger
 
 
@@ -35,6 +42,24 @@ def lambda_handler(event, context) -> dict:
         dict: Dictionary containing the status code and result message.
     """
     try:
+        # fan the sessions out to parallel shard invocations when sharding is enabled
+        batch_shard_count = int(os.environ.get("batch_shard_count", "1"))
+        if is_orchestrator_event(event, batch_shard_count):
+            # shards answer before this run times out, unfinished ones count as incomplete
+            shard_stats = run_shards(
+                get_shard_invoker(os.environ.get("shard_invoker", "lambda"), context),
+                event,
+                batch_shard_count,
+                get_deadline(context, int(os.environ.get("shard_margin_seconds", "30"))),
+            )
+            return {"statusCode": 200, "body": json.dumps(shard_stats)}
+
+        # every shard keeps its own checkpoint and works on its own sessions
+        shard, shard_count = get_shard(event)
+        job_name = "batch_job_lead_update"
+        if shard_count > 1:
+            job_name = f"{job_name}-shard-{shard}"
+
         # Extract Salesforce details from Secrets Manager
         secret_name = os.environ["secret_name"]
         secret_region_name = os.environ["secret_region_name"]
@@ -58,6 +83,7 @@ def lambda_handler(event, context) -> dict:
         model_id = os.environ["model_id"]
         chat_history_table = os.environ["chat_history_table"]
         leads_table = os.environ["leads_table_name"]
+        lead_dedup_table = os.environ.get("lead_dedup_table_name")
 
         # Extract region names
         bedrock_region_name = os.environ["bedrock_region_name"]
@@ -67,6 +93,14 @@ def lambda_handler(event, context) -> dict:
         guardrail_id = os.environ["guardrail_id"]
         guardrail_version = os.environ["guardrail_version"]
 
+        # Extraction mode, json uses tool output and text uses comma separated output
+        extraction_mode = os.environ.get("extraction_mode", "json")
+
+        # Extract user details from new user inputs only when enabled
+        incremental_extraction = (
+            os.environ.get("incremental_extraction", "true").lower() == "true"
+        )
+
         # Getting Bedrock client
         bedrock_runtime = get_bedrock_client(bedrock_region_name)
         if bedrock_runtime is None:
@@ -104,21 +138,76 @@ def lambda_handler(event, context) -> dict:
                 "body": json.dumps({"message": error_message}),
             }
 
+        # Load user details extraction prompts, once for all sessions
+        try:
+            user_details_extraction_prompt = get_prompt(
+                EXTRACTION_PROMPT_FILES[extraction_mode]
+            )
+            incremental_extraction_prompt = get_prompt(
+                "incremental_extraction_instructions.txt"
+            )
+        except Exception as e:
+            error_message = f"Error reading extraction instructions: {e}"
+            logger.info(error_message)
+            return {"statusCode": 500, "body": json.dumps({"message": error_message})}
+
+        # Resume state of an earlier run that stopped before its deadline
+        checkpoint = BatchCheckpoint(
+            dynamodb_client,
+            os.environ.get("batch_checkpoint_table_name"),
+            job_name,
+        )
+        recent_session_ids = list(
+            checkpoint.unprocessed(
+                session_id
+                for session_id in recent_session_ids
+                if shard_of(session_id, shard_count) == shard
+            )
+        )
+
+        # Stop taking new sessions early enough to save the checkpoint
+        stop_at = get_deadline(
+            context, int(os.environ.get("batch_stop_seconds", "60")), event
+        )
+        stopped = False
+        processed_sessions = 0
+        unfetched_session_ids = set()
+
         # Process recent session IDs
         if len(recent_session_ids) > 0:
-            for session_id in recent_session_ids:
+            # Prefetch chat histories and lead rows of up to 100 sessions per request
+            prefetched_sessions = prefetch_session_items(
+                dynamodb_client,
+                recent_session_ids,
+                {
+                    chat_history_table: ["session_id", "history", "updated_at"],
+                    leads_table: [
+                        "session_id",
+                        "user_details",
+                        "lead_id",
+                        "user_inputs",
+                        "lead_update_attempts",
+                    ],
+                },
+                unfetched_session_ids=unfetched_session_ids,
+            )
+            for session_id, session_items in prefetched_sessions:
+                if stop_at is not None and time.time() > stop_at:
+                    stopped = True
+                    break
                 logger.info(f"session_id is {session_id}")
+                checkpoint.mark_processed(session_id)
+                processed_sessions += 1
                 try:
                     # Check if chat history updated in last number of  hours
                     hours_filter = 48 # In hours
-                    recent_chat_history_flag = is_recent_chat_history(
-                        dynamodb_client, chat_history_table, session_id, hours_filter
+                    chat_history_item = session_items[chat_history_table]
+                    recent_chat_history_flag = is_recent_chat_history_item(
+                        chat_history_item, hours_filter
                     )
                     if recent_chat_history_flag:
                         try:
-                            chat_history = get_session_history(
-                                session_id, chat_history_table, dynamodb_client
-                            )
+                            chat_history = chat_history_item.get("history", [])
                             user_inputs = [
                                 entry["content"][0]["text"]
                                 for entry in chat_history
@@ -132,8 +221,8 @@ def lambda_handler(event, context) -> dict:
                                 lead_id,
                                 previous_user_inputs,
                                 lead_update_attempts,
-                            ) = retrieve_previous_user_info(
-                                dynamodb_client, leads_table, session_id
+                            ) = previous_user_info_from_item(
+                                session_items[leads_table]
                             )
                             logger.info(
                                 f"previous_user_details is {previous_user_details}"
@@ -152,29 +241,40 @@ def lambda_handler(event, context) -> dict:
                             logger.info(f"updated_list is {updated_list}")
 
                             if (len(updated_list) > 0) and (lead_update_attempts < 4):
-                                # Load user details extraction prompt
-                                try:
-                                    with open("prompts/extraction_instructions.txt") as f:
-                                        user_details_extraction_prompt = f.read()
-                                except Exception as e:
-                                    error_message = f"Error reading extraction instructions: {e}"
-                                    logger.info(error_message)
-                                    return {"statusCode": 500, "body": json.dumps({"message": error_message})}
-                                            
-                                # Extracting user details and parsing them
-                                user_details = extract_user_details(
-                                    user_inputs,
-                                    user_details_extraction_prompt,
-                                    model_id,
-                                    bedrock_runtime,
+                                # Extract only from new user inputs when previous details are available
+                                user_details_dict = None
+                                new_user_inputs = get_new_user_inputs(
+                                    previous_user_inputs, user_inputs
                                 )
+                                if (
+                                    incremental_extraction
+                                    and previous_user_details
+                                    and new_user_inputs
+                                ):
+                                    user_details_dict = extract_user_details_incremental(
+                                        previous_user_details,
+                                        new_user_inputs,
+                                        incremental_extraction_prompt,
+                                        model_id,
+                                        bedrock_runtime,
+                                    )
 
-                                if user_details is None:
-                                    error_message = f"Unable to extract user details for session ID {session_id}"
-                                    logger.info(error_message)
-                                    continue  # Skip to the next session ID if user details extraction fails
+                                if user_details_dict is None:
+                                    logger.info("running full user details extraction")
+                                    # Extracting user details and parsing them
+                                    user_details_dict = extract_user_details_dict(
+                                        user_inputs,
+                                        user_details_extraction_prompt,
+                                        model_id,
+                                        bedrock_runtime,
+                                        extraction_mode,
+                                    )
+
+                                    if user_details_dict is None:
+                                        error_message = f"Unable to extract user details for session ID {session_id}"
+                                        logger.info(error_message)
+                                        continue  # Skip to the next session ID if user details extraction fails
 
-                                user_details_dict = parse_user_details(user_details)
                                 user_details_dict = validate_user_info(
                                     user_details_dict
                                 )
@@ -203,10 +303,9 @@ def lambda_handler(event, context) -> dict:
 
                                     if len(updated_dict) > 0:
                                         try:
-                                            with open(
-                                                "prompts/summary_instructions.txt"
-                                            ) as f:
-                                                summary_extraction_prompt = f.read()
+                                            summary_extraction_prompt = get_prompt(
+                                                "summary_instructions.txt"
+                                            )
 
                                             conversation_history_list = format_conversation_history(
                                                 chat_history
@@ -228,8 +327,9 @@ def lambda_handler(event, context) -> dict:
                                                 user_details_dict,
                                                 summary,
                                                 session_id,
-                                                dynamodb_client, 
+                                                dynamodb_client,
                                                 leads_table,
+                                                lead_dedup_table,
                                             )
                                             logger.info(
                                                 f"update_lead_flag is {update_lead_flag}"
@@ -264,9 +364,33 @@ def lambda_handler(event, context) -> dict:
                     logger.info(
                         f"Error in getting recent chat history for session id {session_id}: {e}"
                     )
+
+        # Sessions dynamodb did not return are not processed, the next run retries them
+        if unfetched_session_ids:
+            logger.info(f"{len(unfetched_session_ids)} sessions were not fetched")
+            stopped = True
+
+        # Save the processed sessions and start the next run, or forget a finished run
+        if stopped:
+            # a run without a saved checkpoint would start over, leave it to the schedule
+            if checkpoint.save():
+                reinvoke_batch_job(
+                    context, event, int(os.environ.get("batch_max_reinvokes", "0"))
+                )
+        else:
+            checkpoint.clear()
         return {
             "statusCode": 200,
-            "body": json.dumps({"message": "successfully updated lead ids"}),
+            "body": json.dumps(
+                {
+                    "message": "successfully updated lead ids",
+                    "results": {
+                        "processed": processed_sessions,
+                        "unfetched": len(unfetched_session_ids),
+                    },
+                    "completed": not stopped,
+                }
+            ),
         }
     except Exception as e:
         error_message = f"Error during lead update process: {e}"
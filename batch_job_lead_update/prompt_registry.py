@@ -0,0 +1,68 @@
+import hashlib
+import os
+import re
+
+from logger_config import logger
+
+# directory of the prompt templates, next to this module
+PROMPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompts")
+
+# placeholders filled at render time, any other braces in the prompts are kept as they are
+PLACEHOLDER_PATTERN = re.compile(
+    r"\{(input_query|previous_details|conversation_text|current_datetime|session_id)\}"
+)
+
+
+class PromptTemplate:
+    """Prompt template split once into literal text and placeholder names."""
+
+    def __init__(self, name, text):
+        self.name = name
+        self.text = text
+        # short content hash, changes whenever the prompt file changes
+        self.version = hashlib.sha256(text.encode("utf-8")).hexdigest()[:12]
+        # even positions hold literal text and odd positions hold placeholder names
+        self.parts = PLACEHOLDER_PATTERN.split(text)
+        self.placeholders = set(self.parts[1::2])
+
+    def render(self, **values):
+        """Fills every placeholder in a single pass over the pre split template."""
+        missing = self.placeholders - values.keys()
+        if missing:
+            raise KeyError(f"missing values {sorted(missing)} for prompt {self.name}")
+        parts = list(self.parts)
+        parts[1::2] = [str(values[name]) for name in self.parts[1::2]]
+        return "".join(parts)
+
+
+# templates loaded in this process, keyed by file name
+PROMPT_TEMPLATES = {}
+
+
+def get_prompt(file_name):
+    """Returns the template of a prompt file, reading the file only the first time."""
+    template = PROMPT_TEMPLATES.get(file_name)
+    if template is None:
+        with open(os.path.join(PROMPTS_DIR, file_name)) as f:
+            template = PromptTemplate(file_name, f.read())
+        PROMPT_TEMPLATES[file_name] = template
+    return template
+
+
+def get_prompt_versions():
+    """Version hash of every loaded prompt, for logs and cache keys."""
+    return {name: template.version for name, template in PROMPT_TEMPLATES.items()}
+
+
+def load_prompts():
+    """Loads every prompt file once, when the lambda container starts."""
+    try:
+        for file_name in sorted(os.listdir(PROMPTS_DIR)):
+            if file_name.endswith(".txt"):
+                get_prompt(file_name)
+        logger.info(f"prompt versions are {get_prompt_versions()}")
+    except Exception as e:
+        logger.info(f"Exception {e} occured while loading prompts")
+
+
+load_prompts()
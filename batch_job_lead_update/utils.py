@@ -1,25 +1,33 @@
 # basic packages
 import boto3
+from botocore.exceptions import ClientError
+from boto3.dynamodb.conditions import Key
 from typing import Dict
 import random, time, os
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from random import randint
 import json
 from dotenv import load_dotenv
 from io import StringIO
 from typing import Dict, Any, Optional
 import configparser
+import itertools
+import uuid
+import threading
 import re
 
 # salesforce packages
 from simple_salesforce import (
     Salesforce,
+    SalesforceError,
     SalesforceMalformedRequest,
     SalesforceResourceNotFound,
 )
+import requests
 
 # logging
 from logger_config import logger
+from prompt_registry import get_prompt, get_prompt_versions
 
 from validate_user_details import ValidateUserDetails
 
@@ -45,14 +53,18 @@ def get_secret(secret_name, region_name):
         return None
 
 
+# Timestamps like '2024-10-03 13:31:21.824414' are written with datetime.utcnow()
+def parse_utc_timestamp(value):
+    return datetime.fromisoformat(value).replace(tzinfo=timezone.utc)
+
+
 # Convert 'lead_updated_at' to a proper datetime object
 def is_recent_lead(lead_updated_at, hours_filter):
     try:
-        # Assuming 'lead_updated_at' is in the format '2024-10-03 13:31:21.824414'
-        updated_at = datetime.strptime(lead_updated_at, "%Y-%m-%d %H:%M:%S.%f")
+        updated_at = parse_utc_timestamp(lead_updated_at)
 
         # Get the current time and check if the lead was updated in the last 48 hours
-        now = datetime.now()
+        now = datetime.now(timezone.utc)
         time_difference = now - updated_at
 
         return time_difference <= timedelta(hours=hours_filter)
@@ -62,21 +74,79 @@ def is_recent_lead(lead_updated_at, hours_filter):
         return False
 
 
-# Extract session IDs where 'lead_updated_at' is within the last 48 hours
+# Day buckets of lead_updated_day from the cutoff up to now, oldest first
+def get_day_buckets(cutoff_epoch, now_epoch):
+    day = datetime.fromtimestamp(cutoff_epoch / 1000, timezone.utc).date()
+    last_day = datetime.fromtimestamp(now_epoch / 1000, timezone.utc).date()
+    day_buckets = []
+    while day <= last_day:
+        day_buckets.append(day.strftime("%Y-%m-%d"))
+        day += timedelta(days=1)
+    return day_buckets
+
+
+# Session ids with a lead updated after the cutoff, read from the day bucket index.
+# Only the buckets in the window are queried, sorted by lead_updated_epoch.
+def query_recent_session_ids(
+    dynamodb_client, leads_table, cutoff_epoch, index_name=None
+):
+    table = dynamodb_client.Table(leads_table)
+    recent_session_ids = []
+    for day in get_day_buckets(cutoff_epoch, get_epoch_millis()):
+        query_kwargs = {
+            "IndexName": index_name or LEAD_UPDATED_DAY_INDEX_NAME,
+            "KeyConditionExpression": Key("lead_updated_day").eq(day)
+            & Key("lead_updated_epoch").gte(cutoff_epoch),
+            "ProjectionExpression": "session_id, lead_id",
+        }
+        while True:
+            response = table.query(**query_kwargs)
+            recent_session_ids.extend(
+                item["session_id"]
+                for item in response["Items"]
+                if item.get("lead_id") != "None"
+            )
+            if "LastEvaluatedKey" not in response:
+                break
+            query_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    return recent_session_ids
+
+
+# Same result from a scan of the whole leads table, when the index is not available
+def scan_recent_session_ids(dynamodb_client, leads_table, cutoff_epoch, hours_filter):
+    table = dynamodb_client.Table(leads_table)
+    scan_kwargs = {
+        "ProjectionExpression": "session_id, lead_id, lead_updated_at, lead_updated_epoch"
+    }
+    recent_session_ids = []
+    while True:
+        response = table.scan(**scan_kwargs)
+        for item in response["Items"]:
+            if item.get("lead_id") == "None":
+                continue
+            if "lead_updated_epoch" in item:
+                recent = item["lead_updated_epoch"] >= cutoff_epoch
+            else:
+                recent = is_recent_lead(item.get("lead_updated_at"), hours_filter)
+            if recent:
+                recent_session_ids.append(item["session_id"])
+        if "LastEvaluatedKey" not in response:
+            break
+        scan_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    return recent_session_ids
+
+
+# Extract session IDs where the lead was updated within the last hours_filter hours
 def extract_recent_session_ids(dynamodb_client, leads_table, hours_filter):
+    cutoff_epoch = get_epoch_millis() - hours_filter * 3600 * 1000
     try:
-        table = dynamodb_client.Table(leads_table)
-        # Scan the table and get all items
-        response = table.scan()
-
-        # Filter out session IDs updated in the last 48 hours
-        recent_session_ids = [
-            item["session_id"]
-            for item in response["Items"]
-            if (is_recent_lead(item.get("lead_updated_at"), hours_filter))
-            and (item.get("lead_id") != "None")
-        ]
-        return recent_session_ids
+        return query_recent_session_ids(dynamodb_client, leads_table, cutoff_epoch)
+    except Exception as e:
+        logger.info(f"Error querying lead updated day index: {e}, scanning leads table")
+    try:
+        return scan_recent_session_ids(
+            dynamodb_client, leads_table, cutoff_epoch, hours_filter
+        )
     except Exception as e:
         logger.info(f"Error extracting recent session IDs: {e}")
         return None
@@ -89,13 +159,20 @@ def is_recent_chat_history(
     try:
         table = dynamodb_client.Table(chat_history_table_name)
         response = table.get_item(Key={"session_id": session_id})
-        last_updated_at = response["Item"]["updated_at"]
+        return is_recent_chat_history_item(response.get("Item"), hours_filter)
+    except Exception as e:
+        logger.info(f"Error at checking whether recent chat history or not: {e}")
+        return False
 
-        # Assuming 'lead_updated_at' is in the format '2024-10-03 13:31:21.824414'
-        updated_at = datetime.strptime(last_updated_at, "%Y-%m-%d %H:%M:%S.%f")
+
+# Same check for a chat history row that is already read
+def is_recent_chat_history_item(chat_history_item, hours_filter):
+    try:
+        last_updated_at = chat_history_item["updated_at"]
+        updated_at = parse_utc_timestamp(last_updated_at)
 
         # Get the current time and check if the lead was updated in the last 48 hours
-        now = datetime.now()
+        now = datetime.now(timezone.utc)
         time_difference = now - updated_at
 
         return time_difference <= timedelta(hours=hours_filter)
@@ -104,14 +181,294 @@ def is_recent_chat_history(
         return False
 
 
+# Read items by session id with batch_get_item, 100 keys per call. Keys dynamodb leaves
+# unprocessed are requested again with a growing delay, the ones still unprocessed after
+# max_attempts are added to unfetched_session_ids.
+def batch_get_items(
+    dynamodb_client,
+    table_name,
+    session_ids,
+    attributes=None,
+    max_attempts=5,
+    unfetched_session_ids=None,
+):
+    items = {}
+    session_ids = list(dict.fromkeys(session_ids))
+    for start in range(0, len(session_ids), 100):
+        table_request = {
+            "Keys": [
+                {"session_id": session_id}
+                for session_id in session_ids[start : start + 100]
+            ]
+        }
+        if attributes:
+            table_request["ProjectionExpression"] = ", ".join(
+                f"#attribute{number}" for number in range(len(attributes))
+            )
+            table_request["ExpressionAttributeNames"] = {
+                f"#attribute{number}": attribute
+                for number, attribute in enumerate(attributes)
+            }
+        request_items = {table_name: table_request}
+        attempt = 0
+        while request_items:
+            response = dynamodb_client.batch_get_item(RequestItems=request_items)
+            for item in response["Responses"].get(table_name, []):
+                items[item["session_id"]] = item
+            request_items = response.get("UnprocessedKeys") or {}
+            if request_items:
+                attempt += 1
+                if attempt >= max_attempts:
+                    unfetched_keys = request_items[table_name]["Keys"]
+                    logger.info(
+                        f"{len(unfetched_keys)} unprocessed keys left in {table_name} after {attempt} attempts"
+                    )
+                    if unfetched_session_ids is not None:
+                        unfetched_session_ids.update(
+                            key["session_id"] for key in unfetched_keys
+                        )
+                    break
+                time.sleep(min(2, 0.05 * 2**attempt))
+    return items
+
+
+# Prefetch the rows of a batch of sessions from several tables before they are processed.
+# Yields (session_id, {table_name: item or None}) in the order of the session ids. Sessions
+# with rows dynamodb did not return are not yielded but added to unfetched_session_ids,
+# so they are not mistaken for sessions without rows.
+def prefetch_session_items(
+    dynamodb_client,
+    session_ids,
+    table_attributes,
+    batch_size=100,
+    unfetched_session_ids=None,
+):
+    session_ids = iter(session_ids)
+    while True:
+        batch = list(itertools.islice(session_ids, batch_size))
+        if not batch:
+            return
+        batch_unfetched_session_ids = set()
+        fetched_items = {
+            table_name: batch_get_items(
+                dynamodb_client,
+                table_name,
+                batch,
+                attributes,
+                unfetched_session_ids=batch_unfetched_session_ids,
+            )
+            for table_name, attributes in table_attributes.items()
+        }
+        if unfetched_session_ids is not None:
+            unfetched_session_ids |= batch_unfetched_session_ids
+        for session_id in batch:
+            if session_id in batch_unfetched_session_ids:
+                continue
+            yield session_id, {
+                table_name: items.get(session_id)
+                for table_name, items in fetched_items.items()
+            }
+
+
+# Deadline as epoch seconds from the lambda context, keeping some time to save results
+# A shard also stops by the deadline its orchestrator put in the event, whichever is first
+def get_deadline(context, reserve_seconds=10, event=None):
+    deadlines = []
+    if isinstance(event, dict) and event.get("deadline") is not None:
+        deadlines.append(float(event["deadline"]) - reserve_seconds)
+    if context is not None:
+        try:
+            deadlines.append(
+                time.time() + context.get_remaining_time_in_millis() / 1000 - reserve_seconds
+            )
+        except Exception as e:
+            logger.info(f"Exception {e} occured while reading remaining lambda time")
+    return min(deadlines) if deadlines else None
+
+
+class BatchCheckpoint:
+    """Read cursor and processed sessions of an unfinished batch job run.
+
+    The cursor is kept in the checkpoint table under the job name, and every processed
+    session in an item of its own keyed by job name, run id and session id, so the
+    checkpoint stays small however many sessions a run processes. The next invocation
+    skips the marked sessions and continues from the cursor. Without a checkpoint
+    table nothing is saved and every run starts over.
+    """
+
+    def __init__(self, dynamodb_client, table_name, job_name):
+        self.dynamodb_client = dynamodb_client
+        self.table = dynamodb_client.Table(table_name) if table_name else None
+        self.job_name = job_name
+        self.run_id = uuid.uuid4().hex
+        self.resumed = False
+        self.processed_count = 0
+        # processed by this invocation, and found marked by an earlier one
+        self.processed_session_ids = set()
+        self.earlier_processed_session_ids = set()
+        self.cursor = None
+        self.lock = threading.Lock()
+        if self.table is None:
+            return
+        try:
+            item = self.table.get_item(Key={"job_name": job_name}).get("Item")
+            if item and item.get("run_id"):
+                self.resumed = True
+                self.run_id = item["run_id"]
+                self.processed_count = int(item.get("processed_count", 0))
+                self.cursor = item.get("cursor")
+                logger.info(
+                    f"resuming {job_name} after {self.processed_count} processed sessions"
+                )
+        except Exception as e:
+            logger.info(f"Exception {e} occured while reading batch checkpoint")
+
+    def marker_key(self, session_id):
+        return f"{self.job_name}#{self.run_id}#{session_id}"
+
+    def get_processed_markers(self, session_ids, max_attempts=5):
+        """Session ids of the batch marked as processed by an earlier invocation."""
+        prefix_length = len(self.marker_key(""))
+        request_items = {
+            self.table.name: {
+                "Keys": [
+                    {"job_name": self.marker_key(session_id)}
+                    for session_id in dict.fromkeys(session_ids)
+                ],
+                "ProjectionExpression": "job_name",
+            }
+        }
+        processed_session_ids = set()
+        attempt = 0
+        while request_items:
+            response = self.dynamodb_client.batch_get_item(RequestItems=request_items)
+            for item in response["Responses"].get(self.table.name, []):
+                processed_session_ids.add(item["job_name"][prefix_length:])
+            request_items = response.get("UnprocessedKeys") or {}
+            if request_items:
+                attempt += 1
+                if attempt >= max_attempts:
+                    logger.info(f"unprocessed checkpoint keys left after {attempt} attempts")
+                    break
+                time.sleep(min(2, 0.05 * 2**attempt))
+        return processed_session_ids
+
+    def unprocessed(self, session_ids, batch_size=100):
+        """Yields the session ids not processed by the run, looked up 100 at a time."""
+        session_ids = iter(session_ids)
+        if not self.resumed:
+            yield from session_ids
+            return
+        for batch in iter(lambda: list(itertools.islice(session_ids, batch_size)), []):
+            try:
+                processed_session_ids = self.get_processed_markers(batch)
+            except Exception as e:
+                logger.info(f"Exception {e} occured while reading processed sessions")
+                processed_session_ids = set()
+            self.earlier_processed_session_ids |= processed_session_ids
+            for session_id in batch:
+                if session_id not in processed_session_ids:
+                    yield session_id
+
+    def is_processed(self, session_id):
+        return (
+            session_id in self.processed_session_ids
+            or session_id in self.earlier_processed_session_ids
+        )
+
+    def mark_processed(self, session_id):
+        with self.lock:
+            self.processed_session_ids.add(session_id)
+
+    def save(self, cursor=None):
+        """Saves the processed markers and then the cursor. Returns False when not saved."""
+        if self.table is None:
+            return False
+        try:
+            with self.lock:
+                session_ids = set(self.processed_session_ids)
+            # old checkpoints of abandoned runs are removed by the table ttl
+            expires_at = int(time.time()) + 2 * 24 * 3600
+            with self.table.batch_writer() as batch:
+                for session_id in session_ids:
+                    batch.put_item(
+                        Item={
+                            "job_name": self.marker_key(session_id),
+                            "expires_at": expires_at,
+                        }
+                    )
+            self.table.put_item(
+                Item={
+                    "job_name": self.job_name,
+                    "run_id": self.run_id,
+                    "processed_count": self.processed_count + len(session_ids),
+                    "cursor": cursor,
+                    "updated_at": str(datetime.utcnow()),
+                    "expires_at": expires_at,
+                }
+            )
+            logger.info(
+                f"saved checkpoint of {self.job_name} with {len(session_ids)} processed sessions"
+            )
+            return True
+        except Exception as e:
+            logger.info(f"Exception {e} occured while saving batch checkpoint")
+            return False
+
+    def clear(self):
+        if self.table is None:
+            return
+        try:
+            # markers of the run are left to the table ttl, a new run has a new run id
+            self.table.delete_item(Key={"job_name": self.job_name})
+        except Exception as e:
+            logger.info(f"Exception {e} occured while clearing batch checkpoint")
+
+
+# Start the next run of the batch job asynchronously, so a large backlog is drained
+# over several invocations. The chain stops after max_reinvokes runs.
+def reinvoke_batch_job(context, event, max_reinvokes):
+    reinvoke_count = 0
+    if isinstance(event, dict):
+        reinvoke_count = int(event.get("reinvoke_count", 0))
+    if context is None or reinvoke_count >= max_reinvokes:
+        logger.info(f"not reinvoking batch job, reinvoke count is {reinvoke_count}")
+        return False
+    payload = {"reinvoke_count": reinvoke_count + 1}
+    # a shard keeps working on its own part of the sessions
+    if isinstance(event, dict) and "shard" in event:
+        payload.update(shard=event["shard"], shard_count=event.get("shard_count", 1))
+    try:
+        lambda_client = boto3.client("lambda")
+        lambda_client.invoke(
+            FunctionName=context.invoked_function_arn,
+            InvocationType="Event",
+            Payload=json.dumps(payload),
+        )
+        logger.info(f"reinvoked batch job, reinvoke count is {reinvoke_count + 1}")
+        return True
+    except Exception as e:
+        logger.info(f"Exception {e} occured while reinvoking batch job")
+        return False
+
+
 def retrieve_previous_user_info(dynamodb_client, leads_table, session_id):
     try:
         table = dynamodb_client.Table(leads_table)
         response = table.get_item(Key={"session_id": session_id})
-        previous_user_data = response["Item"]["user_details"]
-        lead_id = response["Item"]["lead_id"]
-        previous_user_inputs = response["Item"]["user_inputs"]
-        lead_update_attempts = response["Item"]["lead_update_attempts"]
+        return previous_user_info_from_item(response.get("Item"))
+    except Exception as e:
+        logger.info(f"Error in getting previous user data: {e}")
+        return None, None, None, 0
+
+
+# Previous user details of a leads table row that is already read
+def previous_user_info_from_item(lead_item):
+    try:
+        previous_user_data = lead_item["user_details"]
+        lead_id = lead_item["lead_id"]
+        previous_user_inputs = lead_item["user_inputs"]
+        lead_update_attempts = lead_item["lead_update_attempts"]
         return previous_user_data, lead_id, previous_user_inputs, lead_update_attempts
     except Exception as e:
         logger.info(f"Error in getting previous user data: {e}")
@@ -141,64 +498,500 @@ def find_updated_keys_with_values(dict_old, dict_current):
         return {}
 
 
-# Function to get session ids and summaries for a particular lead_id
-def get_summaries_for_lead(lead_id, current_session_id, dynamodb_client, leads_table):
+# GSI on lead_id sorted by lead_updated_epoch, used to get the latest sessions of a lead
+LEAD_ID_INDEX_NAME = os.environ.get(
+    "lead_id_index_name", "lead_id-lead_updated_epoch-index"
+)
+
+
+# epoch time in milliseconds stored next to the string timestamps for indexed queries
+def get_epoch_millis():
+    return int(time.time() * 1000)
+
+
+# utc timestamp string, epoch millis and day bucket of the same instant, written together
+# so the day index and the epoch sort key always agree
+def get_lead_update_time():
+    now = datetime.now(timezone.utc)
+    return (
+        str(now.replace(tzinfo=None)),
+        int(now.timestamp() * 1000),
+        now.strftime("%Y-%m-%d"),
+    )
+
+
+# Create the lead_id index on leads table if it is not there already
+def create_lead_id_index(dynamodb_client, leads_table, index_name=LEAD_ID_INDEX_NAME):
+    try:
+        client = dynamodb_client.meta.client
+        table_description = client.describe_table(TableName=leads_table)["Table"]
+        existing_indexes = [
+            index["IndexName"]
+            for index in table_description.get("GlobalSecondaryIndexes", [])
+        ]
+        if index_name in existing_indexes:
+            logger.info(f"index {index_name} already exists on {leads_table}")
+            return True
+
+        index_definition = {
+            "IndexName": index_name,
+            "KeySchema": [
+                {"AttributeName": "lead_id", "KeyType": "HASH"},
+                {"AttributeName": "lead_updated_epoch", "KeyType": "RANGE"},
+            ],
+            "Projection": {
+                "ProjectionType": "INCLUDE",
+                "NonKeyAttributes": ["summary"],
+            },
+        }
+        billing_mode = table_description.get("BillingModeSummary", {}).get(
+            "BillingMode", "PROVISIONED"
+        )
+        if billing_mode == "PROVISIONED":
+            throughput = table_description["ProvisionedThroughput"]
+            index_definition["ProvisionedThroughput"] = {
+                "ReadCapacityUnits": throughput["ReadCapacityUnits"],
+                "WriteCapacityUnits": throughput["WriteCapacityUnits"],
+            }
+
+        client.update_table(
+            TableName=leads_table,
+            AttributeDefinitions=[
+                {"AttributeName": "lead_id", "AttributeType": "S"},
+                {"AttributeName": "lead_updated_epoch", "AttributeType": "N"},
+            ],
+            GlobalSecondaryIndexUpdates=[{"Create": index_definition}],
+        )
+        logger.info(f"creating index {index_name} on {leads_table}")
+        return True
+    except Exception as e:
+        logger.info(f"Exception {e} occured while creating lead id index")
+        return False
+
+
+# Set lead_updated_epoch on rows written before it existed so they show up in the index
+def backfill_lead_updated_epoch(dynamodb_client, leads_table):
     try:
         table = dynamodb_client.Table(leads_table)
-        # Query to retrieve all rows for the given lead_id
-        response = table.scan(
-            FilterExpression=boto3.dynamodb.conditions.Attr("lead_id").eq(lead_id)
-        )
-
-        if len(response["Items"]) > 1:
-            # Sort the items by 'lead_updated_at' in descending order (most recent first)
-            sorted_items = sorted(
-                response["Items"],
-                key=lambda x: datetime.strptime(
-                    x.get("lead_updated_at"), "%Y-%m-%d %H:%M:%S.%f"
-                ),  # Adjusted for fractional seconds
-                reverse=True,
-            )
+        scan_kwargs = {
+            "FilterExpression": boto3.dynamodb.conditions.Attr(
+                "lead_updated_epoch"
+            ).not_exists(),
+            "ProjectionExpression": "session_id, lead_updated_at",
+        }
+        updated_count = 0
+        while True:
+            response = table.scan(**scan_kwargs)
+            for item in response["Items"]:
+                # claim rows and other partial rows have no timestamp to convert
+                if not item.get("lead_updated_at"):
+                    continue
+                try:
+                    updated_at = parse_utc_timestamp(item["lead_updated_at"])
+                    table.update_item(
+                        Key={"session_id": item["session_id"]},
+                        UpdateExpression="SET lead_updated_epoch = :epoch",
+                        ExpressionAttributeValues={
+                            ":epoch": int(updated_at.timestamp() * 1000)
+                        },
+                    )
+                    updated_count += 1
+                except Exception as e:
+                    logger.info(
+                        f"Exception {e} occured while backfilling session id {item['session_id']}"
+                    )
+            if "LastEvaluatedKey" not in response:
+                break
+            scan_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+        logger.info(f"lead_updated_epoch set for {updated_count} rows")
+        return updated_count
+    except Exception as e:
+        logger.info(f"Exception {e} occured while backfilling lead_updated_epoch")
+        return None
+
+
+# GSI partitioned by the utc day of the last lead update and sorted by its epoch, used
+# to find the recently updated leads without scanning the table
+LEAD_UPDATED_DAY_INDEX_NAME = os.environ.get(
+    "lead_updated_day_index_name", "lead_updated_day-lead_updated_epoch-index"
+)
 
-            count = 0  # Initialize count variable to store only last 5 summaries
-            
-            # Extract session_ids and summaries
-            session_summaries = []
-            for item in sorted_items:
-                session_id = item.get("session_id")
-                if session_id != current_session_id:
-                    print(f"session_id is {session_id}")
-                    summary = item.get("summary")
-                    count += 1  # Increment count
-                    if summary:
-                        session_summaries.append(summary)
-                    if count > 5:  # Break out of loop if count exceeds 4
-                        break
-
-            # Join all summaries together
-            joined_summary = "\n\n".join(session_summaries)
-        else:
-            joined_summary = ""
 
-        return joined_summary
+# Create the lead updated day index on leads table if it is not there already
+def create_lead_updated_day_index(
+    dynamodb_client, leads_table, index_name=LEAD_UPDATED_DAY_INDEX_NAME
+):
+    try:
+        client = dynamodb_client.meta.client
+        table_description = client.describe_table(TableName=leads_table)["Table"]
+        existing_indexes = [
+            index["IndexName"]
+            for index in table_description.get("GlobalSecondaryIndexes", [])
+        ]
+        if index_name in existing_indexes:
+            logger.info(f"index {index_name} already exists on {leads_table}")
+            return True
+
+        index_definition = {
+            "IndexName": index_name,
+            "KeySchema": [
+                {"AttributeName": "lead_updated_day", "KeyType": "HASH"},
+                {"AttributeName": "lead_updated_epoch", "KeyType": "RANGE"},
+            ],
+            "Projection": {
+                "ProjectionType": "INCLUDE",
+                "NonKeyAttributes": ["lead_id"],
+            },
+        }
+        billing_mode = table_description.get("BillingModeSummary", {}).get(
+            "BillingMode", "PROVISIONED"
+        )
+        if billing_mode == "PROVISIONED":
+            throughput = table_description["ProvisionedThroughput"]
+            index_definition["ProvisionedThroughput"] = {
+                "ReadCapacityUnits": throughput["ReadCapacityUnits"],
+                "WriteCapacityUnits": throughput["WriteCapacityUnits"],
+            }
+
+        client.update_table(
+            TableName=leads_table,
+            AttributeDefinitions=[
+                {"AttributeName": "lead_updated_day", "AttributeType": "S"},
+                {"AttributeName": "lead_updated_epoch", "AttributeType": "N"},
+            ],
+            GlobalSecondaryIndexUpdates=[{"Create": index_definition}],
+        )
+        logger.info(f"creating index {index_name} on {leads_table}")
+        return True
+    except Exception as e:
+        logger.info(f"Exception {e} occured while creating lead updated day index")
+        return False
+
+
+# Set lead_updated_day, and lead_updated_epoch when missing, on rows written before
+# they existed so recent rows show up in the day index
+def backfill_lead_updated_day(dynamodb_client, leads_table):
+    try:
+        table = dynamodb_client.Table(leads_table)
+        scan_kwargs = {
+            "FilterExpression": boto3.dynamodb.conditions.Attr(
+                "lead_updated_day"
+            ).not_exists(),
+            "ProjectionExpression": "session_id, lead_updated_at, lead_updated_epoch",
+        }
+        updated_count = 0
+        while True:
+            response = table.scan(**scan_kwargs)
+            for item in response["Items"]:
+                # claim rows and other partial rows have no timestamp to convert
+                if "lead_updated_epoch" not in item and not item.get("lead_updated_at"):
+                    continue
+                try:
+                    if "lead_updated_epoch" in item:
+                        epoch = int(item["lead_updated_epoch"])
+                    else:
+                        updated_at = parse_utc_timestamp(item["lead_updated_at"])
+                        epoch = int(updated_at.timestamp() * 1000)
+                    day = datetime.fromtimestamp(epoch / 1000, timezone.utc)
+                    table.update_item(
+                        Key={"session_id": item["session_id"]},
+                        UpdateExpression="SET lead_updated_day = :day, lead_updated_epoch = if_not_exists(lead_updated_epoch, :epoch)",
+                        ExpressionAttributeValues={
+                            ":day": day.strftime("%Y-%m-%d"),
+                            ":epoch": epoch,
+                        },
+                    )
+                    updated_count += 1
+                except Exception as e:
+                    logger.info(
+                        f"Exception {e} occured while backfilling session id {item['session_id']}"
+                    )
+            if "LastEvaluatedKey" not in response:
+                break
+            scan_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+        logger.info(f"lead_updated_day set for {updated_count} rows")
+        return updated_count
+    except Exception as e:
+        logger.info(f"Exception {e} occured while backfilling lead_updated_day")
+        return None
+
+
+# Function to get the latest summaries of a particular lead_id, most recent first
+def get_summary_list_for_lead(lead_id, current_session_id, dynamodb_client, leads_table):
+    try:
+        table = dynamodb_client.Table(leads_table)
+        # Query the latest rows for the given lead_id, most recent first. One extra row
+        # is read as the current session is left out of the summaries.
+        response = table.query(
+            IndexName=LEAD_ID_INDEX_NAME,
+            KeyConditionExpression=Key("lead_id").eq(lead_id),
+            ScanIndexForward=False,
+            Limit=7,
+            ProjectionExpression="session_id, summary",
+        )
+
+        # Extract summaries of last 6 sessions other than current session
+        session_summaries = []
+        for item in response["Items"]:
+            if item.get("session_id") == current_session_id:
+                continue
+            if len(session_summaries) == 6:
+                break
+            summary = item.get("summary")
+            if summary:
+                session_summaries.append(summary)
+
+        return session_summaries
     except Exception as e:
         logger.info(
             f"Error in getting the summary for the all session ids of a lead id: {e}"
         )
-        return ""
+        return []
+
+
+# Function to get the joined summaries for a particular lead_id
+def get_summaries_for_lead(lead_id, current_session_id, dynamodb_client, leads_table):
+    # Join all summaries together
+    return "\n\n".join(get_summary_list_for_lead(lead_id, current_session_id, dynamodb_client, leads_table))
+
+
+# Rolling summary digest per lead, so the Description of a long lived lead stays bounded.
+# The latest summaries are kept in full, older ones are compressed and the rest only counted.
+LEAD_DIGEST_TABLE = os.environ.get("lead_digest_table_name")
+DIGEST_RECENT_SUMMARIES = 3
+DIGEST_OLDER_SUMMARIES = 6
+DIGEST_COMPRESSED_CHARS = 400
+MAX_DESCRIPTION_CHARS = 32000
+
+
+def compress_summary(summary, max_chars=DIGEST_COMPRESSED_CHARS):
+    summary = " ".join(summary.split())
+    if len(summary) <= max_chars:
+        return summary
+    cut = summary[:max_chars]
+    # keep whole sentences when a good part of the summary fits
+    sentence_end = cut.rfind(". ")
+    if sentence_end > max_chars // 2:
+        return cut[: sentence_end + 1]
+    return cut.rsplit(" ", 1)[0] + " ..."
+
+
+def merge_summary_into_digest(digest, summary, session_id=None):
+    # a session updated again replaces its previous summary
+    recent_summaries = [
+        entry
+        for entry in digest["recent_summaries"]
+        if entry["summary"] != summary
+        and not (session_id and entry.get("session_id") == session_id)
+    ]
+    recent_summaries.insert(0, {"session_id": session_id or "", "summary": summary})
+    older_summaries = list(digest["older_summaries"])
+    archived_count = int(digest["archived_count"])
+    while len(recent_summaries) > DIGEST_RECENT_SUMMARIES:
+        older_summaries.insert(0, compress_summary(recent_summaries.pop()["summary"]))
+    while len(older_summaries) > DIGEST_OLDER_SUMMARIES:
+        older_summaries.pop()
+        archived_count += 1
+    return dict(
+        digest,
+        recent_summaries=recent_summaries,
+        older_summaries=older_summaries,
+        archived_count=archived_count,
+    )
+
+
+def render_lead_digest(digest):
+    parts = [entry["summary"] for entry in digest["recent_summaries"]]
+    if digest["older_summaries"]:
+        parts.append(
+            "Earlier sessions:\n"
+            + "\n".join(f"- {summary}" for summary in digest["older_summaries"])
+        )
+    if digest["archived_count"]:
+        parts.append(f"{digest['archived_count']} older sessions not shown.")
+    return "\n\n".join(parts)[:MAX_DESCRIPTION_CHARS]
+
+
+# Description for an existing lead with the new summary merged into its digest
+def get_lead_description(
+    lead_id, summary, dynamodb_client, leads_table, session_id=None
+):
+    if not LEAD_DIGEST_TABLE:
+        existing_summary = get_summaries_for_lead(
+            lead_id, session_id, dynamodb_client, leads_table
+        )
+        return summary + "\n\n" + existing_summary
+    try:
+        table = dynamodb_client.Table(LEAD_DIGEST_TABLE)
+        for _ in range(3):
+            digest = table.get_item(Key={"lead_id": lead_id}).get("Item")
+            if digest is None:
+                # first digest of the lead, start from the summaries in the leads table
+                digest = {
+                    "lead_id": lead_id,
+                    "recent_summaries": [],
+                    "older_summaries": [],
+                    "archived_count": 0,
+                    "version": 0,
+                }
+                previous_summaries = get_summary_list_for_lead(
+                    lead_id, session_id, dynamodb_client, leads_table
+                )
+                for previous_summary in reversed(previous_summaries):
+                    digest = merge_summary_into_digest(digest, previous_summary)
+                condition = {"ConditionExpression": "attribute_not_exists(lead_id)"}
+            else:
+                condition = {
+                    "ConditionExpression": "version = :version",
+                    "ExpressionAttributeValues": {":version": digest["version"]},
+                }
+            digest = merge_summary_into_digest(digest, summary, session_id)
+            digest["version"] = int(digest["version"]) + 1
+            digest["updated_at"] = str(datetime.utcnow())
+            try:
+                table.put_item(Item=digest, **condition)
+                return render_lead_digest(digest)
+            except ClientError as e:
+                if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    raise
+                logger.info(f"digest of lead id {lead_id} changed meanwhile, merging again")
+        return render_lead_digest(digest)
+    except Exception as e:
+        logger.info(f"Exception {e} occured while updating the lead digest")
+        existing_summary = get_summaries_for_lead(
+            lead_id, session_id, dynamodb_client, leads_table
+        )
+        return summary + "\n\n" + existing_summary
+
+
+def normalize_email(email):
+    if not email or email == "Not specified":
+        return None
+    return str(email).strip().lower()
+
+
+def normalize_phone(phone):
+    if not phone or phone == "Not specified":
+        return None
+    digits = re.sub(r"\D", "", str(phone))
+    return digits if digits else None
+
+
+# keys of the local dedup index for the email and phone number of a lead
+def get_dedup_keys(user_details_dict):
+    dedup_keys = []
+    email = normalize_email(user_details_dict.get("Email"))
+    if email:
+        dedup_keys.append(f"email#{email}")
+    phone = normalize_phone(user_details_dict.get("Phone"))
+    if phone:
+        dedup_keys.append(f"phone#{phone}")
+    return dedup_keys
+
+
+def record_lead_in_dedup_index(lead_id, user_details_dict, dynamodb_client, dedup_table):
+    if not dedup_table or not lead_id:
+        return False
+    try:
+        table = dynamodb_client.Table(dedup_table)
+        time_value = str(datetime.utcnow())
+        with table.batch_writer() as batch:
+            for dedup_key in get_dedup_keys(user_details_dict):
+                batch.put_item(
+                    Item={
+                        "dedup_key": dedup_key,
+                        "lead_id": lead_id,
+                        "updated_at": time_value,
+                    }
+                )
+        return True
+    except Exception as e:
+        logger.info(f"Exception {e} occured while updating the lead dedup index")
+        return False
+
+
+# salesforce error codes that can succeed when the call is retried
+RETRYABLE_SALESFORCE_ERROR_CODES = {
+    "REQUEST_LIMIT_EXCEEDED",
+    "UNABLE_TO_LOCK_ROW",
+    "SERVER_UNAVAILABLE",
+}
+
+# seconds kept free for a salesforce call after the backoff delay
+SALESFORCE_CALL_SECONDS = 5
 
 
-def update_lead_id(salesforce_object, lead_id, user_details_dict, summary, session_id, dynamodb_client, leads_table):
+def is_retryable_salesforce_error(error):
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    if isinstance(error, SalesforceError):
+        if error.status >= 500:
+            return True
+        content = error.content if isinstance(error.content, list) else []
+        error_codes = {item.get("errorCode") for item in content if isinstance(item, dict)}
+        return bool(error_codes & RETRYABLE_SALESFORCE_ERROR_CODES)
+    return False
+
+
+# Call salesforce, retrying only retryable errors with exponential backoff and jitter.
+# Returns the result, the last error and the number of attempts made.
+def call_salesforce_with_retry(
+    call, *args, max_attempts=3, base_delay=0.5, max_delay=8, deadline=None, **kwargs
+):
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            return call(*args, **kwargs), None, attempt
+        except Exception as e:
+            if attempt >= max_attempts or not is_retryable_salesforce_error(e):
+                return None, e, attempt
+            delay = random.uniform(0, min(max_delay, base_delay * 2**attempt))
+            if (
+                deadline is not None
+                and time.time() + delay + SALESFORCE_CALL_SECONDS > deadline
+            ):
+                logger.info(f"Not enough time left to retry salesforce call: {e}")
+                return None, e, attempt
+            logger.info(
+                f"Retryable salesforce error {e}, retrying in {delay:.2f} seconds ({attempt}/{max_attempts})"
+            )
+            time.sleep(delay)
+
+
+# Same retry policy for calls whose errors are handled by the caller, raises the last error
+def call_salesforce_or_raise(call, *args, **kwargs):
+    result, error, _ = call_salesforce_with_retry(call, *args, **kwargs)
+    if error is not None:
+        raise error
+    return result
+
+
+def update_lead_id(
+    salesforce_object,
+    lead_id,
+    user_details_dict,
+    summary,
+    session_id,
+    dynamodb_client,
+    leads_table,
+    dedup_table=None,
+):
     try:
-        existing_summary = get_summaries_for_lead(lead_id, session_id, dynamodb_client, leads_table)
-        new_summary = summary + "\n\n" + existing_summary
-        user_details_dict["Description"] = new_summary
+        user_details_dict["Description"] = get_lead_description(
+            lead_id, summary, dynamodb_client, leads_table, session_id
+        )
         # update the lead
-        update_response = salesforce_object.Lead.update(lead_id, user_details_dict)
+        update_response = call_salesforce_or_raise(
+            salesforce_object.Lead.update, lead_id, user_details_dict
+        )
 
         # Handle the 204 response (successful update)
         if update_response == 204:
             logger.info(f"Lead {lead_id} updated successfully")
+            record_lead_in_dedup_index(
+                lead_id, user_details_dict, dynamodb_client, dedup_table
+            )
             return True
         else:
             return False
@@ -218,12 +1011,15 @@ def update_leads_table(
 ):
     try:
         table = dynamodb_client.Table(leads_table)
+        new_timestamp, new_epoch, new_day = get_lead_update_time()
         table.update_item(
             Key={"session_id": session_id},
-            UpdateExpression="SET user_details = :updated_user_details, lead_updated_at = :new_timestamp,summary = :new_summary,user_inputs = :new_user_inputs, lead_update_attempts = :new_lead_update_attempts",
+            UpdateExpression="SET user_details = :updated_user_details, lead_updated_at = :new_timestamp, lead_updated_epoch = :new_epoch, lead_updated_day = :new_day,summary = :new_summary,user_inputs = :new_user_inputs, lead_update_attempts = :new_lead_update_attempts",
             ExpressionAttributeValues={
                 ":updated_user_details": user_details_dict,
-                ":new_timestamp": str(datetime.utcnow()),
+                ":new_timestamp": new_timestamp,
+                ":new_epoch": new_epoch,
+                ":new_day": new_day,
                 ":new_summary": summary,
                 ":new_user_inputs": user_inputs,
                 ":new_lead_update_attempts": lead_update_attempts,
@@ -389,8 +1185,8 @@ def extract_user_details(
         join_user_inputs = ".\n ".join(user_inputs)
 
         # modify the prompt
-        new_prompt = user_details_extraction_prompt.replace(
-            "{input_query}", join_user_inputs
+        new_prompt = user_details_extraction_prompt.render(
+            input_query=join_user_inputs
         )
 
         body = {}
@@ -435,6 +1231,254 @@ def parse_user_details(user_details):
     return user_info_dict
 
 
+# user details extracted by the model, in the order used by the extraction prompt
+USER_DETAIL_KEYS = [
+    "Name",
+    "Age",
+    "Marital Status",
+    "Work Experience",
+    "Highest Qualification",
+    "Citizen",
+    "Visa Status",
+    "Current Location",
+    "Future Location",
+    "Subject",
+    "Profession",
+    "How",
+    "Email",
+    "Country Code",
+    "Phone",
+]
+
+# tool definition used to get user details as json matching this schema
+USER_DETAILS_TOOL = {
+    "name": "record_user_details",
+    "description": "Record the user details found in the user inputs. Use null for any detail that is missing or unclear.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            key: {"type": ["string", "null"]} for key in USER_DETAIL_KEYS
+        },
+        "required": USER_DETAIL_KEYS,
+    },
+}
+
+
+# tool used to update previous user details from new user inputs only, with the
+# confidence that the update is right
+INCREMENTAL_USER_DETAILS_TOOL = {
+    "name": USER_DETAILS_TOOL["name"],
+    "description": "Record the previous user details updated with the new user inputs. Use null for any detail that is missing or unclear.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            **USER_DETAILS_TOOL["input_schema"]["properties"],
+            "Confidence": {"type": "string", "enum": ["High", "Low"]},
+        },
+        "required": USER_DETAIL_KEYS + ["Confidence"],
+    },
+}
+
+
+def parse_user_details_tool_output(response_body, keys=USER_DETAIL_KEYS):
+    for content in response_body.get("content", []):
+        if (
+            content.get("type") == "tool_use"
+            and content.get("name") == USER_DETAILS_TOOL["name"]
+        ):
+            tool_input = content.get("input") or {}
+            user_info_dict = {}
+            for key in keys:
+                value = tool_input.get(key)
+                value = "None" if value is None else str(value).strip()
+                user_info_dict[key] = value if value else "None"
+            return user_info_dict
+    return None
+
+
+def extract_user_details_json(
+    user_inputs, user_details_extraction_prompt, model_id, bedrock_runtime
+):
+    try:
+        join_user_inputs = ".\n ".join(user_inputs)
+
+        # modify the prompt
+        new_prompt = user_details_extraction_prompt.render(
+            input_query=join_user_inputs
+        )
+
+        body = {}
+        body["anthropic_version"] = "bedrock-2023-05-31"
+        body["max_tokens"] = 512
+        body["messages"] = [{"role": "user", "content": new_prompt}]
+        body["tools"] = [USER_DETAILS_TOOL]
+        body["tool_choice"] = {"type": "tool", "name": USER_DETAILS_TOOL["name"]}
+
+        response = bedrock_runtime.invoke_model(
+            modelId=model_id,
+            contentType="application/json",
+            accept="application/json",
+            body=json.dumps(body),
+        )
+
+        logger.info(
+            f"model response parameters for extracting user details as json is {response}"
+        )
+
+        # Parse the response
+        response_body = json.loads(response["body"].read().decode("utf-8"))
+        user_details_dict = parse_user_details_tool_output(response_body)
+        if user_details_dict is None:
+            logger.info(f"user details tool output not found in {response_body}")
+        return user_details_dict
+    except Exception as e:
+        logger.info(f"Exception {e} occured while extracting user details as json")
+        return None
+
+
+# Extract user details as a dict ready for validate_user_info
+def extract_user_details_dict(
+    user_inputs,
+    user_details_extraction_prompt,
+    model_id,
+    bedrock_runtime,
+    extraction_mode="json",
+):
+    if extraction_mode == "json":
+        return extract_user_details_json(
+            user_inputs, user_details_extraction_prompt, model_id, bedrock_runtime
+        )
+
+    user_details = extract_user_details(
+        user_inputs, user_details_extraction_prompt, model_id, bedrock_runtime
+    )
+    if user_details is None:
+        return None
+    return parse_user_details(user_details)
+
+
+# prompt file used by each extraction mode
+EXTRACTION_PROMPT_FILES = {
+    "json": "json_extraction_instructions.txt",
+    "text": "extraction_instructions.txt",
+}
+
+
+# salesforce lead fields stored in leads table and their extraction prompt keys
+LEAD_FIELD_TO_DETAIL_KEY = {
+    "Age1__c": "Age",
+    "Marital_Status__c": "Marital Status",
+    "Work_Experience__c": "Work Experience",
+    "What_is_your_highest_education__c": "Highest Qualification",
+    "Nationality__c": "Citizen",
+    "Visa_Status__c": "Visa Status",
+    "Domicile_Country__c": "Current Location",
+    "Where__c": "Future Location",
+    "Specialization__c": "Subject",
+    "Designation__c": "Profession",
+    "How__c": "How",
+    "Email": "Email",
+    "Phone": "Phone",
+}
+
+
+def format_previous_user_details(previous_user_details):
+    def detail_value(value):
+        if value is None or str(value).strip() in ("", "None", "Not specified"):
+            return "None"
+        return str(value)
+
+    name_parts = [
+        detail_value(previous_user_details.get(key))
+        for key in ("FirstName", "LastName")
+    ]
+    name_parts = [part for part in name_parts if part != "None"]
+    previous_details = {"Name": " ".join(name_parts) if name_parts else "None"}
+    for lead_field, detail_key in LEAD_FIELD_TO_DETAIL_KEY.items():
+        previous_details[detail_key] = detail_value(
+            previous_user_details.get(lead_field)
+        )
+    return previous_details
+
+
+# user inputs added since the last extraction, None if the old inputs are not a prefix
+def get_new_user_inputs(previous_user_inputs, user_inputs):
+    if not previous_user_inputs or len(previous_user_inputs) > len(user_inputs):
+        return None
+    if user_inputs[: len(previous_user_inputs)] != list(previous_user_inputs):
+        return None
+    return user_inputs[len(previous_user_inputs) :]
+
+
+# Extract user details from new user inputs only and merge them into previous details
+def extract_user_details_incremental(
+    previous_user_details,
+    new_user_inputs,
+    incremental_extraction_prompt,
+    model_id,
+    bedrock_runtime,
+):
+    try:
+        previous_details = format_previous_user_details(previous_user_details)
+        join_user_inputs = ".\n ".join(new_user_inputs)
+
+        # modify the prompt, previous details as json so commas in values stay intact
+        new_prompt = incremental_extraction_prompt.render(
+            previous_details=json.dumps(
+                {
+                    key: None if value == "None" else value
+                    for key, value in previous_details.items()
+                },
+                indent=2,
+            ),
+            input_query=join_user_inputs,
+        )
+
+        body = {}
+        body["anthropic_version"] = "bedrock-2023-05-31"
+        body["max_tokens"] = 512
+        body["messages"] = [{"role": "user", "content": new_prompt}]
+        body["tools"] = [INCREMENTAL_USER_DETAILS_TOOL]
+        body["tool_choice"] = {
+            "type": "tool",
+            "name": INCREMENTAL_USER_DETAILS_TOOL["name"],
+        }
+
+        response = bedrock_runtime.invoke_model(
+            modelId=model_id,
+            contentType="application/json",
+            accept="application/json",
+            body=json.dumps(body),
+        )
+
+        logger.info(
+            f"model response parameters for incremental user details extraction is {response}"
+        )
+
+        # Parse the response
+        response_body = json.loads(response["body"].read().decode("utf-8"))
+        user_details_dict = parse_user_details_tool_output(
+            response_body, USER_DETAIL_KEYS + ["Confidence"]
+        )
+        if user_details_dict is None:
+            logger.info(f"user details tool output not found in {response_body}")
+            return None
+
+        confidence = user_details_dict.pop("Confidence", "Low")
+        if confidence.lower() != "high":
+            logger.info(f"incremental extraction confidence is {confidence}")
+            return None
+
+        # keep previous values for details the model could not find in new inputs
+        for key, value in previous_details.items():
+            if user_details_dict.get(key, "None") == "None":
+                user_details_dict[key] = value
+        return user_details_dict
+    except Exception as e:
+        logger.info(f"Exception {e} occured while extracting user details incrementally")
+        return None
+
+
 def validate_user_info(user_details_dict):
     validate_user_details_obj = ValidateUserDetails()
 
@@ -571,9 +1615,11 @@ def generate_conversation_summary(
     )
     # modify the prompt
     current_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    new_prompt = summarization_prompt.replace(
-        "{conversation_text}", conversation_text
-    ).replace("{current_datetime}", current_datetime).replace("{session_id}", session_id)
+    new_prompt = summarization_prompt.render(
+        conversation_text=conversation_text,
+        current_datetime=current_datetime,
+        session_id=session_id,
+    )
 
     try:
         body = {}
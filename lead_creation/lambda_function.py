@@ -10,6 +10,7 @@ from io import StringIO
 from typing import Dict, Any, Optional
 import configparser
 import re
+from concurrent.futures import ThreadPoolExecutor
 
 # salesforce packages
 from simple_salesforce import (
@@ -46,37 +47,25 @@ def lambda_handler(event, context) -> dict:
         user_query = clean_user_query(user_query)
         logger.info(f"user query after cleaning is {user_query}")
 
-        # extract salesforce details from secrets manager
-        secret_name = os.environ["secret_name"]
-        secret_region_name = os.environ["secret_region_name"]
-
-        salesforce_secret = get_secret(secret_name, secret_region_name)
-
         final_output = {}
         final_output["lead_type"] = "Not Qualified"
         final_output[
             "lead_creation_message"
         ] = "User conversation not Qualified for creating salesforce lead"
 
-        # checking if salesforce secret is none or not
-        if salesforce_secret is None:
-            logger.info(f"salesforce_secret is {salesforce_secret}")
-            error_message = "Error in getting salesforce secrets from secret manager"
-            logger.info(error_message)
-            final_output["lead_creation_message"] = error_message
-            logger.info(f"lambda response is {final_output}")
-            return {"statusCode": 500, "body": json.dumps(final_output)}
-
-        # Access salesforce secret values
-        username = salesforce_secret.get("user_name")
-        password = salesforce_secret.get("password")
-        security_token = salesforce_secret.get("security_token")
-        domain = salesforce_secret.get("domain")
-
         # extract bedrock model id and dynamoDB tables
         model_id = os.environ["model_id"]
         chat_history_table = os.environ["chat_history_table"]
         leads_table_name = os.environ["leads_table_name"]
+        lead_dedup_table = os.environ.get("lead_dedup_table_name")
+        lead_external_id_field = os.environ.get("lead_external_id_field")
+        lead_outbox_table = os.environ.get("lead_outbox_table_name")
+
+        # time left in this invocation, salesforce retries stop before it
+        deadline = get_deadline(context)
+        session_claim_lease_seconds = int(
+            os.environ.get("session_claim_lease_seconds", "900")
+        )
 
         # extract region names
         bedrock_region_name = os.environ["bedrock_region_name"]
@@ -86,24 +75,8 @@ def lambda_handler(event, context) -> dict:
         guardrail_id = os.environ["guardrail_id"]
         guardrail_version = os.environ["guardrail_version"]
 
-        # loading user details extraction prompt
-        try:
-            with open("prompts/extraction_instructions.txt") as f:
-                user_details_extraction_prompt = f.read()
-        except Exception as e:
-            error_message = f"Error reading extraction instructions: {e}"
-            logger.info(error_message)
-            return {"statusCode": 500, "body": json.dumps({"message": error_message})}
-
-        # getting bedrock client
-        bedrock_runtime = get_bedrock_client(bedrock_region_name)
-
-        if bedrock_runtime is None:
-            error_message = "Error in creating bedrock runtime"
-            logger.info(error_message)
-            final_output["lead_creation_message"] = error_message
-            logger.info(f"lambda response is {final_output}")
-            return {"statusCode": 500, "body": json.dumps(final_output)}
+        # extraction mode, json uses tool output and text uses comma separated output
+        extraction_mode = os.environ.get("extraction_mode", "json")
 
         # get dynamodb client
         dynamodb_client = get_dynamodb_client(dynamodb_region_name)
@@ -115,92 +88,252 @@ def lambda_handler(event, context) -> dict:
             logger.info(f"lambda response is {final_output}")
             return {"statusCode": 500, "body": json.dumps(final_output)}
 
-        # get chat history
-        chat_history = get_session_history(
+        # Cheap checks first: user message count, then the session claim. The chat history,
+        # salesforce secret and bedrock client are only loaded for qualified sessions.
+        has_user_query = (
+            user_query is not None
+            and isinstance(user_query, str)
+            and len(user_query.strip()) > 0
+        )
+        chat_history = None
+        user_turn_count = get_user_turn_count(
             session_id, chat_history_table, dynamodb_client
         )
+        if user_turn_count is None:
+            # no counter on the chat history row, count the user messages from the history
+            chat_history = get_session_history(
+                session_id, chat_history_table, dynamodb_client
+            )
+            if chat_history is None:
+                error_message = "Error in getting chat history"
+                logger.info(error_message)
+                final_output["lead_creation_message"] = error_message
+                logger.info(f"lambda response is {final_output}")
+                return {"statusCode": 500, "body": json.dumps(final_output)}
+            user_turn_count = sum(
+                1 for entry in chat_history if entry["role"] == "user"
+            )
+        if has_user_query:
+            user_turn_count = user_turn_count + 1
+        logger.info(f"user_turn_count is {user_turn_count}")
 
-        if chat_history is None:
-            error_message = "Error in getting chat history"
-            logger.info(error_message)
-            final_output["lead_creation_message"] = error_message
+        if user_turn_count <= 5:
             logger.info(f"lambda response is {final_output}")
-            return {"statusCode": 500, "body": json.dumps(final_output)}
-
-        logger.info(f"length of chat_history is {len(chat_history)}")
+            return {
+                "statusCode": 200,
+                "body": json.dumps(final_output),
+            }
+
+        final_output["lead_type"] = "Qualified"
+        # claiming the session id in leads table, fails if it is already there
+        claimed_until = claim_session(
+            session_id,
+            leads_table_name,
+            dynamodb_client,
+            session_claim_lease_seconds,
+        )
+        session_id_present = claimed_until is None
+        logger.info(f"Session id available in leads table is {session_id_present}")
+        if session_id_present:
+            final_output[
+                "lead_creation_message"
+            ] = f"session id {session_id} is already present in leads table"
+            logger.info(f"lambda response is {final_output}")
+            return {
+                "statusCode": 200,
+                "body": json.dumps(final_output),
+            }
 
-        if (
-            user_query is not None
-            and isinstance(user_query, str)
-            and len(user_query.strip()) > 0
-        ):
-            # create conversation message.
-            conversation = [{"role": "user", "content": [{"text": user_query}]}]
-            chat_history = chat_history + conversation
-
-        # get user inputs from chat history
-        user_inputs = [
-            entry["content"][0]["text"]
-            for entry in chat_history
-            if entry["role"] == "user"
-        ]
-        logger.info(f"user_inputs is {user_inputs}")
-        logger.info(f"user_inputs length is {len(user_inputs)}")
-
-        # Lead creation process
-        if len(user_inputs) > 5:
-            final_output["lead_type"] = "Qualified"
-            # checking whether session id is already there in the table or not
-            session_id_present = check_session_id_and_status(
-                session_id, leads_table_name, dynamodb_client
-            )
-            logger.info(f"Session id available in leads table is {session_id_present}")
-            if not session_id_present:
-                try:
-                    # extracting user details and parsing them
-                    user_details = extract_user_details(
-                        user_inputs,
-                        user_details_extraction_prompt,
-                        model_id,
-                        bedrock_runtime,
+        executor = None
+        lead_row_written = False
+        try:
+            # get chat history
+            if chat_history is None:
+                chat_history = get_session_history(
+                    session_id, chat_history_table, dynamodb_client
+                )
+
+            if chat_history is None:
+                error_message = "Error in getting chat history"
+                logger.info(error_message)
+                final_output["lead_creation_message"] = error_message
+                logger.info(f"lambda response is {final_output}")
+                return {"statusCode": 500, "body": json.dumps(final_output)}
+
+            logger.info(f"length of chat_history is {len(chat_history)}")
+
+            if has_user_query:
+                # create conversation message.
+                conversation = [{"role": "user", "content": [{"text": user_query}]}]
+                chat_history = chat_history + conversation
+
+            # get user inputs from chat history
+            user_inputs = [
+                entry["content"][0]["text"]
+                for entry in chat_history
+                if entry["role"] == "user"
+            ]
+            logger.info(f"user_inputs is {user_inputs}")
+            logger.info(f"user_inputs length is {len(user_inputs)}")
+
+            if not mandatory_details_possibly_present(user_inputs):
+                # email or phone number can not be extracted, skip the bedrock calls
+                lead_creation_message = (
+                    "mandatory user deatils are not present to create lead"
+                )
+                final_output["lead_creation_message"] = lead_creation_message
+                user_details_dict = validate_user_info({})
+                insert_lead_to_dynamodb(
+                    session_id,
+                    "None",
+                    False,
+                    lead_creation_message,
+                    user_details_dict,
+                    "None",
+                    user_inputs,
+                    1,
+                    0,
+                    leads_table_name,
+                    dynamodb_client,
+                )
+                lead_row_written = True
+                logger.info(f"lambda response is {final_output}")
+                return {
+                    "statusCode": 200,
+                    "body": json.dumps(final_output),
+                }
+
+            # extract salesforce details from secrets manager
+            secret_name = os.environ["secret_name"]
+            secret_region_name = os.environ["secret_region_name"]
+
+            salesforce_secret = get_secret(secret_name, secret_region_name)
+
+            # checking if salesforce secret is none or not
+            if salesforce_secret is None:
+                logger.info(f"salesforce_secret is {salesforce_secret}")
+                error_message = "Error in getting salesforce secrets from secret manager"
+                logger.info(error_message)
+                final_output["lead_creation_message"] = error_message
+                logger.info(f"lambda response is {final_output}")
+                return {"statusCode": 500, "body": json.dumps(final_output)}
+
+            # Access salesforce secret values
+            username = salesforce_secret.get("user_name")
+            password = salesforce_secret.get("password")
+            security_token = salesforce_secret.get("security_token")
+            domain = salesforce_secret.get("domain")
+
+            # loading user details extraction prompt
+            try:
+                user_details_extraction_prompt = get_prompt(
+                    EXTRACTION_PROMPT_FILES[extraction_mode]
+                )
+            except Exception as e:
+                error_message = f"Error reading extraction instructions: {e}"
+                logger.info(error_message)
+                return {
+                    "statusCode": 500,
+                    "body": json.dumps({"message": error_message}),
+                }
+
+            # getting bedrock client
+            bedrock_runtime = get_bedrock_client(bedrock_region_name)
+
+            if bedrock_runtime is None:
+                error_message = "Error in creating bedrock runtime"
+                logger.info(error_message)
+                final_output["lead_creation_message"] = error_message
+                logger.info(f"lambda response is {final_output}")
+                return {"statusCode": 500, "body": json.dumps(final_output)}
+
+            # loading summary prompt
+            summary_extraction_prompt = get_prompt("summary_instructions.txt")
+
+            # extraction, summary and salesforce login are independent, run them in parallel
+            executor = ThreadPoolExecutor(max_workers=3)
+            try:
+                (
+                    user_details_future,
+                    summary_future,
+                    salesforce_future,
+                ) = start_lead_preparation(
+                    executor,
+                    user_inputs,
+                    user_details_extraction_prompt,
+                    extraction_mode,
+                    chat_history,
+                    summary_extraction_prompt,
+                    session_id,
+                    model_id,
+                    bedrock_runtime,
+                    username,
+                    password,
+                    security_token,
+                    domain,
+                    not lead_outbox_table,
+                )
+
+                # extracting user details and parsing them
+                user_details_dict = user_details_future.result()
+
+                if user_details_dict is None:
+                    discard_future(summary_future)
+                    final_output[
+                        "lead_creation_message"
+                    ] = "unable to extract user details from user inputs"
+                    logger.info(f"lambda response is {final_output}")
+                    return {
+                        "statusCode": 500,
+                        "body": json.dumps(final_output),
+                    }
+
+                user_details_dict = validate_user_info(user_details_dict)
+                logger.info(f"user_details_dict is {user_details_dict}")
+
+                # crosschecking if email, phone number and first name is present or not.
+                if (
+                    (
+                        user_details_dict["FirstName"]
+                        or user_details_dict["LastName"]
                     )
-
-                    if user_details is None:
-                        final_output[
-                            "lead_creation_message"
-                        ] = "unable to extract user details from user inputs"
-                        logger.info(f"lambda response is {final_output}")
-                        return {
-                            "statusCode": 500,
-                            "body": json.dumps(final_output),
-                        }
-
-                    user_details_dict = parse_user_details(user_details)
-                    user_details_dict = validate_user_info(user_details_dict)
-                    logger.info(f"user_details_dict is {user_details_dict}")
-
-                    # crosschecking if email, phone number and first name is present or not.
-                    if (
-                        (
-                            user_details_dict["FirstName"]
-                            or user_details_dict["LastName"]
-                        )
-                        and (user_details_dict["Email"])
-                        and (user_details_dict["Phone"])
-                    ):
-                        if not user_details_dict["LastName"]:
-                            user_details_dict["LastName"] = user_details_dict[
-                                "FirstName"
-                            ]
-                            user_details_dict["FirstName"] = None
-
-                        try:
-                            lead_creation_message = "None"
-                            # get salesforce object, conversation summary and creating lead in system
-                            salesforce_object = get_salesforce_object(
-                                username, password, security_token, domain
+                    and (user_details_dict["Email"])
+                    and (user_details_dict["Phone"])
+                ):
+                    if not user_details_dict["LastName"]:
+                        user_details_dict["LastName"] = user_details_dict[
+                            "FirstName"
+                        ]
+                        user_details_dict["FirstName"] = None
+
+                    try:
+                        lead_creation_message = "None"
+                        summary = summary_future.result()
+
+                        # queue the salesforce write, batch job drains the outbox
+                        lead_write_queued = False
+                        if lead_outbox_table:
+                            lead_write_queued = enqueue_lead_write(
+                                session_id,
+                                user_details_dict,
+                                summary,
+                                lead_outbox_table,
+                                dynamodb_client,
                             )
 
+                        if lead_write_queued:
+                            lead_id = None
+                            lead_creation_message = "lead write queued in outbox"
+                            lead_creation_attempts = 0
+                        else:
+                            # get salesforce object and creating lead in system
+                            if salesforce_future is not None:
+                                salesforce_object = salesforce_future.result()
+                            else:
+                                salesforce_object = get_salesforce_object(
+                                    username, password, security_token, domain
+                                )
+
                             if salesforce_object is None:
                                 final_output[
                                     "lead_creation_message"
@@ -211,26 +344,6 @@ def lambda_handler(event, context) -> dict:
                                     "body": json.dumps(final_output),
                                 }
 
-                            # loading summary prompt
-                            with open("prompts/summary_instructions.txt") as f:
-                                summary_extraction_prompt = f.read()
-
-                            if len(chat_history) % 2 != 0:
-                                chat_history = chat_history[:-1]
-                                logger.info(f"odd number of chat history elemnts")
-
-                            # Generate conversation summary
-                            conversation_history_list = format_conversation_history(
-                                chat_history
-                            )
-                            summary = generate_conversation_summary(
-                                conversation_history_list,
-                                bedrock_runtime,
-                                model_id,
-                                summary_extraction_prompt,
-                                session_id,
-                            )
-
                             # Lead creation in Salesforce
                             (
                                 lead_id,
@@ -242,74 +355,88 @@ def lambda_handler(event, context) -> dict:
                                 summary,
                                 dynamodb_client,
                                 leads_table_name,
+                                lead_dedup_table,
+                                lead_external_id_field,
+                                deadline,
+                                session_id,
                             )
-                        except Exception as e:
-                            logger.info(
-                                f"Exception {e} occured while creating the lead"
-                            )
-                            lead_creation_message = (
-                                f"Exception {e} occured while creating the lead"
-                            )
-                            lead_id = None
-                            lead_creation_attempts = 1
-
-                        if lead_id is None:
-                            lead_id = "None"
-                            lead_creation_status = False
-                        else:
-                            lead_creation_status = True
+                    except Exception as e:
                         logger.info(
-                            f"lead creation status for lead id {lead_id} is {lead_creation_message}"
+                            f"Exception {e} occured while creating the lead"
                         )
-                        final_output["lead_creation_message"] = lead_creation_message
-                        user_details_dict.pop("Description", None)
-                        lead_update_attempts = 0
-                        insert_lead_to_dynamodb(
-                            session_id,
-                            lead_id,
-                            lead_creation_status,
-                            lead_creation_message,
-                            user_details_dict,
-                            summary,
-                            user_inputs,
-                            lead_creation_attempts,
-                            lead_update_attempts,
-                            leads_table_name,
-                            dynamodb_client,
-                        )
-                    else:
                         lead_creation_message = (
-                            "mandatory user deatils are not present to create lead"
+                            f"Exception {e} occured while creating the lead"
                         )
-                        final_output["lead_creation_message"] = lead_creation_message
-                        lead_update_attempts = 0
+                        lead_id = None
+                        lead_creation_attempts = 1
+                        lead_write_queued = False
+
+                    if lead_id is None:
                         lead_id = "None"
                         lead_creation_status = False
-                        summary = "None"
-                        user_details_dict.pop("Description", None)
-                        lead_creation_attempts = 1
-                        insert_lead_to_dynamodb(
-                            session_id,
-                            lead_id,
-                            lead_creation_status,
-                            lead_creation_message,
-                            user_details_dict,
-                            summary,
-                            user_inputs,
-                            lead_creation_attempts,
-                            lead_update_attempts,
-                            leads_table_name,
-                            dynamodb_client,
-                        )
-                except Exception as e:
-                    logger.info(f"Exception {e} occured while extracting user details")
-                    final_output[
-                        "lead_creation_message"
-                    ] = f"Exception {e} occured while extracting user details"
-            else:
+                    else:
+                        lead_creation_status = True
+                    logger.info(
+                        f"lead creation status for lead id {lead_id} is {lead_creation_message}"
+                    )
+                    final_output["lead_creation_message"] = lead_creation_message
+                    user_details_dict.pop("Description", None)
+                    lead_update_attempts = 0
+                    insert_lead_to_dynamodb(
+                        session_id,
+                        lead_id,
+                        lead_creation_status,
+                        lead_creation_message,
+                        user_details_dict,
+                        summary,
+                        user_inputs,
+                        lead_creation_attempts,
+                        lead_update_attempts,
+                        leads_table_name,
+                        dynamodb_client,
+                        lead_write_queued,
+                    )
+                    lead_row_written = True
+                else:
+                    # summary is not needed when lead can not be created
+                    discard_future(summary_future)
+                    lead_creation_message = (
+                        "mandatory user deatils are not present to create lead"
+                    )
+                    final_output["lead_creation_message"] = lead_creation_message
+                    lead_update_attempts = 0
+                    lead_id = "None"
+                    lead_creation_status = False
+                    summary = "None"
+                    user_details_dict.pop("Description", None)
+                    lead_creation_attempts = 1
+                    insert_lead_to_dynamodb(
+                        session_id,
+                        lead_id,
+                        lead_creation_status,
+                        lead_creation_message,
+                        user_details_dict,
+                        summary,
+                        user_inputs,
+                        lead_creation_attempts,
+                        lead_update_attempts,
+                        leads_table_name,
+                        dynamodb_client,
+                    )
+                    lead_row_written = True
+            except Exception as e:
+                logger.info(f"Exception {e} occured while extracting user details")
                 final_output[
                     "lead_creation_message"
-                ] = f"session id {session_id} is already present in leads table"
+                ] = f"Exception {e} occured while extracting user details"
+        finally:
+            # do not wait for discarded tasks before returning the response
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+            if not lead_row_written:
+                release_session_claim(
+                    session_id, leads_table_name, dynamodb_client, claimed_until
+                )
         logger.info(f"lambda response is {final_output}")
         return {
             "statusCode": 200,
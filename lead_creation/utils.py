@@ -1,8 +1,10 @@
 # basic packages
 import boto3
+from botocore.exceptions import ClientError
+from boto3.dynamodb.conditions import Key
 from typing import Dict
 import random, time, os
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from random import randint
 import json
 from dotenv import load_dotenv
@@ -10,16 +12,21 @@ from io import StringIO
 from typing import Dict, Any, Optional
 import configparser
 import re
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
 
 # salesforce packages
 from simple_salesforce import (
     Salesforce,
+    SalesforceError,
     SalesforceMalformedRequest,
     SalesforceResourceNotFound,
 )
+import requests
 
 # logging
 from logger_config import logger
+from prompt_registry import get_prompt, get_prompt_versions
 
 from validate_user_details import ValidateUserDetails
 
@@ -72,10 +79,16 @@ def get_bedrock_client(region_name):
         return None
 
 
+# endpoint of a local dynamodb stand in, for example DynamoDB Local, unset for aws
+DYNAMODB_ENDPOINT_URL = os.environ.get("dynamodb_endpoint_url") or None
+
+
 def get_dynamodb_client(region_name):
     try:
         # Initialize the DynamoDB resource
-        dynamodb_client = boto3.resource("dynamodb", region_name=region_name)
+        dynamodb_client = boto3.resource(
+            "dynamodb", region_name=region_name, endpoint_url=DYNAMODB_ENDPOINT_URL
+        )
         return dynamodb_client
     except Exception as e:
         logger.error(f"Failed to set up DynamoDB client: {e}")
@@ -155,6 +168,25 @@ def get_session_history(session_id, table_name, dynamodb_client):
         return None
 
 
+# Get the user message count kept by model response lambda with a projected read.
+# Returns None when the row has no counter, then the chat history has to be read.
+def get_user_turn_count(session_id, table_name, dynamodb_client):
+    try:
+        table = dynamodb_client.Table(table_name)
+        response = table.get_item(
+            Key={"session_id": session_id},
+            ProjectionExpression="session_id, user_turn_count",
+        )
+        if "Item" not in response:
+            return 0
+        if "user_turn_count" not in response["Item"]:
+            return None
+        return int(response["Item"]["user_turn_count"])
+    except Exception as e:
+        logger.info(f"Exception {e} occured while getting user turn count")
+        return None
+
+
 # Step 2: Insert new values (session_id, history)
 def insert_session_history(session_id, history, table_name, dynamodb_client):
     try:
@@ -192,6 +224,19 @@ def update_session_history(session_id, table_name, chat_history, dynamodb_client
         logger.info(f"Exception {e} occured while updating chat history")
 
 
+# Local check so that bedrock is called only when email and phone number could be present
+def mandatory_details_possibly_present(user_inputs):
+    validate_user_details_obj = ValidateUserDetails()
+    user_text = "\n".join(user_inputs)
+    if not validate_user_details_obj.contains_email(user_text):
+        logger.info("no email address found in user inputs")
+        return False
+    if not validate_user_details_obj.contains_phone(user_text):
+        logger.info("no phone number found in user inputs")
+        return False
+    return True
+
+
 def extract_user_details(
     user_inputs, user_details_extraction_prompt, model_id, bedrock_runtime
 ):
@@ -199,8 +244,8 @@ def extract_user_details(
         join_user_inputs = ".\n ".join(user_inputs)
 
         # modify the prompt
-        new_prompt = user_details_extraction_prompt.replace(
-            "{input_query}", join_user_inputs
+        new_prompt = user_details_extraction_prompt.render(
+            input_query=join_user_inputs
         )
 
         body = {}
@@ -245,6 +290,123 @@ def parse_user_details(user_details):
     return user_info_dict
 
 
+# user details extracted by the model, in the order used by the extraction prompt
+USER_DETAIL_KEYS = [
+    "Name",
+    "Age",
+    "Marital Status",
+    "Work Experience",
+    "Highest Qualification",
+    "Citizen",
+    "Visa Status",
+    "Current Location",
+    "Future Location",
+    "Subject",
+    "Profession",
+    "How",
+    "Email",
+    "Country Code",
+    "Phone",
+]
+
+# tool definition used to get user details as json matching this schema
+USER_DETAILS_TOOL = {
+    "name": "record_user_details",
+    "description": "Record the user details found in the user inputs. Use null for any detail that is missing or unclear.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            key: {"type": ["string", "null"]} for key in USER_DETAIL_KEYS
+        },
+        "required": USER_DETAIL_KEYS,
+    },
+}
+
+
+def parse_user_details_tool_output(response_body):
+    for content in response_body.get("content", []):
+        if (
+            content.get("type") == "tool_use"
+            and content.get("name") == USER_DETAILS_TOOL["name"]
+        ):
+            tool_input = content.get("input") or {}
+            user_info_dict = {}
+            for key in USER_DETAIL_KEYS:
+                value = tool_input.get(key)
+                value = "None" if value is None else str(value).strip()
+                user_info_dict[key] = value if value else "None"
+            return user_info_dict
+    return None
+
+
+def extract_user_details_json(
+    user_inputs, user_details_extraction_prompt, model_id, bedrock_runtime
+):
+    try:
+        join_user_inputs = ".\n ".join(user_inputs)
+
+        # modify the prompt
+        new_prompt = user_details_extraction_prompt.render(
+            input_query=join_user_inputs
+        )
+
+        body = {}
+        body["anthropic_version"] = "bedrock-2023-05-31"
+        body["max_tokens"] = 512
+        body["messages"] = [{"role": "user", "content": new_prompt}]
+        body["tools"] = [USER_DETAILS_TOOL]
+        body["tool_choice"] = {"type": "tool", "name": USER_DETAILS_TOOL["name"]}
+
+        response = bedrock_runtime.invoke_model(
+            modelId=model_id,
+            contentType="application/json",
+            accept="application/json",
+            body=json.dumps(body),
+        )
+
+        logger.info(
+            f"model response parameters for extracting user details as json is {response}"
+        )
+
+        # Parse the response
+        response_body = json.loads(response["body"].read().decode("utf-8"))
+        user_details_dict = parse_user_details_tool_output(response_body)
+        if user_details_dict is None:
+            logger.info(f"user details tool output not found in {response_body}")
+        return user_details_dict
+    except Exception as e:
+        logger.info(f"Exception {e} occured while extracting user details as json")
+        return None
+
+
+# Extract user details as a dict ready for validate_user_info
+def extract_user_details_dict(
+    user_inputs,
+    user_details_extraction_prompt,
+    model_id,
+    bedrock_runtime,
+    extraction_mode="json",
+):
+    if extraction_mode == "json":
+        return extract_user_details_json(
+            user_inputs, user_details_extraction_prompt, model_id, bedrock_runtime
+        )
+
+    user_details = extract_user_details(
+        user_inputs, user_details_extraction_prompt, model_id, bedrock_runtime
+    )
+    if user_details is None:
+        return None
+    return parse_user_details(user_details)
+
+
+# prompt file used by each extraction mode
+EXTRACTION_PROMPT_FILES = {
+    "json": "json_extraction_instructions.txt",
+    "text": "extraction_instructions.txt",
+}
+
+
 def validate_user_info(user_details_dict):
     validate_user_details_obj = ValidateUserDetails()
 
@@ -418,9 +580,11 @@ def generate_conversation_summary(
     )
     # modify the prompt
     current_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    new_prompt = summarization_prompt.replace(
-        "{conversation_text}", conversation_text
-    ).replace("{current_datetime}", current_datetime).replace("{session_id}", session_id)
+    new_prompt = summarization_prompt.render(
+        conversation_text=conversation_text,
+        current_datetime=current_datetime,
+        session_id=session_id,
+    )
     try:
         body = {}
         body["anthropic_version"] = "bedrock-2023-05-31"
@@ -460,163 +624,727 @@ def get_salesforce_object(username, password, security_token, domain):
         return None
 
 
-# Function to get session ids and summaries for a particular lead_id
-def get_summaries_for_lead(lead_id, dynamodb_client, leads_table):
+def summarize_chat_history(
+    chat_history, bedrock_runtime, model_id, summarization_prompt, session_id
+):
+    if len(chat_history) % 2 != 0:
+        chat_history = chat_history[:-1]
+        logger.info(f"odd number of chat history elemnts")
+
+    # Generate conversation summary
+    conversation_history_list = format_conversation_history(chat_history)
+    summary = generate_conversation_summary(
+        conversation_history_list,
+        bedrock_runtime,
+        model_id,
+        summarization_prompt,
+        session_id,
+    )
+    return summary
+
+
+# Start user details extraction, conversation summary and salesforce login in parallel
+def start_lead_preparation(
+    executor,
+    user_inputs,
+    user_details_extraction_prompt,
+    extraction_mode,
+    chat_history,
+    summarization_prompt,
+    session_id,
+    model_id,
+    bedrock_runtime,
+    username,
+    password,
+    security_token,
+    domain,
+    acquire_salesforce=True,
+):
+    user_details_future = executor.submit(
+        extract_user_details_dict,
+        user_inputs,
+        user_details_extraction_prompt,
+        model_id,
+        bedrock_runtime,
+        extraction_mode,
+    )
+    summary_future = executor.submit(
+        summarize_chat_history,
+        chat_history,
+        bedrock_runtime,
+        model_id,
+        summarization_prompt,
+        session_id,
+    )
+    # salesforce login is not needed when lead writes go through the outbox
+    salesforce_future = None
+    if acquire_salesforce:
+        salesforce_future = executor.submit(
+            get_salesforce_object, username, password, security_token, domain
+        )
+    return user_details_future, summary_future, salesforce_future
+
+
+def discard_future(future):
+    # cancel the future if it has not started, otherwise let it finish in background
+    if not future.cancel():
+        logger.info("lead preparation task already running, discarding its result")
+
+
+# GSI on lead_id sorted by lead_updated_epoch, used to get the latest sessions of a lead
+LEAD_ID_INDEX_NAME = os.environ.get(
+    "lead_id_index_name", "lead_id-lead_updated_epoch-index"
+)
+
+
+# epoch time in milliseconds stored next to the string timestamps for indexed queries
+def get_epoch_millis():
+    return int(time.time() * 1000)
+
+
+# utc timestamp string, epoch millis and day bucket of the same instant, written together
+# so the day index and the epoch sort key always agree
+def get_lead_update_time():
+    now = datetime.now(timezone.utc)
+    return (
+        str(now.replace(tzinfo=None)),
+        int(now.timestamp() * 1000),
+        now.strftime("%Y-%m-%d"),
+    )
+
+
+# Create the lead_id index on leads table if it is not there already
+def create_lead_id_index(dynamodb_client, leads_table, index_name=LEAD_ID_INDEX_NAME):
     try:
-        table = dynamodb_client.Table(leads_table)
-        # Query to retrieve all rows for the given lead_id
-        response = table.scan(
-            FilterExpression=boto3.dynamodb.conditions.Attr("lead_id").eq(lead_id)
-        )
-
-        if len(response["Items"]) > 1:
-            # Sort the items by 'lead_updated_at' in descending order (most recent first)
-            sorted_items = sorted(
-                response["Items"],
-                key=lambda x: datetime.strptime(
-                    x.get("lead_updated_at"), "%Y-%m-%d %H:%M:%S.%f"
-                ),  # Adjusted for fractional seconds
-                reverse=True,
-            )
-        else:
-            sorted_items = response["Items"]
+        client = dynamodb_client.meta.client
+        table_description = client.describe_table(TableName=leads_table)["Table"]
+        existing_indexes = [
+            index["IndexName"]
+            for index in table_description.get("GlobalSecondaryIndexes", [])
+        ]
+        if index_name in existing_indexes:
+            logger.info(f"index {index_name} already exists on {leads_table}")
+            return True
 
-        count = 0  # Initialize count variable to store only last 5 summaries
-        logger.info(f"length of sorted_items is {len(sorted_items)}")
+        index_definition = {
+            "IndexName": index_name,
+            "KeySchema": [
+                {"AttributeName": "lead_id", "KeyType": "HASH"},
+                {"AttributeName": "lead_updated_epoch", "KeyType": "RANGE"},
+            ],
+            "Projection": {
+                "ProjectionType": "INCLUDE",
+                "NonKeyAttributes": ["summary"],
+            },
+        }
+        billing_mode = table_description.get("BillingModeSummary", {}).get(
+            "BillingMode", "PROVISIONED"
+        )
+        if billing_mode == "PROVISIONED":
+            throughput = table_description["ProvisionedThroughput"]
+            index_definition["ProvisionedThroughput"] = {
+                "ReadCapacityUnits": throughput["ReadCapacityUnits"],
+                "WriteCapacityUnits": throughput["WriteCapacityUnits"],
+            }
 
-        # Extract session_ids and summaries
-        session_summaries = []
-        for item in sorted_items:
-            count += 1  # Increment count
-            if count > 4:  # Break out of loop if count exceeds 4
+        client.update_table(
+            TableName=leads_table,
+            AttributeDefinitions=[
+                {"AttributeName": "lead_id", "AttributeType": "S"},
+                {"AttributeName": "lead_updated_epoch", "AttributeType": "N"},
+            ],
+            GlobalSecondaryIndexUpdates=[{"Create": index_definition}],
+        )
+        logger.info(f"creating index {index_name} on {leads_table}")
+        return True
+    except Exception as e:
+        logger.info(f"Exception {e} occured while creating lead id index")
+        return False
+
+
+# Timestamps like '2024-10-03 13:31:21.824414' are written with datetime.utcnow()
+def parse_utc_timestamp(value):
+    return datetime.fromisoformat(value).replace(tzinfo=timezone.utc)
+
+
+# Set lead_updated_epoch on rows written before it existed so they show up in the index
+def backfill_lead_updated_epoch(dynamodb_client, leads_table):
+    try:
+        table = dynamodb_client.Table(leads_table)
+        scan_kwargs = {
+            "FilterExpression": boto3.dynamodb.conditions.Attr(
+                "lead_updated_epoch"
+            ).not_exists(),
+            "ProjectionExpression": "session_id, lead_updated_at",
+        }
+        updated_count = 0
+        while True:
+            response = table.scan(**scan_kwargs)
+            for item in response["Items"]:
+                # claim rows and other partial rows have no timestamp to convert
+                if not item.get("lead_updated_at"):
+                    continue
+                try:
+                    updated_at = parse_utc_timestamp(item["lead_updated_at"])
+                    table.update_item(
+                        Key={"session_id": item["session_id"]},
+                        UpdateExpression="SET lead_updated_epoch = :epoch",
+                        ExpressionAttributeValues={
+                            ":epoch": int(updated_at.timestamp() * 1000)
+                        },
+                    )
+                    updated_count += 1
+                except Exception as e:
+                    logger.info(
+                        f"Exception {e} occured while backfilling session id {item['session_id']}"
+                    )
+            if "LastEvaluatedKey" not in response:
                 break
-            session_id = item.get("session_id")
-            print(f"session_id is {session_id}")
-            summary = item.get("summary")
-            if summary:
-                session_summaries.append(summary)
-
-        # Join all summaries together
-        joined_summary = "\n\n".join(session_summaries)
-        return joined_summary
+            scan_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+        logger.info(f"lead_updated_epoch set for {updated_count} rows")
+        return updated_count
+    except Exception as e:
+        logger.info(f"Exception {e} occured while backfilling lead_updated_epoch")
+        return None
+
+
+# Rows without a lead carry pending_status and pending_since for the sparse pending lead
+# index queried by the batch lead creation job
+PENDING_STATUS = "pending"
+
+
+# Function to get the latest summaries of a particular lead_id, most recent first
+def get_summary_list_for_lead(lead_id, dynamodb_client, leads_table):
+    try:
+        table = dynamodb_client.Table(leads_table)
+        # Query the latest 4 rows for the given lead_id, most recent first
+        response = table.query(
+            IndexName=LEAD_ID_INDEX_NAME,
+            KeyConditionExpression=Key("lead_id").eq(lead_id),
+            ScanIndexForward=False,
+            Limit=4,
+            ProjectionExpression="summary",
+        )
+        logger.info(f"number of summaries for lead id {lead_id} is {response['Count']}")
+
+        # Extract summaries
+        session_summaries = [
+            item.get("summary") for item in response["Items"] if item.get("summary")
+        ]
+
+        return session_summaries
     except Exception as e:
         logger.info(
             f"Error in getting the summary for the all session ids of a lead id: {e}"
         )
-        return ""
+        return []
 
 
-def lead_creation(
-    user_details_dict, salesforce_object, summary, dynamodb_client, leads_table
+# Function to get the joined summaries for a particular lead_id
+def get_summaries_for_lead(lead_id, dynamodb_client, leads_table):
+    # Join all summaries together
+    return "\n\n".join(get_summary_list_for_lead(lead_id, dynamodb_client, leads_table))
+
+
+# Rolling summary digest per lead, so the Description of a long lived lead stays bounded.
+# The latest summaries are kept in full, older ones are compressed and the rest only counted.
+LEAD_DIGEST_TABLE = os.environ.get("lead_digest_table_name")
+DIGEST_RECENT_SUMMARIES = 3
+DIGEST_OLDER_SUMMARIES = 6
+DIGEST_COMPRESSED_CHARS = 400
+MAX_DESCRIPTION_CHARS = 32000
+
+
+def compress_summary(summary, max_chars=DIGEST_COMPRESSED_CHARS):
+    summary = " ".join(summary.split())
+    if len(summary) <= max_chars:
+        return summary
+    cut = summary[:max_chars]
+    # keep whole sentences when a good part of the summary fits
+    sentence_end = cut.rfind(". ")
+    if sentence_end > max_chars // 2:
+        return cut[: sentence_end + 1]
+    return cut.rsplit(" ", 1)[0] + " ..."
+
+
+def merge_summary_into_digest(digest, summary, session_id=None):
+    # a session updated again replaces its previous summary
+    recent_summaries = [
+        entry
+        for entry in digest["recent_summaries"]
+        if entry["summary"] != summary
+        and not (session_id and entry.get("session_id") == session_id)
+    ]
+    recent_summaries.insert(0, {"session_id": session_id or "", "summary": summary})
+    older_summaries = list(digest["older_summaries"])
+    archived_count = int(digest["archived_count"])
+    while len(recent_summaries) > DIGEST_RECENT_SUMMARIES:
+        older_summaries.insert(0, compress_summary(recent_summaries.pop()["summary"]))
+    while len(older_summaries) > DIGEST_OLDER_SUMMARIES:
+        older_summaries.pop()
+        archived_count += 1
+    return dict(
+        digest,
+        recent_summaries=recent_summaries,
+        older_summaries=older_summaries,
+        archived_count=archived_count,
+    )
+
+
+def render_lead_digest(digest):
+    parts = [entry["summary"] for entry in digest["recent_summaries"]]
+    if digest["older_summaries"]:
+        parts.append(
+            "Earlier sessions:\n"
+            + "\n".join(f"- {summary}" for summary in digest["older_summaries"])
+        )
+    if digest["archived_count"]:
+        parts.append(f"{digest['archived_count']} older sessions not shown.")
+    return "\n\n".join(parts)[:MAX_DESCRIPTION_CHARS]
+
+
+# Description for an existing lead with the new summary merged into its digest
+def get_lead_description(
+    lead_id, summary, dynamodb_client, leads_table, session_id=None
 ):
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            lead_attempt = attempt + 1
-            print(f"attempt number is {lead_attempt}")
-            user_details_dict["Description"] = summary
-            result = salesforce_object.Lead.create(user_details_dict)
-            lead_id = result.get("id")
-            logger.info(f"Lead created with API response ID: {lead_id}")
-
-            lead_creation_message = "successfully created"
-            return lead_id, lead_creation_message, lead_attempt
-        except (SalesforceMalformedRequest, SalesforceResourceNotFound) as e:
-            logger.info(f"Error in creating lead: {e}")
-            lead_creation_message = f"Error in creating lead: {e}"
-            error_message = str(e)
+    if not LEAD_DIGEST_TABLE:
+        existing_summary = get_summaries_for_lead(lead_id, dynamodb_client, leads_table)
+        return summary + "\n\n" + existing_summary
+    try:
+        table = dynamodb_client.Table(LEAD_DIGEST_TABLE)
+        for _ in range(3):
+            digest = table.get_item(Key={"lead_id": lead_id}).get("Item")
+            if digest is None:
+                # first digest of the lead, start from the summaries in the leads table
+                digest = {
+                    "lead_id": lead_id,
+                    "recent_summaries": [],
+                    "older_summaries": [],
+                    "archived_count": 0,
+                    "version": 0,
+                }
+                previous_summaries = get_summary_list_for_lead(
+                    lead_id, dynamodb_client, leads_table
+                )
+                for previous_summary in reversed(previous_summaries):
+                    digest = merge_summary_into_digest(digest, previous_summary)
+                condition = {"ConditionExpression": "attribute_not_exists(lead_id)"}
+            else:
+                condition = {
+                    "ConditionExpression": "version = :version",
+                    "ExpressionAttributeValues": {":version": digest["version"]},
+                }
+            digest = merge_summary_into_digest(digest, summary, session_id)
+            digest["version"] = int(digest["version"]) + 1
+            digest["updated_at"] = str(datetime.utcnow())
+            try:
+                table.put_item(Item=digest, **condition)
+                return render_lead_digest(digest)
+            except ClientError as e:
+                if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    raise
+                logger.info(f"digest of lead id {lead_id} changed meanwhile, merging again")
+        return render_lead_digest(digest)
+    except Exception as e:
+        logger.info(f"Exception {e} occured while updating the lead digest")
+        existing_summary = get_summaries_for_lead(lead_id, dynamodb_client, leads_table)
+        return summary + "\n\n" + existing_summary
 
-            logger.info(f"error in creating the lead is {error_message.lower()}")
-            # Check if the error message contains "Email already exists"
-            if "email already exists in our database" in error_message.lower():
-                email_id = user_details_dict["Email"]
-                logger.info(f"Email id is already there in database {email_id}")
 
-                # SQL query to find the lead with the given email ID
-                query = f"SELECT Id, Name, Email, Description FROM Lead WHERE Email = '{email_id}' LIMIT 1"
+def normalize_email(email):
+    if not email or email == "Not specified":
+        return None
+    return str(email).strip().lower()
 
-                try:
-                    # Execute the query
-                    lead_result = salesforce_object.query(query)
-
-                    # Check if the lead exists
-                    if lead_result["totalSize"] > 0:
-                        lead = lead_result["records"][0]
-                        logger.info(
-                            f"Lead found: {lead['Name']} (ID: {lead['Id']}, Email: {lead['Email']}, Description: {lead['Description']})"
-                        )
-                    else:
-                        logger.info(f"No lead found with email: {email_id}")
-
-                    lead_id = lead["Id"]
-                    existing_summary = get_summaries_for_lead(
-                        lead_id, dynamodb_client, leads_table
-                    )
-                    new_summary = summary + "\n\n" + existing_summary
-                    user_details_dict["Description"] = new_summary
-                    salesforce_object.Lead.update(lead_id, user_details_dict)
 
-                    lead_attempt = attempt + 1
-                    lead_creation_message = f"Lead id {lead_id} already exists for user mail id {email_id}. Only updating the summary."
-                    return lead_id, lead_creation_message, lead_attempt
-                except Exception as e:
-                    lead_creation_message = f"Email id is already there in database. Unexpected error at creating the lead: {e}"
-                    logger.info(lead_creation_message)
-                    lead_attempt = attempt + 1
-                    return None, lead_creation_message, lead_attempt
+def normalize_phone(phone):
+    if not phone or phone == "Not specified":
+        return None
+    digits = re.sub(r"\D", "", str(phone))
+    return digits if digits else None
+
+
+# keys of the local dedup index for the email and phone number of a lead
+def get_dedup_keys(user_details_dict):
+    dedup_keys = []
+    email = normalize_email(user_details_dict.get("Email"))
+    if email:
+        dedup_keys.append(f"email#{email}")
+    phone = normalize_phone(user_details_dict.get("Phone"))
+    if phone:
+        dedup_keys.append(f"phone#{phone}")
+    return dedup_keys
+
+
+# Find a lead id already created for the email or phone number in the dedup index
+def lookup_lead_in_dedup_index(user_details_dict, dynamodb_client, dedup_table):
+    if not dedup_table:
+        return None
+    try:
+        dedup_keys = get_dedup_keys(user_details_dict)
+        if not dedup_keys:
+            return None
+        response = dynamodb_client.batch_get_item(
+            RequestItems={
+                dedup_table: {
+                    "Keys": [{"dedup_key": dedup_key} for dedup_key in dedup_keys],
+                    "ProjectionExpression": "dedup_key, lead_id",
+                }
+            }
+        )
+        lead_ids = {
+            item["dedup_key"]: item["lead_id"]
+            for item in response["Responses"].get(dedup_table, [])
+        }
+        # email match is preferred over phone match
+        for dedup_key in dedup_keys:
+            if dedup_key in lead_ids:
+                logger.info(f"lead id {lead_ids[dedup_key]} found for {dedup_key}")
+                return lead_ids[dedup_key]
+        return None
+    except Exception as e:
+        logger.info(f"Exception {e} occured while checking the lead dedup index")
+        return None
+
+
+def record_lead_in_dedup_index(lead_id, user_details_dict, dynamodb_client, dedup_table):
+    if not dedup_table or not lead_id:
+        return False
+    try:
+        table = dynamodb_client.Table(dedup_table)
+        time_value = str(datetime.utcnow())
+        with table.batch_writer() as batch:
+            for dedup_key in get_dedup_keys(user_details_dict):
+                batch.put_item(
+                    Item={
+                        "dedup_key": dedup_key,
+                        "lead_id": lead_id,
+                        "updated_at": time_value,
+                    }
+                )
+        return True
+    except Exception as e:
+        logger.info(f"Exception {e} occured while updating the lead dedup index")
+        return False
+
+
+# Update an existing lead with the new summary added to the previous summaries
+def update_existing_lead(
+    lead_id,
+    user_details_dict,
+    salesforce_object,
+    summary,
+    dynamodb_client,
+    leads_table,
+    session_id=None,
+):
+    user_details_dict["Description"] = get_lead_description(
+        lead_id, summary, dynamodb_client, leads_table, session_id
+    )
+    call_salesforce_or_raise(salesforce_object.Lead.update, lead_id, user_details_dict)
+
+
+# salesforce error codes that can succeed when the call is retried
+RETRYABLE_SALESFORCE_ERROR_CODES = {
+    "REQUEST_LIMIT_EXCEEDED",
+    "UNABLE_TO_LOCK_ROW",
+    "SERVER_UNAVAILABLE",
+}
+
+# seconds kept free for a salesforce call after the backoff delay
+SALESFORCE_CALL_SECONDS = 5
 
+
+# Deadline as epoch seconds from the lambda context, keeping some time to save results
+def get_deadline(context, reserve_seconds=10):
+    if context is None:
+        return None
+    try:
+        return time.time() + context.get_remaining_time_in_millis() / 1000 - reserve_seconds
+    except Exception as e:
+        logger.info(f"Exception {e} occured while reading remaining lambda time")
+        return None
+
+
+def is_retryable_salesforce_error(error):
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    if isinstance(error, SalesforceError):
+        if error.status >= 500:
+            return True
+        content = error.content if isinstance(error.content, list) else []
+        error_codes = {item.get("errorCode") for item in content if isinstance(item, dict)}
+        return bool(error_codes & RETRYABLE_SALESFORCE_ERROR_CODES)
+    return False
+
+
+# Call salesforce, retrying only retryable errors with exponential backoff and jitter.
+# Returns the result, the last error and the number of attempts made.
+def call_salesforce_with_retry(
+    call, *args, max_attempts=3, base_delay=0.5, max_delay=8, deadline=None, **kwargs
+):
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            return call(*args, **kwargs), None, attempt
+        except Exception as e:
+            if attempt >= max_attempts or not is_retryable_salesforce_error(e):
+                return None, e, attempt
+            delay = random.uniform(0, min(max_delay, base_delay * 2**attempt))
             if (
-                "mobile phone number already exists in our database."
-                in error_message.lower()
+                deadline is not None
+                and time.time() + delay + SALESFORCE_CALL_SECONDS > deadline
             ):
-                phone_number = user_details_dict["Phone"]
-                logger.info(f"Phone number is already there in database {phone_number}")
+                logger.info(f"Not enough time left to retry salesforce call: {e}")
+                return None, e, attempt
+            logger.info(
+                f"Retryable salesforce error {e}, retrying in {delay:.2f} seconds ({attempt}/{max_attempts})"
+            )
+            time.sleep(delay)
+
+
+# Same retry policy for calls whose errors are handled by the caller, raises the last error
+def call_salesforce_or_raise(call, *args, **kwargs):
+    result, error, _ = call_salesforce_with_retry(call, *args, **kwargs)
+    if error is not None:
+        raise error
+    return result
+
+
+# messages used when email or phone number of the lead already exists in salesforce
+DUPLICATE_LEAD_MESSAGES = {
+    "Email": {
+        "error": "email already exists in our database",
+        "found": "Lead id {lead_id} already exists for user mail id {value}. Only updating the summary.",
+        "failed": "Email id is already there in database. Unexpected error at creating the lead: {error}",
+    },
+    "Phone": {
+        "error": "mobile phone number already exists in our database.",
+        "found": "Lead id {lead_id} already exists for phone_number is {value}. updating the summary.",
+        "failed": "Phone number is already there in database. Unexpected error at creating the lead: {error}",
+    },
+}
+
+
+# Update the existing lead when salesforce reports the email or phone number as duplicate.
+# Returns None when the error is not a duplicate error.
+def resolve_duplicate_lead(
+    error_message,
+    user_details_dict,
+    salesforce_object,
+    summary,
+    dynamodb_client,
+    leads_table,
+    dedup_table,
+    lead_attempt,
+    session_id=None,
+):
+    logger.info(f"error in creating the lead is {error_message.lower()}")
+    for field, messages in DUPLICATE_LEAD_MESSAGES.items():
+        if messages["error"] not in error_message.lower():
+            continue
 
-                # SOQL query to find the lead with the given email ID
-                query = f"SELECT Id, Name, Phone, Description FROM Lead WHERE Phone = '{phone_number}' LIMIT 1"
+        value = user_details_dict[field]
+        logger.info(f"{field} is already there in database {value}")
 
-                try:
-                    # Execute the query
-                    lead_result = salesforce_object.query(query)
-
-                    # Check if the lead exists
-                    if lead_result["totalSize"] > 0:
-                        lead = lead_result["records"][0]
-                        logger.info(
-                            f"Lead found: {lead['Name']} (ID: {lead['Id']}, Phone: {lead['Phone']}, Description: {lead['Description']})"
-                        )
-                    else:
-                        logger.info(f"No lead found with phone_number: {phone_number}")
-
-                    lead_id = lead["Id"]
-                    existing_summary = get_summaries_for_lead(
-                        lead_id, dynamodb_client, leads_table
-                    )
-                    new_summary = summary + "\n\n" + existing_summary
-                    user_details_dict["Description"] = new_summary
-                    salesforce_object.Lead.update(lead_id, user_details_dict)
+        # SOQL query to find the lead with the given email ID or phone number
+        query = f"SELECT Id, Name, {field}, Description FROM Lead WHERE {field} = '{value}' LIMIT 1"
 
-                    lead_attempt = attempt + 1
-                    lead_creation_message = f"Lead id {lead_id} already exists for phone_number is {phone_number}. updating the summary."
-                    return lead_id, lead_creation_message, lead_attempt
-                except Exception as e:
-                    lead_creation_message = f"Phone number is already there in database. Unexpected error at creating the lead: {e}"
-                    logger.info(lead_creation_message)
-                    lead_attempt = attempt + 1
-                    return None, lead_creation_message, lead_attempt
-
-            if attempt < max_retries - 1:
-                logger.info(f"Retrying... ({attempt + 1}/{max_retries})")
-                time.sleep(2)  # Wait for 2 seconds before retrying
+        try:
+            # Execute the query
+            lead_result = call_salesforce_or_raise(salesforce_object.query, query)
+
+            # Check if the lead exists
+            if lead_result["totalSize"] > 0:
+                lead = lead_result["records"][0]
+                logger.info(
+                    f"Lead found: {lead['Name']} (ID: {lead['Id']}, {field}: {lead[field]}, Description: {lead['Description']})"
+                )
             else:
-                logger.info("Max retries reached. Could not create lead.")
-                lead_attempt = attempt + 1
-                return None, lead_creation_message, lead_attempt
+                logger.info(f"No lead found with {field}: {value}")
+
+            lead_id = lead["Id"]
+            update_existing_lead(
+                lead_id,
+                user_details_dict,
+                salesforce_object,
+                summary,
+                dynamodb_client,
+                leads_table,
+                session_id,
+            )
+            record_lead_in_dedup_index(
+                lead_id, user_details_dict, dynamodb_client, dedup_table
+            )
+
+            lead_creation_message = messages["found"].format(lead_id=lead_id, value=value)
+            return lead_id, lead_creation_message, lead_attempt
         except Exception as e:
-            lead_creation_message = f"Unexpected error at creating the lead: {e}"
+            lead_creation_message = messages["failed"].format(error=e)
             logger.info(lead_creation_message)
-            lead_attempt = attempt + 1
             return None, lead_creation_message, lead_attempt
+    return None
+
+
+# external id fields found missing in the salesforce org, upsert is skipped for them
+UNSUPPORTED_EXTERNAL_ID_FIELDS = set()
+
+
+# Create or update the lead keyed on an external id field holding the normalized email
+def upsert_lead(
+    user_details_dict,
+    salesforce_object,
+    summary,
+    external_id_field,
+    dynamodb_client,
+    leads_table,
+    deadline=None,
+    session_id=None,
+):
+    external_id = normalize_email(user_details_dict.get("Email"))
+    if external_id is None or external_id_field in UNSUPPORTED_EXTERNAL_ID_FIELDS:
+        return None, None
+    try:
+        lead_fields = dict(user_details_dict)
+        lead_fields.pop(external_id_field, None)
+        lead_fields["Description"] = summary
+        response, error, _ = call_salesforce_with_retry(
+            salesforce_object.Lead.upsert,
+            f"{external_id_field}/{quote(external_id, safe='@.')}",
+            lead_fields,
+            raw_response=True,
+            deadline=deadline,
+        )
+        if error is not None:
+            raise error
+        result = response.json() if response.content else {}
+        lead_id = result.get("id")
+        created = result.get("created", response.status_code == 201)
+        if lead_id is None:
+            # older api versions do not return the id of an updated record
+            lead_result = call_salesforce_or_raise(
+                salesforce_object.query,
+                f"SELECT Id FROM Lead WHERE {external_id_field} = '{external_id}' LIMIT 1"
+            )
+            lead_id = lead_result["records"][0]["Id"]
+
+        if created:
+            logger.info(f"Lead created with upsert, ID: {lead_id}")
+            return lead_id, "successfully created"
+
+        # returning user, keep the summaries of previous sessions in the description
+        description = get_lead_description(
+            lead_id, summary, dynamodb_client, leads_table, session_id
+        )
+        if description.strip() != summary.strip():
+            call_salesforce_or_raise(
+                salesforce_object.Lead.update, lead_id, {"Description": description}
+            )
+        lead_creation_message = f"Lead id {lead_id} already exists for external id {external_id}. Updated the lead with upsert."
+        logger.info(lead_creation_message)
+        return lead_id, lead_creation_message
+    except (SalesforceMalformedRequest, SalesforceResourceNotFound) as e:
+        error_message = str(e)
+        if "INVALID_FIELD" in error_message or "NOT_FOUND" in error_message:
+            logger.info(f"external id field {external_id_field} is not available: {e}")
+            UNSUPPORTED_EXTERNAL_ID_FIELDS.add(external_id_field)
+        else:
+            logger.info(f"Error in upserting lead: {e}")
+        return None, None
+    except Exception as e:
+        logger.info(f"Unexpected error at upserting the lead: {e}")
+        return None, None
+
+
+def lead_creation(
+    user_details_dict,
+    salesforce_object,
+    summary,
+    dynamodb_client,
+    leads_table,
+    dedup_table=None,
+    external_id_field=None,
+    deadline=None,
+    session_id=None,
+):
+    # go straight to update when a lead is already known for the email or phone number
+    lead_id = lookup_lead_in_dedup_index(user_details_dict, dynamodb_client, dedup_table)
+    if lead_id is not None:
+        try:
+            update_existing_lead(
+                lead_id,
+                user_details_dict,
+                salesforce_object,
+                summary,
+                dynamodb_client,
+                leads_table,
+                session_id,
+            )
+            record_lead_in_dedup_index(
+                lead_id, user_details_dict, dynamodb_client, dedup_table
+            )
+            lead_creation_message = f"Lead id {lead_id} found in dedup index. Only updating the summary."
+            return lead_id, lead_creation_message, 1
+        except Exception as e:
+            logger.info(
+                f"Error in updating lead {lead_id} from dedup index: {e}, creating the lead"
+            )
+
+    # single call create or update when the org has an external id field for leads
+    if external_id_field:
+        lead_id, lead_creation_message = upsert_lead(
+            user_details_dict,
+            salesforce_object,
+            summary,
+            external_id_field,
+            dynamodb_client,
+            leads_table,
+            deadline,
+            session_id,
+        )
+        if lead_id is not None:
+            record_lead_in_dedup_index(
+                lead_id, user_details_dict, dynamodb_client, dedup_table
+            )
+            return lead_id, lead_creation_message, 1
+        logger.info("upsert did not complete, creating the lead")
+
+    user_details_dict["Description"] = summary
+    result, error, lead_attempt = call_salesforce_with_retry(
+        salesforce_object.Lead.create, user_details_dict, deadline=deadline
+    )
+    print(f"attempt number is {lead_attempt}")
+    if error is None:
+        lead_id = result.get("id")
+        logger.info(f"Lead created with API response ID: {lead_id}")
+        record_lead_in_dedup_index(
+            lead_id, user_details_dict, dynamodb_client, dedup_table
+        )
+
+        lead_creation_message = "successfully created"
+        return lead_id, lead_creation_message, lead_attempt
+
+    if isinstance(error, SalesforceError):
+        logger.info(f"Error in creating lead: {error}")
+        duplicate_result = resolve_duplicate_lead(
+            str(error),
+            user_details_dict,
+            salesforce_object,
+            summary,
+            dynamodb_client,
+            leads_table,
+            dedup_table,
+            lead_attempt,
+            session_id,
+        )
+        if duplicate_result is not None:
+            return duplicate_result
+        lead_creation_message = f"Error in creating lead: {error}"
+    else:
+        lead_creation_message = f"Unexpected error at creating the lead: {error}"
+    logger.info(lead_creation_message)
+    return None, lead_creation_message, lead_attempt
 
 
 def check_session_id_and_status(session_id, table_name, dynamodb_client):
@@ -642,6 +1370,98 @@ def check_session_id_and_status(session_id, table_name, dynamodb_client):
         return False
 
 
+# Reserve the session in leads table so that only one invocation creates its lead.
+# A claim older than the lease can be taken over, in case the claiming worker crashed.
+# Returns the lease end of the new claim, or None when the session is already taken.
+def claim_session(session_id, table_name, dynamodb_client, lease_seconds):
+    try:
+        table = dynamodb_client.Table(table_name)
+        now = int(time.time())
+        claimed_until = now + lease_seconds
+        table.put_item(
+            Item={
+                "session_id": session_id,
+                "lead_id": "None",
+                "claim_status": "claimed",
+                "claimed_until": claimed_until,
+                "lead_created_at": str(datetime.utcnow()),
+                # found by the batch job only when the lease runs out
+                "pending_status": PENDING_STATUS,
+                "pending_since": claimed_until * 1000,
+            },
+            ConditionExpression="attribute_not_exists(session_id) OR (claim_status = :claimed AND claimed_until < :now)",
+            ExpressionAttributeValues={":claimed": "claimed", ":now": now},
+        )
+        logger.info(f"Session ID {session_id} claimed in leads table.")
+        # the lease end identifies this claim when it is released
+        return claimed_until
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            logger.info(f"Session ID {session_id} is already present in the table.")
+        else:
+            logger.info(f"Exception {e} occured while claiming session id in leads table")
+        return None
+    except Exception as e:
+        logger.info(f"Exception {e} occured while claiming session id in leads table")
+        return None
+
+
+# Remove the claim when the session was not processed, so a later call can retry it.
+# Only the claim written by this call is removed, not one taken over after its lease ran out.
+def release_session_claim(session_id, table_name, dynamodb_client, claimed_until):
+    try:
+        table = dynamodb_client.Table(table_name)
+        table.delete_item(
+            Key={"session_id": session_id},
+            ConditionExpression="claim_status = :claimed AND claimed_until = :my_claimed_until",
+            ExpressionAttributeValues={
+                ":claimed": "claimed",
+                ":my_claimed_until": claimed_until,
+            },
+        )
+        logger.info(f"Released claim on session ID {session_id}.")
+    except Exception as e:
+        logger.info(f"Exception {e} occured while releasing session id claim")
+
+
+# Record the lead write intent in the outbox table, the batch job sends it to salesforce
+def enqueue_lead_write(
+    session_id, user_details_dict, summary, outbox_table, dynamodb_client
+):
+    try:
+        dedup_keys = get_dedup_keys(user_details_dict)
+        created_epoch = get_epoch_millis()
+        table = dynamodb_client.Table(outbox_table)
+        table.put_item(
+            Item={
+                "outbox_id": session_id,
+                "session_id": session_id,
+                "outbox_status": PENDING_STATUS,
+                # keys of the sparse outbox index read by the batch job
+                "pending_status": PENDING_STATUS,
+                "pending_since": created_epoch,
+                "lead_key": dedup_keys[0] if dedup_keys else f"session#{session_id}",
+                "created_epoch": created_epoch,
+                "created_at": str(datetime.utcnow()),
+                "user_details": user_details_dict,
+                "summary": summary,
+                "attempts": 0,
+            },
+            ConditionExpression="attribute_not_exists(outbox_id)",
+        )
+        logger.info(f"lead write for session id {session_id} queued in outbox")
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            logger.info(f"lead write for session id {session_id} is already in outbox")
+            return True
+        logger.info(f"Exception {e} occured while queueing lead write")
+        return False
+    except Exception as e:
+        logger.info(f"Exception {e} occured while queueing lead write")
+        return False
+
+
 def insert_lead_to_dynamodb(
     session_id,
     lead_id,
@@ -654,10 +1474,11 @@ def insert_lead_to_dynamodb(
     lead_update_attempts,
     table_name,
     dynamodb_client,
+    outbox_pending=False,
 ):
     # Connect to the DynamoDB table
     table = dynamodb_client.Table(table_name)
-    time_value = str(datetime.utcnow())
+    time_value, epoch_value, day_value = get_lead_update_time()
     # Define the item to be inserted
     item = {
         "session_id": session_id,
@@ -665,6 +1486,8 @@ def insert_lead_to_dynamodb(
         "lead_creation_status": lead_creation_status,
         "lead_created_at": time_value,
         "lead_updated_at": time_value,
+        "lead_updated_epoch": epoch_value,
+        "lead_updated_day": day_value,
         "lead_creation_message": lead_creation_message,
         "user_details": user_details_dict,
         "summary": summary,
@@ -672,6 +1495,13 @@ def insert_lead_to_dynamodb(
         "lead_creation_attempts": lead_creation_attempts,
         "lead_update_attempts": lead_update_attempts,
     }
+    # lead write is waiting in the outbox, batch job drains it
+    if outbox_pending:
+        item["outbox_pending"] = True
+    elif lead_id in (None, "None"):
+        # sparse index of sessions the batch job still has to create a lead for
+        item["pending_status"] = PENDING_STATUS
+        item["pending_since"] = item["lead_updated_epoch"]
 
     try:
         # Put the item into the DynamoDB table
@@ -2,6 +2,19 @@ import os
 import re
 import time
 
+# patterns used to validate extracted user details
+NAME_PATTERN = re.compile(r"^[a-zA-Z ]+$")
+EMAIL_PATTERN = re.compile(r"^[\w\.-]+@[\w\.-]+\.\w+$")
+PHONE_PATTERN = re.compile(r"^\+?[0-9 ]+$")
+COUNTRY_CODE_PATTERN = re.compile(r"^\+?[0-9]+$")
+
+# patterns used to look for an email or phone number anywhere in free text
+EMAIL_SEARCH_PATTERN = re.compile(
+    r"[\w\.-]+\s*@\s*[\w\.-]+|\w+\s*[\(\[]?\s*at\s*[\)\]]?\s*\w+\s*[\(\[]?\s*dot\s*[\)\]]?\s*\w+",
+    re.IGNORECASE,
+)
+PHONE_SEARCH_PATTERN = re.compile(r"(?:\d[\s\-\.\(\)]*){7,}")
+
 
 class ValidateUserDetails:
     @staticmethod
@@ -18,8 +31,7 @@ class ValidateUserDetails:
         """Check if the name is valid."""
         # Use regular expression to validate name format
         print(f"Name check: ", name)
-        pattern = r"^[a-zA-Z ]+$"
-        if re.match(pattern, name):
+        if NAME_PATTERN.match(name):
             return True
         else:
             return False
@@ -29,8 +41,7 @@ class ValidateUserDetails:
         """Check if the email is valid."""
         # Use regular expression to validate email format
         print(f"Email check: ", email)
-        pattern = r"^[\w\.-]+@[\w\.-]+\.\w+$"
-        if re.match(pattern, email):
+        if EMAIL_PATTERN.match(email):
             return True
         else:
             return False
@@ -40,8 +51,7 @@ class ValidateUserDetails:
         """Check if the phone number is valid."""
         # Use regular expression to validate phone number format
         print(f"Phone check: ", phone)
-        pattern = r"^\+?[0-9 ]+$"
-        if re.match(pattern, phone):
+        if PHONE_PATTERN.match(phone):
             return True
         else:
             return False
@@ -64,8 +74,17 @@ class ValidateUserDetails:
         """Check if the country code is valid."""
         # Use regular expression to validate country code format
         print(f"Country code check: ", country_code)
-        pattern = r"^\+?[0-9]+$"
-        if re.match(pattern, country_code):
+        if COUNTRY_CODE_PATTERN.match(country_code):
             return True
         else:
             return False
+
+    @staticmethod
+    def contains_email(text):
+        """Check if the text could contain an email address."""
+        return EMAIL_SEARCH_PATTERN.search(text) is not None
+
+    @staticmethod
+    def contains_phone(text):
+        """Check if the text could contain a phone number."""
+        return PHONE_SEARCH_PATTERN.search(text) is not None
@@ -119,8 +119,7 @@ def lambda_handler(event, context) -> dict:
             return {"statusCode": 500, "body": json.dumps(final_output)}
 
         # loading system prompt
-        with open("prompts/system_instructions.txt") as f:
-            system_prompt = f.read()
+        system_prompt = get_prompt("system_instructions.txt").text
 
         # get chat history
         chat_history = get_session_history(
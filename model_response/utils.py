@@ -2,7 +2,7 @@
 import boto3
 from typing import Dict
 import random, time, os
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from random import randint
 import json
 from dotenv import load_dotenv
@@ -13,6 +13,7 @@ import re
 
 # logging
 from logger_config import logger
+from prompt_registry import get_prompt, get_prompt_versions
 
 from validate_user_details import ValidateUserDetails
 
@@ -148,6 +149,12 @@ def get_session_history(session_id, table_name, dynamodb_client):
         return None
 
 
+# Number of user messages in the chat history, stored with the history so that
+# lead creation lambda can check it without reading the whole history
+def count_user_turns(history):
+    return sum(1 for entry in history if entry["role"] == "user")
+
+
 # Step 2: Insert new values (session_id, history)
 def insert_session_history(session_id, history, table_name, dynamodb_client):
     try:
@@ -157,6 +164,7 @@ def insert_session_history(session_id, history, table_name, dynamodb_client):
             Item={
                 "session_id": session_id,
                 "history": history,
+                "user_turn_count": count_user_turns(history),
                 "created_at": current_time,
                 "updated_at": current_time,
             }
@@ -174,9 +182,10 @@ def update_session_history(session_id, table_name, chat_history, dynamodb_client
         # Update the table with the new history
         table.update_item(
             Key={"session_id": session_id},
-            UpdateExpression="SET history = :new_history, updated_at = :new_timestamp",
+            UpdateExpression="SET history = :new_history, user_turn_count = :user_turn_count, updated_at = :new_timestamp",
             ExpressionAttributeValues={
                 ":new_history": chat_history,
+                ":user_turn_count": count_user_turns(chat_history),
                 ":new_timestamp": str(datetime.utcnow()),
             },
         )
@@ -192,8 +201,8 @@ def extract_user_details(
         join_user_inputs = ".\n ".join(user_inputs)
 
         # modify the prompt
-        new_prompt = user_details_extraction_prompt.replace(
-            "{input_query}", join_user_inputs
+        new_prompt = user_details_extraction_prompt.render(
+            input_query=join_user_inputs
         )
 
         body = {}
@@ -454,40 +463,6 @@ def get_salesforce_object(username, password, security_token, domain):
         return None
 
 
-def lead_creation(user_details_dict, salesforce_object, summary):
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            print(f"attempt number is {attempt}")
-            result = salesforce_object.Lead.create(user_details_dict)
-            lead_id = result.get("id")
-            logger.info(f"Lead created with API response ID: {lead_id}")
-
-            # Update the lead with the conversation summary
-            salesforce_object.Lead.update(lead_id, {"Description": summary})
-            lead_creation_message = "successfully created"
-            return lead_id, lead_creation_message
-        except (SalesforceMalformedRequest, SalesforceResourceNotFound) as e:
-            logger.info(f"Error creating or updating lead: {e}")
-            lead_creation_message = f"Error creating or updating lead: {e}"
-            error_message = str(e)
-
-            # Check if the error message contains "Email already exists"
-            if "already exists in our database." in error_message.lower():
-                return None, lead_creation_message
-
-            if attempt < max_retries - 1:
-                logger.info(f"Retrying... ({attempt + 1}/{max_retries})")
-                time.sleep(2)  # Wait for 2 seconds before retrying
-            else:
-                logger.info("Max retries reached. Could not create lead.")
-                return None, lead_creation_message
-        except Exception as e:
-            logger.info(f"Unexpected error: {e}")
-            lead_creation_message = f"Unexpected error: {e}"
-            return None, lead_creation_message
-
-
 def check_session_id_and_status(session_id, table_name, dynamodb_client):
     try:
         # Connect to the table
@@ -511,6 +486,17 @@ def check_session_id_and_status(session_id, table_name, dynamodb_client):
         return False
 
 
+# utc timestamp string, epoch millis and day bucket of the same instant, written together
+# so the day index and the epoch sort key always agree
+def get_lead_update_time():
+    now = datetime.now(timezone.utc)
+    return (
+        str(now.replace(tzinfo=None)),
+        int(now.timestamp() * 1000),
+        now.strftime("%Y-%m-%d"),
+    )
+
+
 def insert_lead_to_dynamodb(
     session_id,
     lead_id,
@@ -523,7 +509,7 @@ def insert_lead_to_dynamodb(
 ):
     # Connect to the DynamoDB table
     table = dynamodb_client.Table(table_name)
-    time_value = str(datetime.utcnow())
+    time_value, epoch_value, day_value = get_lead_update_time()
     # Define the item to be inserted
     item = {
         "session_id": session_id,
@@ -531,10 +517,16 @@ def insert_lead_to_dynamodb(
         "lead_creation_status": lead_creation_status,
         "lead_created_at": time_value,
         "lead_updated_at": time_value,
+        "lead_updated_epoch": epoch_value,
+        "lead_updated_day": day_value,
         "lead_creation_message": lead_creation_message,
         "user_details": user_details_dict,
         "summary": summary,
     }
+    # sparse index of sessions the batch job still has to create a lead for
+    if lead_id in (None, "None"):
+        item["pending_status"] = "pending"
+        item["pending_since"] = item["lead_updated_epoch"]
 
     try:
         # Put the item into the DynamoDB table